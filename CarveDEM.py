@@ -1,15 +1,22 @@
 # -*- coding: cp1251 -*-
 import arcpy
 import sys
+import os
 import traceback
 import math
+import multiprocessing
 import numpy
+import Utils
+import ScratchWorkspace as SW
 from arcpy.sa import *
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from datetime import datetime
 
 shift = []
 window = []
 noData = -9999
+shared = {}
 # 2019, Timofey Samsonov, Lomonosov Moscow State University
 
 
@@ -26,124 +33,331 @@ def process_raster(inraster, niter, nfilt):
 
     return outraster
 
-def euc_distance(p1, p2):
-    return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
+def carve_profile(z, cells, eps):
+    # monotone profile along the ordered stream cells: cells between successive running minima
+    # are interpolated by the length of the path, the last cell is lowered below all others
+    # NoData cells are left as is and skipped by the profile
+    valid = numpy.isfinite(z)
+    if not valid.all():
+        z = z.copy()
+        z[valid], ncarved = carve_profile(z[valid], cells[valid], eps)
+        return z, ncarved
+
+    z = z.copy()
+    n = len(z)
+    if n < 2:
+        return z, 0
+
+    runmin = numpy.minimum.accumulate(z)
+
+    anchors = numpy.empty(n, dtype=bool)
+    anchors[0] = True
+    anchors[1:] = z[1:] < runmin[:-1]
+
+    forced = not anchors[-1]
+    if forced:
+        z[-1] = runmin[-2] - eps
+        anchors[-1] = True
+
+    idx = numpy.flatnonzero(anchors)
+    ncarved = int(numpy.count_nonzero(numpy.diff(idx) > 1)) + int(forced and idx[-2] == n - 2)
+
+    hills = numpy.flatnonzero(~anchors)
+    if len(hills) == 0:
+        return z, ncarved
+
+    # previous and next anchor of each hill cell
+    pos = numpy.searchsorted(idx, hills)
+    a = idx[pos - 1]
+    b = idx[pos]
+
+    cum = numpy.zeros(n)
+    cum[1:] = numpy.cumsum(numpy.hypot(*numpy.diff(cells, axis=0).T))
+
+    # the length is measured to the preceding cell
+    z[hills] = z[a] + (z[b] - z[a]) * (cum[hills - 1] - cum[a]) / (cum[b] - cum[a])
+
+    return z, ncarved
+
+
+def stream_network(features, shape):
+    # every stream flows into the stream which owns a cell at or next to its outlet.
+    # Streams which start in this cell are preferred, streams which end in it are tributaries
+    # of the same junction and are not taken as downstream.
+    # Returns junction cell of each stream (None for outlets)
+    # and groups of streams in upstream order, which share no cells with other groups
+    n = len(features)
+    owners = numpy.repeat(numpy.arange(n), [len(f) for f in features])
+    positions = numpy.concatenate([numpy.arange(len(f)) for f in features])
+    lasts = positions == numpy.repeat([len(f) - 1 for f in features], [len(f) for f in features])
+    cells = numpy.vstack(features)
+    keys = cells[:, 0] * shape[1] + cells[:, 1]
+
+    order = numpy.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    owners = owners[order]
+    positions = positions[order]
+    lasts = lasts[order]
+    cells = cells[order]
+
+    downstream = numpy.full(n, -1)
+    junctions = [None] * n
+    for k in range(n):
+        r, c = features[k][-1]
+        # outlet cell itself is checked first, then its neighbours
+        for dr, dc in [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]:
+            if not (0 <= r + dr < shape[0] and 0 <= c + dc < shape[1]):
+                continue
+            key = (r + dr) * shape[1] + c + dc
+            lo = numpy.searchsorted(keys, key)
+            hi = numpy.searchsorted(keys, key, side='right')
+            candidates = [p for p in range(lo, hi) if owners[p] != k and not lasts[p]]
+            if len(candidates) > 0:
+                p = min(candidates, key=lambda p: positions[p] > 0)
+                downstream[k] = owners[p]
+                junctions[k] = cells[p]
+                break
+
+    # streams are linked by junctions and by shared cells
+    same = numpy.flatnonzero(keys[1:] == keys[:-1])
+    i = numpy.concatenate((numpy.flatnonzero(downstream >= 0), owners[same]))
+    j = numpy.concatenate((downstream[downstream >= 0], owners[same + 1]))
+    graph = coo_matrix((numpy.ones(len(i)), (i, j)), shape=(n, n))
+    ngroups, labels = connected_components(graph, directed=False)
+
+    # upstream order: from outlets to sources, streams in loops go last
+    upstream = [[] for k in range(n)]
+    for k in range(n):
+        if downstream[k] >= 0:
+            upstream[downstream[k]].append(k)
+
+    visited = numpy.zeros(n, dtype=bool)
+    ordered = []
+    queue = [k for k in range(n) if downstream[k] < 0]
+    while queue:
+        k = queue.pop(0)
+        if not visited[k]:
+            visited[k] = True
+            ordered.append(k)
+            queue.extend(upstream[k])
+    ordered.extend(numpy.flatnonzero(~visited).tolist())
+
+    groups = [[] for g in range(ngroups)]
+    for k in ordered:
+        groups[labels[k]].append(k)
+
+    return junctions, groups
+
+def init_shared(raw, shape):
+    shared['dem'] = numpy.frombuffer(raw, dtype=numpy.float64).reshape(shape)
+
+# Just a crutch for pool.imap (Python 2.7)
+def call_carve(args):
+    return carve_streams(*args)
+
+def extend_to_junction(cells, junction):
+    # tributaries are carved down to the junction with the carved downstream line,
+    # returns profile cells and the number of its first cells to be written back
+    n = len(cells)
+    if junction is not None:
+        if (cells[-1] == junction).all():
+            n -= 1
+        else:
+            cells = numpy.vstack((cells, junction))
+    return cells, n
+
+def carve_streams(streams, eps):
+    # carve (cells, junction) streams of one group in the shared DEM
+    dem = shared['dem']
+    counts = []
+    for cells, junction in streams:
+        cells, n = extend_to_junction(cells, junction)
+
+        z, ncarved = carve_profile(dem[cells[:, 0], cells[:, 1]], cells, eps)
+        dem[cells[:n, 0], cells[:n, 1]] = z[:n]
+        counts.append(ncarved)
+
+    return counts
+
+def carve_network(npdem, features, eps, is_parallel=False, num_processes=0):
+    junctions, groups = stream_network(features, npdem.shape)
+    arcpy.AddMessage(str(len(features)) + ' streams form ' + str(len(groups)) + ' independent networks')
+
+    args = [([(features[k], junctions[k]) for k in group], eps) for group in groups]
+
+    raw = multiprocessing.RawArray('d', npdem.size)
+    dem = numpy.frombuffer(raw, dtype=numpy.float64).reshape(npdem.shape)
+    dem[:] = npdem
+
+    if is_parallel and len(groups) > 1:
+        nproc = Utils.get_nproc(num_processes)
+        arcpy.AddMessage('> Trying to make multiprocessing using ' + str(nproc) + ' processor cores')
+
+        pool = multiprocessing.Pool(nproc, init_shared, (raw, npdem.shape))
+        results = pool.map(call_carve, args)
+        pool.close()
+        pool.join()
+    else:
+        init_shared(raw, npdem.shape)
+        results = [call_carve(arg) for arg in args]
+
+    counts = numpy.zeros(len(features), dtype=int)
+    for group, result in zip(groups, results):
+        counts[group] = result
+
+    return dem.astype(npdem.dtype), counts
+
+def stream_cells(in_streams, in_field, xmin, ymax, cell_size, shape):
+    # cells of the streams ordered along the lines
+    xy, offsets, keys, _ = Utils.get_vertices(in_streams, in_field)
 
-def path_length(path):
-    L = 0
-    n = len(path)
-    (ic, jc) = path[0]
-    for k in range(1, n):
-        (i, j) = path[k]
-        L += euc_distance((i, j), (ic, jc))
-        ic = i
-        jc = j
-    return L
+    ids = []
+    features = []
+    for k in range(len(keys)):
+        rows, cols = Utils.line_cells(Utils.get_line(xy, offsets, k), xmin, ymax, cell_size, shape)
+        if len(rows) == 0:
+            continue
 
+        ids.append(keys[k])
+        features.append(numpy.column_stack((rows, cols)))
 
-def execute(in_raster, in_streams, in_field, out_raster):
+    return ids, features
 
-    EPS = 1
+def block_slices(keys, shape, block_size):
+    # blocks containing the cells with sorted keys: (r0, r1, c0, c1) and positions of their cells
+    rows = keys // shape[1]
+    cols = keys % shape[1]
+    nbcols = int(math.ceil(float(shape[1]) / block_size))
+    bkeys = (rows // block_size) * nbcols + cols // block_size
 
-    inraster = arcpy.sa.Raster(in_raster)
-    arcpy.env.extent = inraster.extent  # Very important!
-    arcpy.env.snapRaster = inraster  # Very important!
-    cell_size = float(arcpy.GetRasterProperties_management(in_raster, "CELLSIZEX").getOutput(0).replace(',', '.'))
-    ncols = int(arcpy.GetRasterProperties_management(in_raster, "COLUMNCOUNT").getOutput(0))
-    nrows = int(arcpy.GetRasterProperties_management(in_raster, "ROWCOUNT").getOutput(0))
+    order = numpy.argsort(bkeys, kind='mergesort')
+    bounds = numpy.flatnonzero(numpy.diff(bkeys[order])) + 1
 
-    lowerleft = arcpy.Point(inraster.extent.XMin, inraster.extent.YMin)
-    crs = inraster.spatialReference
+    blocks = []
+    for sel in numpy.split(order, bounds):
+        bi, bj = divmod(int(bkeys[sel[0]]), nbcols)
+        r0 = bi * block_size
+        c0 = bj * block_size
+        blocks.append(((r0, min(r0 + block_size, shape[0]), c0, min(c0 + block_size, shape[1])), sel))
 
-    stream = 'in_memory/stream'
-    spnt = 'in_memory/spnt'
+    return blocks, rows, cols
 
-    features = []
-    ids = []
-    strlyr = 'strlyr'
-    arcpy.MakeFeatureLayer_management(in_streams, strlyr)
+def execute_windowed(in_raster, in_streams, in_field, out_raster, is_network=False, block_size=1024):
 
-    npdem = arcpy.RasterToNumPyArray(in_raster, ncols = ncols, nrows = nrows)
+    EPS = 1
 
-    arcpy.AddMessage('RASTERIZING STREAMS' + str(datetime.now()))
+    desc = arcpy.Describe(in_raster)
+    cell_size = desc.meanCellWidth
+    xmin = desc.extent.XMin
+    ymax = desc.extent.YMax
+    shape = (desc.height, desc.width)
 
-    with arcpy.da.SearchCursor(in_streams, in_field) as rows:
-        for row in rows:
-            id = row[0]
-            ids.append(id)
-            arcpy.AddMessage('ID = ' + str(id))
-            arcpy.SelectLayerByAttribute_management(strlyr, 'NEW_SELECTION', in_field + ' = ' + str(id))
-            arcpy.FeatureVerticesToPoints_management(strlyr, spnt, 'START')
+    arcpy.AddMessage('RASTERIZING STREAMS' + str(datetime.now()))
+    ids, features = stream_cells(in_streams, in_field, xmin, ymax, cell_size, shape)
+
+    keys = numpy.unique(numpy.concatenate([f[:, 0] * shape[1] + f[:, 1] for f in features]))
+    blocks, rows, cols = block_slices(keys, shape, block_size)
+    arcpy.AddMessage(str(len(keys)) + ' stream cells lie in ' + str(len(blocks)) + ' blocks of ' +
+                     str(block_size) + ' x ' + str(block_size) + ' cells')
+
+    arcpy.AddMessage('READING BLOCKS' + str(datetime.now()))
+    # blocks are cached to be written back after carving
+    cache = []
+    zvals = numpy.empty(len(keys))
+    for (r0, r1, c0, c1), sel in blocks:
+        block = Utils.read_raster(in_raster, arcpy.Point(xmin + c0 * cell_size, ymax - r1 * cell_size), c1 - c0, r1 - r0)
+        zvals[sel] = block[rows[sel] - r0, cols[sel] - c0]
+        cache.append(block)
+
+    def positions(cells):
+        return numpy.searchsorted(keys, cells[:, 0] * shape[1] + cells[:, 1])
+
+    for k in range(len(features)):
+        idx = positions(features[k])
+        if zvals[idx[0]] < zvals[idx[-1]]:
+            features[k] = numpy.flipud(features[k])
 
-            arcpy.PolylineToRaster_conversion(strlyr, in_field, stream, cellsize = cell_size)
-            str_mask = Power(stream, 0)
+    arcpy.AddMessage('CARVING' + str(datetime.now()))
 
-            cost = CostDistance(spnt, str_mask)
-            npcost = arcpy.RasterToNumPyArray(cost, nodata_to_value = -1)
+    if is_network:
+        junctions, groups = stream_network(features, shape)
+        order = [k for group in groups for k in group]
+    else:
+        junctions = [None] * len(features)
+        order = range(len(features))
 
-            cells = numpy.argwhere(npcost >= 0)
-            values = npcost[npcost >= 0]
+    for k in order:
+        cells, n = extend_to_junction(features[k], junctions[k])
+        idx = positions(cells)
 
-            idx = numpy.argsort(values)
+        z, ncarved = carve_profile(zvals[idx], cells, EPS)
+        zvals[idx[:n]] = z[:n]
 
-            feature = cells[idx, :]
+        arcpy.AddMessage('ID = ' + str(ids[k]) + ': carved ' + str(ncarved) + ' sections')
 
-            if npdem[feature[0][0], feature[0][1]] < npdem[feature[-1][0], feature[-1][1]]:
-                feature = numpy.flipud(feature)
+    arcpy.AddMessage('WRITING BLOCKS' + str(datetime.now()))
+    # blocks without streams are copied as is
+    scratchworkspace = SW.CreateScratchWorkspace(os.path.dirname(out_raster))
 
+    names = []
+    for ((r0, r1, c0, c1), sel), block in zip(blocks, cache):
+        block[rows[sel] - r0, cols[sel] - c0] = zvals[sel]
+        names.append(Utils.write_block(block, in_raster, r0, c0,
+                                       scratchworkspace + '/block' + str(len(names)) + '.tif'))
 
-            features.append(feature)
+    Utils.mosaic_blocks(in_raster, names, out_raster)
 
-    arcpy.AddMessage('CARVING' + str(datetime.now()))
+    arcpy.AddMessage('END' + str(datetime.now()))
 
-    finished = False
+    return
 
-    ifeat = 0
+def execute(in_raster, in_streams, in_field, out_raster, is_network=False, is_parallel=False, num_processes=0,
+            is_windowed=False):
 
-    while not finished:
-        for feature in features:
-            ni = len(feature)
-            cell = feature[0]
-            zprev = npdem[cell[0], cell[1]]
-            ishill = False
+    if is_windowed:
+        if is_parallel:
+            arcpy.AddWarning('Parallel processing is not used when only blocks with streams are read')
+        return execute_windowed(in_raster, in_streams, in_field, out_raster, is_network)
 
-            carved = [cell]
+    EPS = 1
 
-            ncarved = 0
+    inraster = arcpy.sa.Raster(in_raster)
+    arcpy.env.extent = inraster.extent  # Very important!
+    arcpy.env.snapRaster = inraster  # Very important!
+    cell_size = float(arcpy.GetRasterProperties_management(in_raster, "CELLSIZEX").getOutput(0).replace(',', '.'))
+    ncols = int(arcpy.GetRasterProperties_management(in_raster, "COLUMNCOUNT").getOutput(0))
+    nrows = int(arcpy.GetRasterProperties_management(in_raster, "ROWCOUNT").getOutput(0))
 
-            for i in range(1, ni):
-                cell = feature[i]
-                z = npdem[cell[0], cell[1]]
+    lowerleft = arcpy.Point(inraster.extent.XMin, inraster.extent.YMin)
+    crs = inraster.spatialReference
 
-                if z >= zprev:
-                    ishill = True
+    npdem = arcpy.RasterToNumPyArray(in_raster, ncols = ncols, nrows = nrows)
 
-                    if i == ni - 1:
-                        z = zprev - EPS
-                        npdem[cell[0], cell[1]] = z
-                    else:
-                        carved.append(cell)
+    arcpy.AddMessage('RASTERIZING STREAMS' + str(datetime.now()))
 
-                if z < zprev:
-                    if ishill:
-                        ncarved += 1
+    ids, features = stream_cells(in_streams, in_field, inraster.extent.XMin, inraster.extent.YMax,
+                                 cell_size, npdem.shape)
 
-                        ishill = False
-                        carved.append(cell)
-                        carlength = path_length(carved)
+    for k in range(len(features)):
+        feature = features[k]
+        if npdem[feature[0][0], feature[0][1]] < npdem[feature[-1][0], feature[-1][1]]:
+            features[k] = numpy.flipud(feature)
 
-                        ncar = len(carved)
-                        dz = z - zprev
+    arcpy.AddMessage('CARVING' + str(datetime.now()))
 
-                        for j in range(1, ncar-1):
-                            npdem[carved[j][0], carved[j][1]] = zprev + dz * path_length(carved[0:j]) / carlength
+    if is_network:
+        npdem, counts = carve_network(npdem, features, EPS, is_parallel, num_processes)
+        for k in range(len(features)):
+            arcpy.AddMessage('ID = ' + str(ids[k]) + ': carved ' + str(counts[k]) + ' sections')
+    else:
+        for k in range(len(features)):
+            rows = features[k][:, 0]
+            cols = features[k][:, 1]
 
-                    carved = [cell]
-                    zprev = z
+            z, ncarved = carve_profile(npdem[rows, cols], features[k], EPS)
+            npdem[rows, cols] = z
 
-            arcpy.AddMessage('ID = ' + str(ids[ifeat]) + ': carved ' + str(ncarved) + ' sections')
-            ifeat += 1
-        finished = True
+            arcpy.AddMessage('ID = ' + str(ids[k]) + ': carved ' + str(ncarved) + ' sections')
 
     outraster = arcpy.NumPyArrayToRaster(npdem, lowerleft, cell_size)
     arcpy.DefineProjection_management(outraster, crs)
@@ -160,8 +374,12 @@ if __name__ == "__main__":
         in_streams = arcpy.GetParameterAsText(1)
         in_field = arcpy.GetParameterAsText(2)
         out_raster = arcpy.GetParameterAsText(3)
+        is_network = arcpy.GetParameterAsText(4) == 'true'
+        is_parallel = arcpy.GetParameterAsText(5) == 'true'
+        num_processes = float(arcpy.GetParameterAsText(6)) if arcpy.GetParameterAsText(6) else 0
+        is_windowed = arcpy.GetParameterAsText(7) == 'true'
 
-        execute(in_raster, in_streams, in_field, out_raster)
+        execute(in_raster, in_streams, in_field, out_raster, is_network, is_parallel, num_processes, is_windowed)
     except:
         tb = sys.exc_info()[2]
         tbinfo = traceback.format_tb(tb)[0]
@@ -0,0 +1,264 @@
+# -*- coding: cp1251 -*-
+# Automated DEM conflation with reference hydrographic lines in one run:
+# counterpart streams, conflation links and rubbersheeting are passed between stages in memory
+# 2020, Timofey Samsonov, Lomonosov Moscow State University
+import os
+import arcpy
+import math
+import sys
+import traceback
+import numpy
+import Utils
+import ScratchWorkspace as SW
+import CounterpartStreams as CS
+import ConflationLinks as CL
+import ConflateDEMbyLinks as CB
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from datetime import datetime
+
+__author__ = 'Timofey Samsonov'
+
+BLOCK_SIZE = 1024
+
+def drainage_groups(lines, tolerance):
+    # lines which touch each other by their endpoints within tolerance are conflated together
+    n = len(lines)
+    if n == 0:
+        return []
+    owner = numpy.repeat(numpy.arange(n), [len(line) for line in lines])
+    ends = numpy.vstack([line[[0, -1]] for line in lines])
+
+    hits = cKDTree(numpy.vstack(lines)).query_ball_point(ends, tolerance)
+    i = numpy.repeat(numpy.repeat(numpy.arange(n), 2), [len(h) for h in hits])
+    j = owner[numpy.concatenate(hits).astype(int)]
+
+    graph = coo_matrix((numpy.ones(len(i)), (i, j)), shape=(n, n))
+    ngroups, labels = connected_components(graph, directed=False)
+
+    return [numpy.nonzero(labels == g)[0] for g in range(ngroups)]
+
+def group_window(lines, shape, xmin, ymax, cellsize, margin):
+    # rows and columns of DEM cells covering the lines extended by margin
+    xy = numpy.vstack(lines)
+    r0 = max(int(math.floor((ymax - xy[:, 1].max() - margin) / cellsize)), 0)
+    r1 = min(int(math.ceil((ymax - xy[:, 1].min() + margin) / cellsize)), shape[0])
+    c0 = max(int(math.floor((xy[:, 0].min() - margin - xmin) / cellsize)), 0)
+    c1 = min(int(math.ceil((xy[:, 0].max() + margin - xmin) / cellsize)), shape[1])
+    return r0, r1, c0, c1
+
+def feather_weights(window, shape, overlap, part=None):
+    # weights grow linearly from the window edges and reach 1 at overlap cells inside,
+    # edges lying on the DEM boundary are not feathered. Part of the window can be requested
+    r0, r1, c0, c1 = window
+    i0, i1, j0, j1 = part if part is not None else window
+    r = numpy.arange(i0 - r0, i1 - r0, dtype=float)
+    c = numpy.arange(j0 - c0, j1 - c0, dtype=float)
+
+    dr = numpy.minimum(r + 1 if r0 > 0 else numpy.inf, r1 - r0 - r if r1 < shape[0] else numpy.inf)
+    dc = numpy.minimum(c + 1 if c0 > 0 else numpy.inf, c1 - c0 - c if c1 < shape[1] else numpy.inf)
+
+    return numpy.minimum(numpy.minimum.outer(dr, dc) / max(overlap, 1), 1)
+
+def blend_block(in_raster, block, windows, results, overlap):
+    # DEM block with the feathered elevation changes of the overlapping conflated windows
+    desc = arcpy.Describe(in_raster)
+    cellsize = desc.meanCellWidth
+    xmin = desc.extent.XMin
+    ymax = desc.extent.YMax
+    shape = (desc.height, desc.width)
+
+    r0, r1, c0, c1 = block
+    dem = Utils.read_raster(in_raster, arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize), c1 - c0, r1 - r0)
+    num = numpy.zeros(dem.shape)
+    den = numpy.zeros(dem.shape)
+    for window, result in zip(windows, results):
+        i0, i1 = max(window[0], r0), min(window[1], r1)
+        j0, j1 = max(window[2], c0), min(window[3], c1)
+        part = Utils.read_raster(result, arcpy.Point(xmin + j0 * cellsize, ymax - i1 * cellsize), j1 - j0, i1 - i0)
+        delta = part - dem[i0 - r0:i1 - r0, j0 - c0:j1 - c0]
+        changed = numpy.isfinite(delta) & (delta != 0)
+        w = feather_weights(window, shape, overlap, (i0, i1, j0, j1)) * changed
+        num[i0 - r0:i1 - r0, j0 - c0:j1 - c0] += w * numpy.where(changed, delta, 0)
+        den[i0 - r0:i1 - r0, j0 - c0:j1 - c0] += w
+
+    return dem + num / numpy.maximum(den, 1)
+
+# Just a crutch for pool.imap (Python 2.7)
+def call_window(args):
+    k, in_raster, in_streams, in_field, oids, in_acc, extent, params, scratchworkspace, outputs, method = args
+    try:
+        arcpy.env.overwriteOutput = True
+        arcpy.env.snapRaster = in_raster
+        arcpy.env.extent = arcpy.Extent(*extent)
+
+        arcpy.AddMessage('> CONFLATING GROUP ' + str(k + 1) + ': ' + str(len(oids)) + ' lines')
+
+        dem = scratchworkspace + '/dem' + str(k) + '.tif'
+        acc = scratchworkspace + '/acc' + str(k) + '.tif'
+        arcpy.CopyRaster_management(in_raster, dem)
+        arcpy.CopyRaster_management(in_acc, acc)
+
+        # only the lines of the group are searched for counterparts, even if other groups share their IDs
+        streams = 'streams' + str(k)
+        oidfield = arcpy.AddFieldDelimiters(in_streams, arcpy.Describe(in_streams).OIDFieldName)
+        arcpy.MakeFeatureLayer_management(in_streams, streams,
+                                          oidfield + ' IN (' + ', '.join(str(oid) for oid in oids) + ')')
+
+        out_raster = scratchworkspace + '/conf' + str(k) + '.tif'
+        intermediate = [scratchworkspace + '/' + name + str(k) + '.shp' if name else None for name in outputs]
+
+        execute(dem, streams, in_field, acc, out_raster, *(params + tuple(intermediate)), method=method)
+
+        return out_raster
+    except:
+        arcpy.AddMessage('\n> FAILED to conflate group ' + str(k + 1) + '\n' + traceback.format_exc())
+        return None
+
+def execute_tiled(in_raster, in_streams, in_field, in_acc, out_raster, minacc, penalty, radius, deviation, limit,
+                  distance, out_counterparts=None, out_links=None, out_area=None, is_parallel=False, num_processes=0,
+                  method='RASTER'):
+
+    desc = arcpy.Describe(in_raster)
+    cellsize = desc.meanCellWidth
+    xmin = desc.extent.XMin
+    ymax = desc.extent.YMax
+
+    arcpy.AddMessage('DRAINAGE GROUPS...' + str(datetime.now()))
+    xy, offsets, keys, oids = Utils.get_vertices(in_streams, in_field)
+    lines = [Utils.get_line(xy, offsets, k) for k in range(len(oids))]
+    groups = drainage_groups(lines, cellsize)
+
+    shape = (desc.height, desc.width)
+
+    # windows cover the search radius and conflation distance, plus the overlap used for feathering
+    overlap = int(math.ceil(distance / cellsize))
+    margin = radius + distance + overlap * cellsize
+    windows = [group_window([lines[i] for i in group], shape, xmin, ymax, cellsize, margin) for group in groups]
+
+    # largest windows first to balance the pool
+    order = sorted(range(len(groups)), key=lambda g: -(windows[g][1] - windows[g][0]) * (windows[g][3] - windows[g][2]))
+    arcpy.AddMessage(str(len(keys)) + ' lines are split into ' + str(len(groups)) + ' drainage groups')
+
+    scratchworkspace = SW.CreateScratchWorkspace(os.path.dirname(out_raster))
+    params = (minacc, penalty, radius, deviation, limit, distance)
+    outputs = [name if out else None for name, out in zip(['counterparts', 'links', 'area'],
+                                                          [out_counterparts, out_links, out_area])]
+
+    args = []
+    for g in order:
+        r0, r1, c0, c1 = windows[g]
+        extent = (xmin + c0 * cellsize, ymax - r1 * cellsize, xmin + c1 * cellsize, ymax - r0 * cellsize)
+        args.append((g, in_raster, in_streams, in_field, sorted(int(oids[i]) for i in groups[g]), in_acc, extent,
+                     params, scratchworkspace, outputs, method))
+
+    results = list(Utils.imap_parallel(call_window, args, is_parallel, num_processes, chunksize=1))
+    done = [(windows[order[k]], result) for k, result in enumerate(results) if result is not None]
+
+    arcpy.AddMessage('BLENDING...' + str(datetime.now()))
+    # conflated windows are blended as feathered elevation changes block by block,
+    # blocks which are not covered by windows are copied from the source DEM
+    blocks = []
+    for r0 in range(0, shape[0], BLOCK_SIZE):
+        for c0 in range(0, shape[1], BLOCK_SIZE):
+            r1 = min(r0 + BLOCK_SIZE, shape[0])
+            c1 = min(c0 + BLOCK_SIZE, shape[1])
+            covering = [(w, result) for w, result in done if w[0] < r1 and w[1] > r0 and w[2] < c1 and w[3] > c0]
+            if len(covering) == 0:
+                continue
+            block = blend_block(in_raster, (r0, r1, c0, c1), [w for w, _ in covering], [r for _, r in covering],
+                                overlap)
+            blocks.append(Utils.write_block(block, in_raster, r0, c0,
+                                            scratchworkspace + '/blend' + str(len(blocks)) + '.tif'))
+
+    Utils.mosaic_blocks(in_raster, blocks, out_raster)
+
+    # intermediate datasets of the groups are merged
+    for name, out in zip(outputs, [out_counterparts, out_links, out_area]):
+        if name:
+            datasets = [scratchworkspace + '/' + name + str(g) + '.shp' for g in range(len(groups))]
+            arcpy.Merge_management([d for d in datasets if arcpy.Exists(d)], out)
+
+    arcpy.AddMessage('END...' + str(datetime.now()))
+
+    return
+
+def execute(in_raster, in_streams, in_field, in_acc, out_raster, minacc, penalty, radius, deviation, limit, distance,
+            out_counterparts=None, out_links=None, out_area=None, is_parallel=False, num_processes=0,
+            method='RASTER', is_tiled=False):
+
+    if is_tiled:
+        return execute_tiled(in_raster, in_streams, in_field, in_acc, out_raster, minacc, penalty, radius, deviation,
+                             limit, distance, out_counterparts, out_links, out_area, is_parallel, num_processes, method)
+
+    desc = arcpy.Describe(in_raster)
+    cellsize = desc.meanCellWidth
+    crs = desc.spatialReference
+
+    arcpy.AddMessage('COUNTERPART STREAMS...' + str(datetime.now()))
+    ids, count_lines, hydro_lines, types = CS.execute(in_streams, in_field, in_acc, in_raster, out_counterparts,
+                                                      minacc, penalty, radius, deviation, limit)
+
+    # streams without counterparts cannot be linked
+    linked = [k for k in range(len(ids)) if len(count_lines[k]) > 1 and len(hydro_lines[k]) > 1]
+    if len(linked) < len(ids):
+        arcpy.AddMessage(str(len(ids) - len(linked)) + ' streams have no counterparts')
+    ids = [ids[k] for k in linked]
+    count_lines = [count_lines[k] for k in linked]
+    hydro_lines = [hydro_lines[k] for k in linked]
+
+    arcpy.AddMessage('CONFLATION LINKS...' + str(datetime.now()))
+    links = list(Utils.imap_parallel(CL.link_pair, zip(count_lines, hydro_lines), is_parallel, num_processes))
+
+    # intermediate datasets are written only if requested
+    if out_links or out_area or method == 'TIN':
+        links_fc = out_links if out_links else 'in_memory/links'
+        CL.write_links(links_fc, crs, ids, links)
+
+    if out_area:
+        hydro_fc = Utils.write_lines('in_memory/hydro', hydro_lines, crs, 'ID', ids)
+        count_fc = Utils.write_lines('in_memory/counterparts', count_lines, crs, 'ID', ids)
+        CL.conflation_area(hydro_fc, count_fc, links_fc, out_area)
+
+    arcpy.AddMessage('CONFLATION...' + str(datetime.now()))
+    # CounterpartStreams uses the DEM only in map algebra for the cost surfaces of Spatial Analyst,
+    # so the elevations are read into an array here once. Conflation area is rasterized in memory
+    dem = Utils.read_raster(in_raster)
+    links = numpy.vstack([l for pair in links for l in pair] + [numpy.empty((0, 4))])
+    mask = CB.area_mask(hydro_lines + count_lines, links, dem.shape,
+                        desc.extent.XMin, desc.extent.YMax, cellsize, distance)
+
+    if method == 'TIN':
+        out = CB.conflate_tin(dem, mask, links_fc, in_raster, SW.CreateScratchWorkspace(os.path.dirname(out_raster)))
+    else:
+        arcpy.AddMessage('Rubbersheeting ' + str(mask.sum()) + ' cells...' + str(datetime.now()))
+        out = CB.rubbersheet_array(dem, mask, links, desc.extent.XMin, desc.extent.YMax, cellsize)
+
+    Utils.write_raster(out, arcpy.Point(desc.extent.XMin, desc.extent.YMin), cellsize, crs, out_raster)
+
+    arcpy.AddMessage('END...' + str(datetime.now()))
+
+    return
+
+if __name__ == "__main__":
+    try:
+        in_raster = arcpy.GetParameterAsText(0)
+        in_streams = arcpy.GetParameterAsText(1)
+        in_field = arcpy.GetParameterAsText(2)
+        in_acc = arcpy.GetParameterAsText(3)
+        out_raster = arcpy.GetParameterAsText(4)
+        minacc = float(arcpy.GetParameterAsText(5))
+        penalty = int(arcpy.GetParameterAsText(6))
+        radius = float(arcpy.GetParameterAsText(7))
+        deviation = float(arcpy.GetParameterAsText(8))
+        limit = arcpy.GetParameterAsText(9)
+        distance = float(arcpy.GetParameterAsText(10))
+
+        execute(in_raster, in_streams, in_field, in_acc, out_raster, minacc, penalty, radius, deviation, limit, distance)
+    except:
+        tb = sys.exc_info()[2]
+        tbinfo = traceback.format_tb(tb)[0]
+        pymsg = "Traceback Info:\n" + tbinfo + "\nError Info:\n    " + \
+                str(sys.exc_type)+ ": " + str(sys.exc_value) + "\n"
+        arcpy.AddError(pymsg)
@@ -5,66 +5,218 @@ import os
 import arcpy
 import sys
 import traceback
+import numpy
 from arcpy.sa import *
+from scipy import ndimage
+from scipy.interpolate import LinearNDInterpolator
+from scipy.spatial import cKDTree
 import ScratchWorkspace as SW
+import Utils
 from datetime import datetime
 
 __author__ = 'Timofey Samsonov'
 
-def execute(in_raster, in_links, in_area, distance, out_raster):
+def cell_centers(rows, cols, xmin, ymax, cellsize):
+    return numpy.column_stack((xmin + (cols + 0.5) * cellsize, ymax - (rows + 0.5) * cellsize))
+
+def buffer_mask(mask, distance, cellsize):
+    return ndimage.distance_transform_edt(numpy.logical_not(mask)) * cellsize <= distance
+
+def area_mask(lines, links, shape, xmin, ymax, cellsize, distance):
+    # conflation area enclosed by hydrolines, counterparts and links, buffered by distance
+    mask = numpy.zeros(shape, dtype=bool)
+    for xy in list(lines) + list(links.reshape(-1, 2, 2)):
+        if len(xy) > 0:
+            rows, cols = Utils.line_cells(xy, xmin, ymax, cellsize, shape)
+            mask[rows, cols] = True
+
+    return buffer_mask(ndimage.binary_fill_holes(mask), distance, cellsize)
+
+def displacement_field(links, fixed, points):
+    # displacement from target back to source, linearly interpolated at points
+    # between link targets and fixed points that do not move
+    src = numpy.vstack((links[:, 0:2], fixed))
+    dst = numpy.vstack((links[:, 2:4], fixed))
+
+    # several links can share a target: average their displacements
+    dst_keys, inverse = numpy.unique(dst[:, 0] + 1j * dst[:, 1], return_inverse=True)
+    counts = numpy.bincount(inverse).astype(float)
+    u = numpy.column_stack((numpy.bincount(inverse, src[:, 0] - dst[:, 0]) / counts,
+                            numpy.bincount(inverse, src[:, 1] - dst[:, 1]) / counts))
+
+    interpolator = LinearNDInterpolator(numpy.column_stack((dst_keys.real, dst_keys.imag)), u, fill_value=0)
+    return interpolator(points)
+
+def sample(dem, x, y, xmin, ymax, cellsize):
+    # bilinear resampling, nearest cell next to NoData
+    coords = [(ymax - y) / cellsize - 0.5, (x - xmin) / cellsize - 0.5]
+    z = ndimage.map_coordinates(dem, coords, order=1, mode='nearest')
+    nodata = numpy.isnan(z)
+    if nodata.any():
+        z[nodata] = ndimage.map_coordinates(dem, [c[nodata] for c in coords], order=0, mode='nearest')
+    return z
+
+def is_triangulable(points):
+    # at least 3 distinct points which do not lie on one line
+    keys = numpy.unique(points[:, 0] + 1j * points[:, 1])
+    points = numpy.column_stack((keys.real, keys.imag))
+    return len(points) >= 3 and numpy.linalg.matrix_rank(points - points.mean(axis=0)) == 2
+
+def rubbersheet_array(dem, mask, links, xmin, ymax, cellsize):
+    # inverse warp of the cells inside mask, other cells are copied untouched
+    out = dem.copy()
+
+    rows, cols = numpy.nonzero(mask)
+    if len(rows) == 0:
+        arcpy.AddMessage("Conflation area has no cells, DEM is not changed")
+        return out
+    points = cell_centers(rows, cols, xmin, ymax, cellsize)
+
+    erows, ecols = numpy.nonzero(mask & numpy.logical_not(ndimage.binary_erosion(mask)))
+    fixed = cell_centers(erows, ecols, xmin, ymax, cellsize)
+
+    # fixed points next to link targets would conflict with their displacements
+    if len(links) > 0 and len(fixed) > 0:
+        fixed = fixed[cKDTree(links[:, 2:4]).query(fixed)[0] > cellsize]
+
+    # displacements are interpolated in triangles of link targets and fixed points
+    if not is_triangulable(numpy.vstack((links[:, 2:4], fixed))):
+        arcpy.AddMessage("Less than 3 control points which are not collinear, DEM is not changed")
+        return out
+
+    u = displacement_field(links, fixed, points)
+    z = sample(dem, points[:, 0] + u[:, 0], points[:, 1] + u[:, 1], xmin, ymax, cellsize)
+
+    # NoData cells stay NoData
+    out[rows, cols] = numpy.where(numpy.isnan(dem[rows, cols]), numpy.nan, z)
+
+    return out
+
+def get_links(in_links):
+    xy, offsets, _, _ = Utils.get_vertices(in_links)
+    return numpy.hstack((xy[offsets[:-1]], xy[offsets[:-1] + 1]))
+
+def read_area_mask(in_area, in_raster, shape, distance):
+    # conflation area polygons rasterized on the DEM grid and buffered by distance
     desc = arcpy.Describe(in_raster)
-    cellsize = arcpy.GetRasterProperties_management(in_raster, "CELLSIZEX").getOutput(0)
-    crs = desc.spatialReference
-    workspace = os.path.dirname(out_raster)
+    lowerleft = arcpy.Point(desc.extent.XMin, desc.extent.YMin)
 
-    scratchworkspace = SW.CreateScratchWorkspace(workspace)
+    arcpy.env.extent = desc.extent
+    arcpy.env.snapRaster = in_raster
+    area = 'in_memory/area'
+    arcpy.PolygonToRaster_conversion(in_area, arcpy.Describe(in_area).OIDFieldName, area, cellsize=desc.meanCellWidth)
+    mask = arcpy.RasterToNumPyArray(area, lowerleft, shape[1], shape[0], nodata_to_value=-1) >= 0
+    arcpy.Delete_management(area)
 
-    arcpy.AddMessage("Converting raster to points..." + str(datetime.now()))
-    dempts = 'in_memory/dempts'
-    arcpy.RasterToPoint_conversion(in_raster, dempts)
+    return buffer_mask(mask, distance, desc.meanCellWidth)
 
-    arcpy.AddMessage("Preparing points and links..." + str(datetime.now()))
-    buf = 'in_memory/buf'
-    arcpy.Buffer_analysis(in_area, buf, distance, dissolve_option='ALL')
-    arcpy.Densify_edit(buf, 'DISTANCE', cellsize)
+def cells_to_points(dem, rows, cols, xmin, ymax, cellsize, out_points, crs):
+    points = numpy.empty(len(rows), dtype=[('SHAPE', '<f8', 2), ('grid_code', '<f8')])
+    points['SHAPE'] = cell_centers(rows, cols, xmin, ymax, cellsize)
+    points['grid_code'] = dem[rows, cols]
+    arcpy.da.NumPyArrayToFeatureClass(points, out_points, ['SHAPE'], crs)
+    return out_points
 
-    identity_links = 'in_memory/idlinks'
-    arcpy.FeatureVerticesToPoints_management(buf, identity_links)
+def execute_raster(in_raster, in_links, in_area, distance, out_raster):
+    desc = arcpy.Describe(in_raster)
+    cellsize = desc.meanCellWidth
+    lowerleft = arcpy.Point(desc.extent.XMin, desc.extent.YMin)
 
-    ptslyr = 'ptslyr'
-    arcpy.MakeFeatureLayer_management(dempts, ptslyr)
-    arcpy.SelectLayerByLocation_management(ptslyr, 'INTERSECT', buf)
+    arcpy.AddMessage("Reading DEM and links..." + str(datetime.now()))
+    dem = Utils.read_raster(in_raster)
+    links = get_links(in_links)
 
-    confpts = 'in_memory/confpts'
-    arcpy.CopyFeatures_management(ptslyr, confpts)
+    arcpy.AddMessage("Rasterizing conflation area..." + str(datetime.now()))
+    mask = read_area_mask(in_area, in_raster, dem.shape, distance)
 
-    # arcpy.CopyFeatures_management(ptslyr, 'X:/DEMGEN/Test.gdb/confpts')
+    arcpy.AddMessage("Rubbersheeting " + str(mask.sum()) + " cells..." + str(datetime.now()))
+    out = rubbersheet_array(dem, mask, links, desc.extent.XMin, desc.extent.YMax, cellsize)
 
-    arcpy.AddMessage("Rubbersheeting..." + str(datetime.now()))
-    arcpy.RubbersheetFeatures_edit(confpts, in_links, identity_links, 'NATURAL_NEIGHBOR')
+    arcpy.AddMessage("Writing output raster..." + str(datetime.now()))
+    Utils.write_raster(out, lowerleft, cellsize, desc.spatialReference, out_raster)
 
-    # arcpy.CopyFeatures_management(confpts, 'X:/DEMGEN/Test.gdb/confpts_confl')
+    arcpy.AddMessage("END..." + str(datetime.now()))
 
-    arcpy.AddMessage("Triangulation..."+ str(datetime.now()))
-    arcpy.SelectLayerByAttribute_management(ptslyr, 'SWITCH_SELECTION')
+def conflate_tin(dem, mask, in_links, in_raster, scratchworkspace):
+    # cells inside mask are rubbersheeted as points by links and retriangulated,
+    # only the buffer is retriangulated, the ring of cells around it ties the TIN to the DEM
+    desc = arcpy.Describe(in_raster)
+    cellsize = desc.meanCellWidth
+    crs = desc.spatialReference
+    xmin = desc.extent.XMin
+    ymax = desc.extent.YMax
+
+    ring = ndimage.binary_dilation(mask) & numpy.logical_not(mask) & numpy.isfinite(dem)
+
+    # area outside the raster or on NoData only leaves the DEM unchanged
+    if not (mask & numpy.isfinite(dem)).any() or not ring.any():
+        arcpy.AddMessage("Conflation area has no cells with heights, DEM is not changed")
+        return dem.copy()
+
+    arcpy.AddMessage("Preparing points and links..." + str(datetime.now()))
+    # boundary cells of the area stay in place
+    erows, ecols = numpy.nonzero(mask & numpy.logical_not(ndimage.binary_erosion(mask)))
+    identity_links = cells_to_points(dem, erows, ecols, xmin, ymax, cellsize, 'in_memory/idlinks', crs)
+
+    mask = mask & numpy.isfinite(dem)
+    rows, cols = numpy.nonzero(mask)
+    confpts = cells_to_points(dem, rows, cols, xmin, ymax, cellsize, 'in_memory/confpts', crs)
 
+    rrows, rcols = numpy.nonzero(ring)
+    ringpts = cells_to_points(dem, rrows, rcols, xmin, ymax, cellsize, 'in_memory/ringpts', crs)
+
+    arcpy.AddMessage("Rubbersheeting " + str(len(rows)) + " points..." + str(datetime.now()))
+    arcpy.RubbersheetFeatures_edit(confpts, in_links, identity_links, 'NATURAL_NEIGHBOR')
+
+    arcpy.AddMessage("Triangulation..."+ str(datetime.now()))
     features = []
     features.append("'" + confpts + "' grid_code " + "masspoints")
-    features.append("'" + ptslyr + "' grid_code " + "masspoints")
+    features.append("'" + ringpts + "' grid_code " + "masspoints")
     featurestring = ';'.join(features)
 
     tin = scratchworkspace + '/tin'
     arcpy.CreateTin_3d(tin, crs, featurestring)
 
     arcpy.AddMessage("Converting to output raster..." + str(datetime.now()))
-    arcpy.env.extent = desc.extent  # Very important!
+    # window of DEM cells covered by the ring
+    r0, r1 = rrows.min(), rrows.max() + 1
+    c0, c1 = rcols.min(), rcols.max() + 1
+    lowerleft = arcpy.Point(xmin + c0 * cellsize, ymax - r1 * cellsize)
+
+    arcpy.env.extent = arcpy.Extent(lowerleft.X, lowerleft.Y, xmin + c1 * cellsize, ymax - r0 * cellsize)
     arcpy.env.snapRaster = in_raster
 
+    tinraster = 'in_memory/tinraster'
     try:
-        arcpy.TinRaster_3d(tin, out_raster, "FLOAT", "NATURAL_NEIGHBORS", "CELLSIZE " + str(cellsize), 1)
+        arcpy.TinRaster_3d(tin, tinraster, "FLOAT", "NATURAL_NEIGHBORS", "CELLSIZE " + str(cellsize), 1)
     except:
         arcpy.AddMessage("Failed to rasterize TIN using NATURAL_NEIGHBORS method. Switching to linear")
-        arcpy.TinRaster_3d(tin, out_raster, "FLOAT", "LINEAR", "CELLSIZE " + str(cellsize), 1)
+        arcpy.TinRaster_3d(tin, tinraster, "FLOAT", "LINEAR", "CELLSIZE " + str(cellsize), 1)
+
+    window = Utils.read_raster(tinraster, lowerleft, c1 - c0, r1 - r0)
+    arcpy.env.extent = desc.extent
+
+    # composite conflated cells back into the DEM
+    out = dem.copy()
+    replace = mask[r0:r1, c0:c1] & numpy.isfinite(window)
+    out[r0:r1, c0:c1][replace] = window[replace]
+
+    return out
+
+def execute(in_raster, in_links, in_area, distance, out_raster, method='TIN'):
+    if method == 'RASTER':
+        return execute_raster(in_raster, in_links, in_area, distance, out_raster)
+
+    desc = arcpy.Describe(in_raster)
+    scratchworkspace = SW.CreateScratchWorkspace(os.path.dirname(out_raster))
+
+    arcpy.AddMessage("Reading DEM and conflation area..." + str(datetime.now()))
+    dem = Utils.read_raster(in_raster)
+    mask = read_area_mask(in_area, in_raster, dem.shape, distance)
+
+    out = conflate_tin(dem, mask, in_links, in_raster, scratchworkspace)
+    Utils.write_raster(out, arcpy.Point(desc.extent.XMin, desc.extent.YMin), desc.meanCellWidth,
+                       desc.spatialReference, out_raster)
 
     arcpy.AddMessage("END..." + str(datetime.now()))
 
@@ -75,8 +227,9 @@ if __name__ == "__main__":
         in_area = arcpy.GetParameterAsText(2)
         distance = float(arcpy.GetParameterAsText(3))
         out_raster = arcpy.GetParameterAsText(4)
+        method = arcpy.GetParameterAsText(5)
 
-        execute(in_raster, in_links, in_area, distance, out_raster)
+        execute(in_raster, in_links, in_area, distance, out_raster, method)
     except:
         tb = sys.exc_info()[2]
         tbinfo = traceback.format_tb(tb)[0]
@@ -4,6 +4,7 @@ import arcpy
 import traceback
 import math
 import numpy
+import Utils
 from scipy.spatial.distance import cdist
 
 # Frechet distance implementation is borrowed from
@@ -34,157 +35,120 @@ def euc_matrix(P, Q):
     mdist = cdist(P, Q, 'euclidean')
     return mdist
 
-def execute(in_hydrolines, hydro_field, in_counterparts, count_field, out_links, out_area):
-
+def match_vertices(eucs):
+    # monotone matching of counterpart vertices (rows) to hydroline vertices (columns)
+    ni, nj = eucs.shape
+
+    # minimum distance to each hydroline vertex from the counterpart vertices below i
+    below = numpy.full((ni, nj), numpy.inf)
+    if ni > 1:
+        below[:-1] = numpy.minimum.accumulate(eucs[:0:-1], axis=0)[::-1]
+    closer = below <= eucs
+
+    # find basic min j for each i: the vertex before the first j
+    # that is reached closer by one of the next counterpart vertices
+    minjays = numpy.empty(ni, dtype=int)
+    minj = 0
+    for i in range(ni):
+        row = closer[i, minj + 1:]
+        if row.size > 0:
+            j = numpy.argmax(row)
+            if row[j]:
+                minj += j
+        minjays[i] = minj
+
+    # fill empty min j by connecting to nearest i
+    jbacks = []
+    ibacks = []
+    curj = 0
+    for i in range(1, ni-1):
+        nextj = minjays[i]
+        if nextj - curj > 1:
+            js = numpy.arange(curj + 1, nextj)
+            jbacks.extend(js.tolist())
+            ibacks.extend((i - 1 + (eucs[i, js] < eucs[i - 1, js])).tolist())
+        curj = nextj
+
+    # check if the last points are connected
+    if nj-1 not in minjays:
+        for j in range(curj + 1, nj):
+            jbacks.append(j)
+            ibacks.append(ni-1)
+
+    # check if the first points are connected
+    if 0 not in minjays:
+        ibacks.insert(0, 0)
+        jbacks.insert(0, 0)
+
+    pairs = list(zip(range(ni), minjays.tolist()))
+    backpairs = list(zip(ibacks, jbacks))
+
+    return pairs, backpairs
+
+def link_pair(args):
+    count_coords, hydro_coords = args
+
+    pairs, backpairs = match_vertices(euc_matrix(count_coords, hydro_coords))
+
+    # each link is a row of x, y of counterpart vertex and x, y of hydroline vertex
+    links = []
+    for p in (pairs, backpairs):
+        ij = numpy.asarray(p, dtype=int).reshape(-1, 2)
+        links.append(numpy.hstack((count_coords[ij[:, 0]], hydro_coords[ij[:, 1]])))
+
+    return links[0], links[1]
+
+def write_links(out_links, spatial_reference, ids, results):
+    # results yield (links, backlinks) arrays for every id
     arcpy.CreateFeatureclass_management(os.path.dirname(out_links), os.path.basename(out_links),
-                                        geometry_type='POLYLINE', spatial_reference=in_hydrolines)
+                                        geometry_type='POLYLINE', spatial_reference=spatial_reference)
 
     arcpy.AddField_management(out_links, 'ID', 'LONG')
     arcpy.AddField_management(out_links, 'DIR', 'TEXT', field_length=8)
 
-    insertcursor = arcpy.da.InsertCursor(out_links, ['SHAPE@', 'ID', 'DIR'])
-
-    hcursor = arcpy.da.SearchCursor(in_hydrolines, ['SHAPE@', hydro_field])
-    for row in hcursor:
-        hydro_coords = []
-        for pnt in row[0].getPart().next():
-            hydro_coords.append([pnt.X, pnt.Y])
-
-        id = row[1]
-        ccursor = arcpy.da.SearchCursor(in_counterparts, ['SHAPE@', count_field], where_clause = count_field + ' = ' + str(id))
-        counterpart = ccursor.next()
-
-        count_coords = []
-        for pnt in counterpart[0].getPart().next():
-            count_coords.append([pnt.X, pnt.Y])
-
-        eucs = euc_matrix(count_coords, hydro_coords)
-
-        ni = len(count_coords)
-        nj = len(hydro_coords)
-
-        # find basic min j for each i
-        # minjays = [0]
-        # for i in range(ni):
-        #     minj = numpy.argmin(eucs[i, :])
-        #     for k in range (i, ni):
-        #         curj = numpy.argmin(eucs[k, :])
-        #         if  minj > curj:
-        #             minj = curj
-        #     minjays.append(minj)
-
-        minjays = []
-        minj = 0
-        for i in range(0, ni):
-            found = False
-            for j in range(minj + 1, nj):
-                for k in range(i + 1, ni):
-                    if eucs[k, j] <= eucs[i, j]:
-                        minj = j-1
-                        found = True
-                        break
-                if found:
-                    break
-            minjays.append(minj)
-
-        # fill empty min j by connecting to nearest i
-        jbacks = []
-        ibacks = []
-        curj = 0
-        for i in range(1, ni-1):
-            nextj = minjays[i]
-            if nextj - curj > 1:
-                for j in range(curj+1, nextj):
-                    iback = numpy.argmin(eucs[(i-1):(i+1), j]) + i - 1
-                    jbacks.append(j)
-                    ibacks.append(iback)
-            curj = nextj
-
-        # check if the last points are connected
-        if nj-1 not in minjays:
-            for j in range(curj + 1, nj):
-                jbacks.append(j)
-                ibacks.append(ni-1)
-
-        # check if the first points are connected
-        if 0 not in minjays:
-            ibacks.insert(0, 0)
-            jbacks.insert(0, 0)
-
-        pairs = zip(range(ni), minjays)
-        backpairs = zip(ibacks, jbacks)
-
-        # pairs = [[0, 0]]
-        #
-        # i = 0
-        # j = 0
-        #
-        # np = 1
-        #
-        # while i < ni - 1 or j < nj - 1:
-        #     if j == nj - 1:
-        #         pairs.append([i + 1, j])
-        #         i += 1
-        #     elif i == ni - 1:
-        #         pairs.append([i, j + 1])
-        #         j += 1
-        #     elif eucs[i + 1, j] < eucs[i, j + 1] and eucs[i + 1, j] < eucs[i + 1, j + 1]:
-        #         if np > 1:
-        #             if pairs[-2][0] == pairs[-1][0] and pairs[-2][1] != pairs[-1][1]:
-        #                 pairs = pairs[:-1]
-        #                 np -= 1
-        #                 pairs.append([i + 1, j + 1])
-        #                 i += 1
-        #                 j += 1
-        #             else:
-        #                 pairs.append([i + 1, j])
-        #                 i += 1
-        #         else:
-        #             pairs.append([i + 1, j])
-        #             i += 1
-        #     elif eucs[i, j + 1] < eucs[i + 1, j] and eucs[i, j + 1] < eucs[i + 1, j + 1]:
-        #         if np > 1:
-        #             if pairs[-2][0] != pairs[-1][0] and pairs[-2][1] == pairs[-1][1]:
-        #                 pairs = pairs[:-1]
-        #                 np -= 1
-        #                 pairs.append([i + 1, j + 1])
-        #                 i += 1
-        #                 j += 1
-        #             else:
-        #                 pairs.append([i, j + 1])
-        #                 j += 1
-        #         else:
-        #             pairs.append([i, j + 1])
-        #             j += 1
-        #     else:
-        #         pairs.append([i + 1, j + 1])
-        #         i += 1
-        #         j += 1
-        #     np += 1
-
-        # fdist = frechet_dist(count_coords, hydro_coords)
-        # arcpy.AddMessage('Frechet distance: ' + str(fdist) + ' (' + hydro_field + ' = ' + str(id) + ')')
-
-        features = []
-        for pair in pairs:
-            line = [arcpy.Point(*count_coords[pair[0]]), arcpy.Point(*hydro_coords[pair[1]])]
-            features.append(arcpy.Polyline(arcpy.Array(line)))
-
-        backfeatures = []
-        for pair in backpairs:
-            line = [arcpy.Point(*count_coords[pair[0]]), arcpy.Point(*hydro_coords[pair[1]])]
-            backfeatures.append(arcpy.Polyline(arcpy.Array(line)))
-
-        for feature in features:
-            insertcursor.insertRow([feature, id, 'Forward'])
-
-        for backfeature in backfeatures:
-            insertcursor.insertRow([backfeature, id, 'Backward'])
+    with arcpy.da.InsertCursor(out_links, ['SHAPE@WKT', 'ID', 'DIR']) as insertcursor:
+        for k, (links, backlinks) in enumerate(results):
+            id = int(ids[k])
+            arcpy.AddMessage('ID = ' + str(id) + ': ' + str(len(links)) + ' forward and ' +
+                             str(len(backlinks)) + ' backward links')
+
+            for link in links:
+                insertcursor.insertRow([Utils.line_wkt(link.reshape(2, 2)), id, 'Forward'])
+
+            for link in backlinks:
+                insertcursor.insertRow([Utils.line_wkt(link.reshape(2, 2)), id, 'Backward'])
+
+    return out_links
+
+def conflation_area(in_hydrolines, in_counterparts, in_links, out_area):
+    polys = 'in_memory/polys'
+    arcpy.FeatureToPolygon_management([in_hydrolines, in_counterparts, in_links], polys)
+    arcpy.Dissolve_management(polys, out_area)
+    return out_area
+
+def execute(in_hydrolines, hydro_field, in_counterparts, count_field, out_links, out_area,
+            is_parallel=False, num_processes=0):
+
+    hydro_xy, hydro_offsets, hydro_ids, _ = Utils.get_vertices(in_hydrolines, hydro_field)
+    count_xy, count_offsets, count_ids, _ = Utils.get_vertices(in_counterparts, count_field)
+
+    # counterparts of less than two vertices cannot be linked
+    joined = [(h, c) for h, c in Utils.join_by_keys(hydro_ids, count_ids)
+              if hydro_offsets[h + 1] - hydro_offsets[h] > 1 and count_offsets[c + 1] - count_offsets[c] > 1]
+
+    if len(joined) < len(hydro_ids):
+        arcpy.AddMessage(str(len(hydro_ids) - len(joined)) + ' hydrolines have no counterparts')
+
+    args = ((Utils.get_line(count_xy, count_offsets, c), Utils.get_line(hydro_xy, hydro_offsets, h))
+            for h, c in joined)
+
+    results = Utils.imap_parallel(link_pair, args, is_parallel, num_processes)
+
+    write_links(out_links, arcpy.Describe(in_hydrolines).spatialReference,
+                [hydro_ids[h] for h, c in joined], results)
 
     if out_area is not None:
-        polys = 'in_memory/polys'
-        arcpy.FeatureToPolygon_management([in_hydrolines, in_counterparts, out_links], polys)
-        arcpy.Dissolve_management(polys, out_area)
+        conflation_area(in_hydrolines, in_counterparts, out_links, out_area)
 
     return
 
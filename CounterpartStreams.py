@@ -193,9 +193,9 @@ def trace_flow_cells(accraster, euc, i, j, minacc, endneigh, down = True):
         tb = sys.exc_info()[2]
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "Traceback Info:\n" + tbinfo + "\nError Info:\n    " + \
-                str(sys.exc_type) + ": " + str(sys.exc_value) + "\n"
+                str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]) + "\n"
         arcpy.AddError(pymsg)
-        raise Exception
+        raise
 
 # borrowed from https://gis.stackexchange.com/questions/150200/reversing-polyline-direction-based-on-raster-value-using-arcpy
 def FlipLine(Line):
@@ -208,16 +208,6 @@ def FlipLine(Line):
 def get_values(features, field):
     return numpy.asarray([row[0] for row in arcpy.da.SearchCursor(features, field)])
 
-def get_coordinates(features):
-    lines = []
-    with arcpy.da.SearchCursor(features, "SHAPE@") as rows:
-        for row in rows:
-            coords = []
-            for pnt in row[0].getPart().next():
-                coords.append([pnt.X, pnt.Y])
-            lines.append(coords)
-    return lines
-
 def set_values(features, field, values):
     with arcpy.da.UpdateCursor(features, field) as rows:
         i = 0
@@ -501,6 +491,17 @@ def extended_euc(coords, crs, cellsize, start = None, end = None):
     return arcpy.RasterToNumPyArray(arcpy.sa.EucDistance(templine, cell_size=cellsize))
 
 
+def cells_to_line(cells, lowerleft, cellsize, ni, start, end):
+    # line through the centers of ordered cells, directed as the reference line
+    ij = numpy.asarray(cells, dtype=float).reshape(-1, 2)
+    xy = numpy.column_stack((lowerleft.X + (ij[:, 1] + 0.5) * cellsize,
+                             lowerleft.Y + (ni - ij[:, 0] - 0.5) * cellsize))
+
+    if len(xy) > 0 and euc_distance(xy[0], start) > euc_distance(xy[0], end):
+        xy = xy[::-1]
+
+    return xy
+
 def process_raster(instreams, inIDfield, in_raster, minacc, radius, deviation, demraster, penalty, startpts, endpts,
                    ids, ordids, ordends, ordstarts, lowerleft, cellsize, crs, outstreams, limit):
 
@@ -551,7 +552,7 @@ def process_raster(instreams, inIDfield, in_raster, minacc, radius, deviation, d
             x, y = row[0]
             endxy.append([x, y])
 
-        geometries = get_coordinates(instreams)
+        geometries = Utils.get_coordinates(instreams)
         arcpy.AddMessage(idx)
         if len(geometries) > 1:
             geometries = [geometries[i] for i in idx]
@@ -794,72 +795,38 @@ def process_raster(instreams, inIDfield, in_raster, minacc, radius, deviation, d
         arcpy.AddMessage('Total flowline time: ' + str(fsum))
         arcpy.AddMessage('Total least cost time: ' + str(lsum))
 
-        arcpy.AddMessage("GENERATING VECTOR AND RASTER OUTPUT..." + str(datetime.now()))
-
-        outraster = None
-        nodatavalue = 0 if (min(ordids) > 0) else min(ordids) - 1
-
-        N = len(streams)
-
-        if (N > 0):
-            outraster = numpy.full((N, ni, nj), nodatavalue)
-            for l in range(N):
-                for ncells in range(len(streams[l])):
-                    outraster[l, streams[l][ncells][0], streams[l][ncells][1]] = ordids[l]
+        lines = [cells_to_line(streams[k], lowerleft, cellsize, ni, startxy[k], endxy[k]) for k in range(len(streams))]
 
-        outinnerraster = arcpy.sa.Int(arcpy.NumPyArrayToRaster(outraster[0, :, :],
-                                                               lowerleft, cellsize, value_to_nodata=nodatavalue))
-        arcpy.DefineProjection_management(outinnerraster, crs)
+        if outstreams is None:
+            return ordids, lines, geometries, types
 
-        result = 'in_memory/result'
-        arcpy.RasterToPolyline_conversion(outinnerraster, result, background_value='NODATA', simplify='NO_SIMPLIFY')
+        arcpy.AddMessage("GENERATING VECTOR OUTPUT..." + str(datetime.now()))
 
-        templines = 'in_memory/templine'
-        for k in range(1, N):
-            outinnerraster = arcpy.sa.Int(arcpy.NumPyArrayToRaster(outraster[k, :, :],
-                                                                   lowerleft, cellsize, value_to_nodata=nodatavalue))
-            arcpy.DefineProjection_management(outinnerraster, crs)
-            arcpy.RasterToPolyline_conversion(outinnerraster, templines, background_value='NODATA',
-                                              simplify='NO_SIMPLIFY')
-            arcpy.Append_management(templines, result, schema_type='NO_TEST')
-
-        arcpy.AddField_management(result, 'type', 'TEXT', field_length=16)
-        result = set_values(result, 'type', types)
-
-        arcpy.UnsplitLine_management(result, outstreams, ['grid_code', 'type'])
+        # lines through ordered stream cells are written directly, they are already directed as hydrolines
+        Utils.write_lines(outstreams, lines, crs, 'grid_code', [int(id) for id in ordids])
         arcpy.Densify_edit(outstreams, 'DISTANCE', cellsize)
 
+        arcpy.AddField_management(outstreams, 'type', 'TEXT', field_length=16)
         arcpy.AddField_management(outstreams, 'frechet_dist', 'FLOAT', field_length=16)
         arcpy.AddField_management(outstreams, 'hausdorff_dist', 'FLOAT', field_length=16)
         arcpy.AddField_management(outstreams, 'dir_hausdorff_dist', 'FLOAT', field_length=16)
         arcpy.AddField_management(outstreams, 'quality', 'TEXT', field_length=16)
 
-        # ensure right direction
-        arcpy.AddMessage('ENSURING RIGHT DIRECTION AND ASSESSING THE QUALITY...' + str(datetime.now()))
+        arcpy.AddMessage('ASSESSING THE QUALITY...' + str(datetime.now()))
 
-        with  arcpy.da.UpdateCursor(outstreams, ["SHAPE@", 'grid_code', 'frechet_dist', 'hausdorff_dist', 'dir_hausdorff_dist', 'quality']) as rows:
+        with  arcpy.da.UpdateCursor(outstreams, ["SHAPE@", 'grid_code', 'frechet_dist', 'hausdorff_dist', 'dir_hausdorff_dist', 'quality', 'type']) as rows:
             for row in rows:
-                line = row[0].getPart(0)
-                count_start = [line[0].X, line[0].Y]
                 id = row[1]
 
                 idx = numpy.where(ordids == id)[0].tolist()[0]
 
-                hydro_start = startxy[idx]
-                hydro_end = endxy[idx]
-
-                if euc_distance(count_start, hydro_start) > euc_distance(count_start, hydro_end):
-                    row[0] = FlipLine(line)
-                    rows.updateRow(row)
-
                 coords = []
-                for pnt in row[0].getPart().next():
+                for pnt in row[0].getPart(0):
                     coords.append([pnt.X, pnt.Y])
 
+                row[6] = types[idx]
                 row[2] = Utils.frechet_dist(coords, geometries[idx])
-                row[3] = Utils.hausdorff_dist(coords, geometries[idx])
-                row[4] = Utils.hausdorff_dist_dir(coords, geometries[idx])
-                rows.updateRow(row)
+                row[3], row[4], _, _ = Utils.hausdorff_dists(coords, geometries[idx])
 
                 if row[2] <= deviation:
                     row[5] = 'Strong'
@@ -870,15 +837,15 @@ def process_raster(instreams, inIDfield, in_raster, minacc, radius, deviation, d
                 rows.updateRow(row)
 
         arcpy.AddMessage('END...' + str(datetime.now()))
-        return
+        return ordids, lines, geometries, types
 
     except:
         tb = sys.exc_info()[2]
         tbinfo = traceback.format_tb(tb)[0]
         pymsg = "Traceback Info:\n" + tbinfo + "\nError Info:\n    " + \
-                str(sys.exc_type)+ ": " + str(sys.exc_value) + "\n"
+                str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]) + "\n"
         arcpy.AddError(pymsg)
-        raise Exception
+        raise
 
 def execute(in_streams, inIDfield, inraster, demRaster, outstreams, minacc, penalty, radius, deviation, limit):
     global MAXACC
@@ -979,10 +946,10 @@ def execute(in_streams, inIDfield, inraster, demRaster, outstreams, minacc, pena
 
     arcpy.AddMessage('PROCESSING: ' + str(datetime.now()))
 
-    process_raster(instreams_crop, inIDfield, inraster, minacc, radius, deviation, demRaster, penalty,
-                   startpts, endpts, ids, ordids, ordends, ordstarts, lowerleft, cellsize, crs, outstreams, limit)
-
-    return
+    # counterpart lines and reference lines are returned in processing order,
+    # outstreams can be None to keep them in memory only
+    return process_raster(instreams_crop, inIDfield, inraster, minacc, radius, deviation, demRaster, penalty,
+                          startpts, endpts, ids, ordids, ordends, ordstarts, lowerleft, cellsize, crs, outstreams, limit)
 
 if __name__ == "__main__":
     try:
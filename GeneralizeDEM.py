@@ -9,13 +9,129 @@ import math
 import multiprocessing
 import sys
 import traceback
+import numpy
 from arcpy.sa import *
 from itertools import repeat
 import os.path
 import ExtractStreams, WidenLandforms, CreateFishnet
+import Hydrology, Triangulation, Utils
 
 __author__ = 'Timofey Samsonov'
 
+def save_array(array, template, path, nodata=None):
+    # array on the grid of the template raster
+    lowerleft = arcpy.Point(template.extent.XMin, template.extent.YMin)
+    Utils.write_raster(array, lowerleft, template.meanCellWidth, template.spatialReference, path, nodata)
+    return arcpy.Raster(path)
+
+def boundary_lines(labels, template, heights):
+    # boundaries between labelled regions as 3D lines on the grid of the template raster
+    xmin = template.extent.XMin
+    ymax = template.extent.YMax
+    cellsize = template.meanCellWidth
+
+    lines = []
+    for rc in Utils.label_boundaries(labels):
+        xy = numpy.column_stack((xmin + rc[:, 1] * cellsize, ymax - rc[:, 0] * cellsize))
+        lines.append(numpy.column_stack((xy, Utils.sample_heights(heights, xy, xmin, ymax, cellsize))))
+
+    return lines
+
+def center_lines(lines, template, heights):
+    # stream lines through cell centers as 3D lines, heights are taken from cells
+    xmin = template.extent.XMin
+    ymax = template.extent.YMax
+    cellsize = template.meanCellWidth
+
+    return [numpy.column_stack((xmin + (rc[:, 1] + 0.5) * cellsize,
+                                ymax - (rc[:, 0] + 0.5) * cellsize,
+                                heights[rc[:, 0], rc[:, 1]])) for rc in lines]
+
+def interpolate_shapes(datasets, template, heights, boundary, is_written=True):
+    # features get heights from the DEM array of the tile in one vectorized call instead of InterpolateShape.
+    # Datasets are tuples of input, output, densification flag and surface type,
+    # inputs are clipped by the tile boundary.
+    # Parts with heights are returned for every dataset
+    xmin = template.extent.XMin
+    ymax = template.extent.YMax
+    cellsize = template.meanCellWidth
+
+    inputs = []
+    for k in range(len(datasets)):
+        features, out, is_densified, _ = datasets[k]
+        clipped = 'in_memory/clipped' + str(k)
+        arcpy.Clip_analysis(features, boundary, clipped)
+        parts, counts = Utils.get_parts(clipped)
+        if is_densified:
+            parts = [Utils.densify(xy, cellsize) for xy in parts]
+        desc = arcpy.Describe(features)
+        inputs.append((parts, counts, desc.shapeType.upper(), desc.spatialReference))
+
+    sampled = Utils.sample_parts(heights, [xy for parts, _, _, _ in inputs for xy in parts], xmin, ymax, cellsize)
+
+    results = []
+    k = 0
+    for (parts, counts, shapetype, crs), (_, out, _, _) in zip(inputs, datasets):
+        results.append(sampled[k:k + len(parts)])
+        if is_written:
+            Utils.write_parts(out, results[-1], counts, shapetype, crs)
+        k += len(parts)
+
+    return results
+
+def cached(cache, names, func, *items):
+    # arrays of a processing stage are restored from the cache if the stage inputs did not change,
+    # otherwise they are computed by func and stored. Cache is a tuple of folder and size limit in bytes
+    if cache is None:
+        return func()
+    folder, maxsize = cache
+    key = Utils.content_key(names, *items)
+    arrays = Utils.cache_load(folder, key)
+    if arrays is None:
+        arrays = dict(zip(names, func()))
+        Utils.cache_save(folder, key, arrays, maxsize)
+    else:
+        arcpy.AddMessage("Restored from cache: " + ', '.join(names))
+    return [arrays[name] for name in names]
+
+def numpy_hydrology(dem):
+    # flow directions and accumulation of the DEM array with -1 in NoData cells
+    arcpy.AddMessage("Fill...")
+    fill = Hydrology.fill_depressions(dem)
+    nodata = numpy.isnan(fill)
+    arcpy.AddMessage("Dir...")
+    dirs = Hydrology.flow_direction(fill)
+    arcpy.AddMessage("Acc...")
+    accs = Hydrology.flow_accumulation(dirs, nodata)
+    return numpy.where(nodata, -1, dirs).astype(numpy.int16), numpy.where(nodata, -1, accs).astype(numpy.int32)
+
+def numpy_streams(acc, path, minacc, minlen):
+    # raster of streams extracted from the accumulation raster
+    ExtractStreams.execute(acc, path, minacc, minlen)
+    return [numpy.nan_to_num(Utils.read_raster(path)).astype(numpy.uint8)]
+
+def numpy_tin(lines, template, shape, tolerance):
+    # raster of the TIN constrained by 3D lines of surface types on the grid of the template raster
+    cellsize = template.meanCellHeight
+    xmin = template.extent.XMin
+    ymax = template.extent.YMax
+
+    # softlines and softreplace polygons are simplified to the output resolution before triangulation,
+    # lines which would cross other lines after simplification are kept as is. Hardlines are not simplified
+    soft = lines['softline'] + lines['softreplace']
+    nvertices = sum(len(line) for line in soft)
+    soft = Triangulation.simplify_lines(soft, tolerance, xmin, ymax, cellsize, shape, lines['hardline'])
+    arcpy.AddMessage("Simplified constraint lines from " + str(nvertices) + " to " +
+                     str(sum(len(line) for line in soft)) + " vertices")
+
+    lines = {'hardline': lines['hardline'],
+             'softline': soft[:len(lines['softline'])],
+             'softreplace': soft[len(lines['softline']):]}
+
+    # TIN is triangulated and rasterized in memory on the grid of the tile
+    arcpy.AddMessage("TIN to raster conversion...")
+    return [Triangulation.tin_raster(lines, xmin, ymax, cellsize, shape)]
+
 # Just a crutch for pool.map (Python 2.7)
 def call_list(args):
     return call(*args)
@@ -37,7 +153,10 @@ def call(oid,
          widendist,
          filtersize,
          is_smooth,
-         scratchworkspace):
+         scratchworkspace,
+         engine='ARCGIS',
+         tolerance=0,
+         cache=None):
     try:
         i = int(oid) - 1
         raster = 'dem' + str(i) + '.tif'
@@ -85,6 +204,7 @@ def call(oid,
 
         land_area = None
         process_marine = False
+        shapes = [] # to be filled with features which need heights
         clip_3d = workspace + "/clip_3d"
         cell_erased = workspace + "/cell_erased" + str(i)
 
@@ -98,7 +218,7 @@ def call(oid,
                     dem = ExtractByMask(dem0, cell_erased)
                     dem.save(rastertinworkspace + '/' + raster + "_e.tif")
                     dem = arcpy.Raster(rastertinworkspace + '/' + raster + "_e.tif")
-                    arcpy.InterpolateShape_3d(demdataset, land_area, clip_3d, vertices_only=True)
+                    shapes.append((land_area, clip_3d, False, 'hardline'))
 
                     process_marine = True
 
@@ -129,13 +249,37 @@ def call(oid,
 
         dir = flowdir
         acc = flowacc
-        if (dir == None):
-            arcpy.AddMessage("Fill...")
-            fill = Fill(dem, "")
-            arcpy.AddMessage("Dir...")
-            dir = FlowDirection(fill, "", "")
-            arcpy.AddMessage("Acc...")
-            acc = FlowAccumulation(dir, "", "INTEGER")
+        if (dir != None):
+            # shared rasters are read only within the tile extent
+            arcpy.AddMessage("Reading flow direction and accumulation...")
+            dir = rastertinworkspace + "/dir.tif"
+            arcpy.CopyRaster_management(flowdir, dir)
+            acc = rastertinworkspace + "/acc.tif"
+            arcpy.CopyRaster_management(flowacc, acc)
+        else:
+            if engine == 'NUMPY':
+                source = Utils.read_raster(dem.catalogPath).astype(numpy.float32)
+                dirs, accs = cached(cache, ['dir', 'acc'], lambda: numpy_hydrology(source), source)
+
+                dir = save_array(dirs, dem, rastertinworkspace + "/dir.tif", -1)
+                acc = save_array(accs, dem, rastertinworkspace + "/acc.tif", -1)
+            else:
+                arcpy.AddMessage("Fill...")
+                fill = Fill(dem, "")
+                arcpy.AddMessage("Dir...")
+                dir = FlowDirection(fill, "", "")
+                arcpy.AddMessage("Acc...")
+                acc = FlowAccumulation(dir, "", "INTEGER")
+
+        if engine == 'NUMPY':
+            # donor graph is ordered once for all watersheds and basins of the tile
+            dirs = numpy.nan_to_num(Utils.read_raster(rastertinworkspace + "/dir.tif")).astype(numpy.uint8)
+            accs = Utils.read_raster(rastertinworkspace + "/acc.tif")
+            nodata = numpy.isnan(accs)
+            rec = Hydrology.receivers(dirs, nodata)
+            levels = Hydrology.upstream_levels(rec)
+
+        heights = Utils.read_raster(dem0.catalogPath)
 
         # MAIN STREAMS AND WATERSHEDS
         arcpy.AddMessage("PROCESSING PRIMARY STREAMS AND WATERSHEDS")
@@ -144,7 +288,13 @@ def call(oid,
 
         arcpy.AddMessage("Extracting primary streams...")
 
-        ExtractStreams.execute(acc, str1_0, minacc1, minlen1)
+        if engine == 'NUMPY':
+            strs1 = cached(cache, ['streams'], lambda: numpy_streams(acc, str1_0, minacc1, minlen1),
+                           accs, minacc1, minlen1)[0]
+            save_array(strs1, dem, str1_0, 255)
+            strs1 = strs1 == 1
+        else:
+            ExtractStreams.execute(acc, str1_0, minacc1, minlen1)
 
         maxstr = int(str(arcpy.GetRasterProperties_management(str1_0, "MAXIMUM")))
 
@@ -154,101 +304,129 @@ def call(oid,
         stream_processing = True
 
         features = [] # to be filled with features for TIN construction
+        tinlines = {kind: [] for kind in Triangulation.SURFACE_TYPES} # 3D lines for TIN construction in memory
 
         # If there are any streams extracted
         if maxstr == 1:
-            str1 = SetNull(str1_0, 1, "value = 0")
-
             arcpy.AddMessage("Vectorizing streams...")
-            # StreamToFeature(str1, dir, streams1, False)
-            arcpy.RasterToPolyline_conversion(str1, streams1)
+            if engine == 'NUMPY':
+                # lines follow flow directions over stream cells and get heights of these cells
+                lines1, _ = Hydrology.stream_lines(strs1, dirs)
+                streamlines = center_lines(lines1, dem, heights)
+                Utils.write_lines(streams1, streamlines, dem.spatialReference, has_z=True)
+                tinlines['hardline'] += streamlines
+            else:
+                str1 = SetNull(str1_0, 1, "value = 0")
 
-            arcpy.AddMessage("Deriving endpoints...")
-            endpoints1 = workspace + "/endpoints1"
-            arcpy.FeatureVerticesToPoints_management(streams1, endpoints1, "END")
+                # StreamToFeature(str1, dir, streams1, False)
+                arcpy.RasterToPolyline_conversion(str1, streams1)
 
             # radius = 2 * cellsize
 
             radius = 1 # number of cells
 
-            rpts1 = workspace + "/rpts1"
-            arcpy.PointToRaster_conversion(endpoints1, 'grid_code', rpts1, cellsize=cellsize)
+            if engine == 'NUMPY':
+                # endpoints are the first and last cells of stream lines, buffered on the stream raster
+                ends = numpy.vstack([rc[[0, -1]] for rc in lines1])
+                ends1 = numpy.zeros(strs1.shape, dtype=bool)
+                ends1[ends[:, 0], ends[:, 1]] = True
+
+                arcpy.AddMessage("Erasing streams near endpoints...")
+                strs1_e = strs1 & ~Hydrology.expand(ends1, 2*radius)
+
+                arcpy.AddMessage("Deriving erased endpoints...")
+                endpoints1_e = Hydrology.pour_points(Hydrology.stream_outlets(strs1_e, dirs))
+            else:
+                arcpy.AddMessage("Deriving endpoints...")
+                endpoints1 = workspace + "/endpoints1"
+                arcpy.FeatureVerticesToPoints_management(streams1, endpoints1, "END")
+
+                rpts1 = workspace + "/rpts1"
+                arcpy.PointToRaster_conversion(endpoints1, 'grid_code', rpts1, cellsize=cellsize)
 
-            arcpy.AddMessage("Buffering endpoints...")
-            rpts11 = Con(rpts1, 1, 0, "Value>0")
-            rendbuffers1 = Expand(rpts11, 2*radius, [1])
+                arcpy.AddMessage("Buffering endpoints...")
+                rpts11 = Con(rpts1, 1, 0, "Value>0")
+                rendbuffers1 = Expand(rpts11, 2*radius, [1])
 
-            # endbuffers1 = workspace + "/endbuffers1"
-            # arcpy.Buffer_analysis(endpoints1, endbuffers1, radius, "FULL", "ROUND", "NONE", "")
-            # rendbuffers1 = workspace + "/rendbuffers1"
-            # arcpy.FeatureToRaster_conversion(endbuffers1, "OBJECTID", rendbuffers1, cellsize)
+                # endbuffers1 = workspace + "/endbuffers1"
+                # arcpy.Buffer_analysis(endpoints1, endbuffers1, radius, "FULL", "ROUND", "NONE", "")
+                # rendbuffers1 = workspace + "/rendbuffers1"
+                # arcpy.FeatureToRaster_conversion(endbuffers1, "OBJECTID", rendbuffers1, cellsize)
 
-            mask = CreateConstantRaster(0, "INTEGER", cellsize, dem.extent)
-            arcpy.Mosaic_management(mask, rendbuffers1, "MAXIMUM", "FIRST", "", "", "", "0.3", "NONE")
+                mask = CreateConstantRaster(0, "INTEGER", cellsize, dem.extent)
+                arcpy.Mosaic_management(mask, rendbuffers1, "MAXIMUM", "FIRST", "", "", "", "0.3", "NONE")
 
-            arcpy.AddMessage("Erasing streams...")
-            str1_e = SetNull(rendbuffers1, str1, "value > 0")
+                arcpy.AddMessage("Erasing streams...")
+                str1_e = SetNull(rendbuffers1, str1, "value > 0")
 
-            arcpy.AddMessage("Vectorizing erased streams...")
-            streams1_e = workspace + "/streams1_e"
-            # StreamToFeature(str1_e, dir, streams1_e, False)
-            arcpy.RasterToPolyline_conversion(str1_e, streams1_e)
+                arcpy.AddMessage("Vectorizing erased streams...")
+                streams1_e = workspace + "/streams1_e"
+                # StreamToFeature(str1_e, dir, streams1_e, False)
+                arcpy.RasterToPolyline_conversion(str1_e, streams1_e)
 
-            arcpy.AddMessage("Deriving erased endpoints...")
-            endpoints1_e = workspace + "/endpoints1_e"
-            arcpy.FeatureVerticesToPoints_management(streams1_e, endpoints1_e, "END")
+                arcpy.AddMessage("Deriving erased endpoints...")
+                endpoints1_e = workspace + "/endpoints1_e"
+                arcpy.FeatureVerticesToPoints_management(streams1_e, endpoints1_e, "END")
 
             arcpy.AddMessage("Deriving primary watersheds...")
-            pour1 = SnapPourPoint(endpoints1_e, acc, cellsize * 1.5, "")
+            if engine == 'NUMPY':
+                pour1 = Hydrology.snap_pour_points(endpoints1_e, accs, 1.5)
+                wsh1 = cached(cache, ['watersheds'], lambda: [Hydrology.watersheds(rec, levels, pour1)], rec, pour1)[0]
+            else:
+                pour1 = SnapPourPoint(endpoints1_e, acc, cellsize * 1.5, "")
 
-            wsh1 = Watershed(dir, pour1, "")
+                wsh1 = Watershed(dir, pour1, "")
 
-            arcpy.AddMessage("Vectorizing primary watersheds...")
-            watersheds1 = workspace + "/watersheds1"
+            if engine == 'NUMPY':
+                arcpy.AddMessage("Tracing primary watershed boundaries...")
+                tinlines['softline'] += boundary_lines(wsh1, dem, heights)
+            else:
+                arcpy.AddMessage("Vectorizing primary watersheds...")
+                watersheds1 = workspace + "/watersheds1"
 
-            try:
-                arcpy.RasterToPolygon_conversion(wsh1, watersheds1, False, "")
-            except:
-                arcpy.AddMessage("\n> FAILED TO CONVERT PRIMARY WATERSHEDS TO VECTOR - PROBABLY EXTENT ERROR. MASKING...\n")
+                try:
+                    arcpy.RasterToPolygon_conversion(wsh1, watersheds1, False, "")
+                except:
+                    arcpy.AddMessage("\n> FAILED TO CONVERT PRIMARY WATERSHEDS TO VECTOR - PROBABLY EXTENT ERROR. MASKING...\n")
 
-                domain = workspace + "/domain1"
+                    domain = workspace + "/domain1"
 
-                arcpy.RasterDomain_3d(wsh1, domain, "POLYGON")
+                    arcpy.RasterDomain_3d(wsh1, domain, "POLYGON")
 
-                envpoly = workspace + "/envpoly1"
-                arcpy.MinimumBoundingGeometry_management(domain, envpoly,
-                                                         "ENVELOPE", "NONE")
+                    envpoly = workspace + "/envpoly1"
+                    arcpy.MinimumBoundingGeometry_management(domain, envpoly,
+                                                             "ENVELOPE", "NONE")
 
-                envline = workspace + "/envline1"
-                arcpy.PolygonToLine_management(envpoly, envline)
+                    envline = workspace + "/envline1"
+                    arcpy.PolygonToLine_management(envpoly, envline)
 
-                envpolyr = workspace + "/envpolyr1"
-                envliner = workspace + "/envliner1"
+                    envpolyr = workspace + "/envpolyr1"
+                    envliner = workspace + "/envliner1"
 
-                arcpy.PolygonToRaster_conversion(envpoly, "OBJECTID",
-                                                 envpolyr, "", "", cellsize)
+                    arcpy.PolygonToRaster_conversion(envpoly, "OBJECTID",
+                                                     envpolyr, "", "", cellsize)
 
-                arcpy.PolylineToRaster_conversion(envline, "OBJECTID",
-                                                 envliner, "", "", cellsize)
+                    arcpy.PolylineToRaster_conversion(envline, "OBJECTID",
+                                                     envliner, "", "", cellsize)
 
-                envmaskname = "envmask1"
-                envmask = workspace + "/" + envmaskname
+                    envmaskname = "envmask1"
+                    envmask = workspace + "/" + envmaskname
 
-                envs = [envpolyr, envliner]
+                    envs = [envpolyr, envliner]
 
-                arcpy.MosaicToNewRaster_management(envs,
-                                                   workspace,
-                                                   envmaskname,
-                                                   "",
-                                                   "8_BIT_UNSIGNED",
-                                                   str(cellsize),
-                                                   "1",
-                                                   "SUM",
-                                                   "FIRST")
+                    arcpy.MosaicToNewRaster_management(envs,
+                                                       workspace,
+                                                       envmaskname,
+                                                       "",
+                                                       "8_BIT_UNSIGNED",
+                                                       str(cellsize),
+                                                       "1",
+                                                       "SUM",
+                                                       "FIRST")
 
-                wsh1_m = SetNull(envmask, wsh1, "VALUE = 2")
+                    wsh1_m = SetNull(envmask, wsh1, "VALUE = 2")
 
-                arcpy.RasterToPolygon_conversion(wsh1_m, watersheds1, True, "")
+                    arcpy.RasterToPolygon_conversion(wsh1_m, watersheds1, True, "")
 
             # SECONDARY STREAMS AND WATERSHEDS
 
@@ -256,119 +434,138 @@ def call(oid,
 
             arcpy.AddMessage("Extracting secondary streams...")
             str2_0 = rastertinworkspace + "/str2.tif"
-            ExtractStreams.execute(acc, str2_0, minacc2, minlen2)
-
-            str2 = SetNull(str2_0, 1, "value = 0")
-            str2_e = SetNull(str1_0, str2, "value > 0")
-            acc_e = SetNull(str1_0, acc, "value > 0")
-
-            arcpy.AddMessage("Vectorizing streams...")
-            streams2_e = workspace + "/streams2_e"
-            # StreamToFeature(str2_e, dir, streams2_e, False)
-            arcpy.RasterToPolyline_conversion(str2_e, streams2_e)
-
-            arcpy.AddMessage("Deriving endpoints...")
-            endpoints2_e = workspace + "/endpoints2_e"
-            arcpy.FeatureVerticesToPoints_management(streams2_e, endpoints2_e, "END")
 
-            arcpy.AddMessage("Buffering primary streams...")
-            streambuffer = Expand(str1, radius, [1])
-            # streambuffer = workspace + "/streams1_b"
-            # arcpy.Buffer_analysis(streams1, streambuffer, radius, "FULL", "ROUND", "NONE", "")
+            if engine == 'NUMPY':
+                strs2 = cached(cache, ['streams'], lambda: numpy_streams(acc, str2_0, minacc2, minlen2),
+                               accs, minacc2, minlen2)[0]
 
-            arcpy.AddMessage("Selecting endpoints...")
-            # pointslyr = "points"
-            # arcpy.MakeFeatureLayer_management(endpoints2_e, pointslyr)
-            # arcpy.SelectLayerByLocation_management(pointslyr, "INTERSECT", streambuffer)
-            # pourpts2 = workspace + "/pourpts2"
-            # arcpy.CopyFeatures_management(pointslyr, pourpts2)
+                arcpy.AddMessage("Selecting endpoints...")
+                strs2_e = (strs2 == 1) & ~strs1
+                ends2 = Hydrology.stream_outlets(strs2_e, dirs) & Hydrology.expand(strs1, radius)
+                pourpts2 = Hydrology.pour_points(ends2)
 
-            rpts2 = workspace + "/rpts2"
-            arcpy.PointToRaster_conversion(endpoints2_e, 'grid_code', rpts2, cellsize=cellsize)
-            # rpts21 = Con(rpts2, 1, 0, "Value>0")
-            pourpts2 = ExtractByMask(rpts2, streambuffer)
+                arcpy.AddMessage("Deriving secondary pour pts...")
+                accs_e = numpy.where(strs1, numpy.nan, accs)
+                pour21 = Hydrology.snap_pour_points(pourpts2, accs_e, 1.5)
+                pour22 = Hydrology.snap_pour_points(pourpts2, accs_e, 2)
+                pour22 = numpy.where(pour22 > 0, pour22, pour21)
 
+                arcpy.AddMessage("Deriving secondary watersheds...")
+                wsh2 = cached(cache, ['watersheds'], lambda: [Hydrology.watersheds(rec, levels, pour22)], rec, pour22)[0]
+            else:
+                ExtractStreams.execute(acc, str2_0, minacc2, minlen2)
 
-            arcpy.AddMessage("Deriving secondary pour pts 1...")
-            pour21 = SnapPourPoint(pourpts2, acc_e, cellsize * 1.5, "")
+                str2 = SetNull(str2_0, 1, "value = 0")
+                str2_e = SetNull(str1_0, str2, "value > 0")
+                acc_e = SetNull(str1_0, acc, "value > 0")
 
-            arcpy.AddMessage("Deriving secondary pour pts 2...")
-            pour22 = SnapPourPoint(pourpts2, acc_e, cellsize * 2, "")
+                arcpy.AddMessage("Vectorizing streams...")
+                streams2_e = workspace + "/streams2_e"
+                # StreamToFeature(str2_e, dir, streams2_e, False)
+                arcpy.RasterToPolyline_conversion(str2_e, streams2_e)
 
-            arcpy.AddMessage("Mosaic secondary pour pts...")
-            arcpy.Mosaic_management(pour21, pour22, "FIRST", "FIRST", "0", "0", "", "0.3", "NONE")
+                arcpy.AddMessage("Deriving endpoints...")
+                endpoints2_e = workspace + "/endpoints2_e"
+                arcpy.FeatureVerticesToPoints_management(streams2_e, endpoints2_e, "END")
 
-            arcpy.AddMessage("Deriving secondary watersheds...")
-            wsh2 = Watershed(dir, pour22, "")
+                arcpy.AddMessage("Buffering primary streams...")
+                streambuffer = Expand(str1, radius, [1])
+                # streambuffer = workspace + "/streams1_b"
+                # arcpy.Buffer_analysis(streams1, streambuffer, radius, "FULL", "ROUND", "NONE", "")
 
-            arcpy.AddMessage("Vectorizing secondary watersheds...")
-            watersheds2 = workspace + "/watersheds2"
+                arcpy.AddMessage("Selecting endpoints...")
+                # pointslyr = "points"
+                # arcpy.MakeFeatureLayer_management(endpoints2_e, pointslyr)
+                # arcpy.SelectLayerByLocation_management(pointslyr, "INTERSECT", streambuffer)
+                # pourpts2 = workspace + "/pourpts2"
+                # arcpy.CopyFeatures_management(pointslyr, pourpts2)
 
-            try:
-                arcpy.RasterToPolygon_conversion(wsh2, watersheds2, False, "")
-            except:
-                arcpy.AddMessage("\n> FAILED TO CONVERT SECONDARY WATERSHEDS TO VECTOR - PROBABLY EXTENT ERROR. MASKING...\n")
-                domain = workspace + "/domain2"
+                rpts2 = workspace + "/rpts2"
+                arcpy.PointToRaster_conversion(endpoints2_e, 'grid_code', rpts2, cellsize=cellsize)
+                # rpts21 = Con(rpts2, 1, 0, "Value>0")
+                pourpts2 = ExtractByMask(rpts2, streambuffer)
 
-                arcpy.RasterDomain_3d(wsh2, domain, "POLYGON")
+                arcpy.AddMessage("Deriving secondary pour pts 1...")
+                pour21 = SnapPourPoint(pourpts2, acc_e, cellsize * 1.5, "")
 
-                envpoly = workspace + "/envpoly2"
-                arcpy.MinimumBoundingGeometry_management(domain, envpoly,
-                                                         "ENVELOPE", "NONE")
-                envline = workspace + "/envline2"
-                arcpy.PolygonToLine_management(envpoly, envline)
+                arcpy.AddMessage("Deriving secondary pour pts 2...")
+                pour22 = SnapPourPoint(pourpts2, acc_e, cellsize * 2, "")
 
-                envpolyr = workspace + "/envpolyr2"
-                envliner = workspace + "/envliner2"
+                arcpy.AddMessage("Mosaic secondary pour pts...")
+                arcpy.Mosaic_management(pour21, pour22, "FIRST", "FIRST", "0", "0", "", "0.3", "NONE")
 
-                arcpy.PolygonToRaster_conversion(envpoly, "OBJECTID",
-                                                 envpolyr, "", "", cellsize)
+                arcpy.AddMessage("Deriving secondary watersheds...")
+                wsh2 = Watershed(dir, pour22, "")
 
-                arcpy.PolylineToRaster_conversion(envline, "OBJECTID",
-                                                  envliner, "", "", cellsize)
+            if engine == 'NUMPY':
+                arcpy.AddMessage("Tracing secondary watershed boundaries...")
+                tinlines['softline'] += boundary_lines(wsh2, dem, heights)
+            else:
+                arcpy.AddMessage("Vectorizing secondary watersheds...")
+                watersheds2 = workspace + "/watersheds2"
 
-                envmaskname = "envmask2"
-                envmask = workspace + "/" + envmaskname
+                try:
+                    arcpy.RasterToPolygon_conversion(wsh2, watersheds2, False, "")
+                except:
+                    arcpy.AddMessage("\n> FAILED TO CONVERT SECONDARY WATERSHEDS TO VECTOR - PROBABLY EXTENT ERROR. MASKING...\n")
+                    domain = workspace + "/domain2"
 
-                envs = [envpolyr, envliner]
+                    arcpy.RasterDomain_3d(wsh2, domain, "POLYGON")
 
-                arcpy.MosaicToNewRaster_management(envs,
-                                                   workspace,
-                                                   envmaskname,
-                                                   "",
-                                                   "8_BIT_UNSIGNED",
-                                                   str(cellsize),
-                                                   "1",
-                                                   "SUM",
-                                                   "FIRST")
+                    envpoly = workspace + "/envpoly2"
+                    arcpy.MinimumBoundingGeometry_management(domain, envpoly,
+                                                             "ENVELOPE", "NONE")
+                    envline = workspace + "/envline2"
+                    arcpy.PolygonToLine_management(envpoly, envline)
 
-                wsh2_m = SetNull(envmask, wsh2, "VALUE = 2")
+                    envpolyr = workspace + "/envpolyr2"
+                    envliner = workspace + "/envliner2"
 
-                arcpy.RasterToPolygon_conversion(wsh2_m, watersheds2, False, "")
+                    arcpy.PolygonToRaster_conversion(envpoly, "OBJECTID",
+                                                     envpolyr, "", "", cellsize)
 
-            # PROCESSING NARROW AREAS WITHOUT WATERSHEDS
+                    arcpy.PolylineToRaster_conversion(envline, "OBJECTID",
+                                                      envliner, "", "", cellsize)
 
-            arcpy.AddMessage("Processing remaining basins...")
-            bsn = Basin(dir)
-            basins = workspace + "/basins"
-            arcpy.RasterToPolygon_conversion(bsn, basins, False, "")
-            basins_e = workspace + "/basins_e"
-            arcpy.Erase_analysis(basins, watersheds1, basins_e)
+                    envmaskname = "envmask2"
+                    envmask = workspace + "/" + envmaskname
 
-            arcpy.AddMessage("Interpolating features into 3D...")
+                    envs = [envpolyr, envliner]
 
-            streams1_3d = workspace + "/streams1_3d"
+                    arcpy.MosaicToNewRaster_management(envs,
+                                                       workspace,
+                                                       envmaskname,
+                                                       "",
+                                                       "8_BIT_UNSIGNED",
+                                                       str(cellsize),
+                                                       "1",
+                                                       "SUM",
+                                                       "FIRST")
 
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, streams1, streams1_3d)
+                    wsh2_m = SetNull(envmask, wsh2, "VALUE = 2")
 
-            watersheds1_3d = workspace + "/watersheds1_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, watersheds1, watersheds1_3d)
+                    arcpy.RasterToPolygon_conversion(wsh2_m, watersheds2, False, "")
 
-            watersheds2_3d = workspace + "/watersheds2_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, watersheds2, watersheds2_3d)
+            # PROCESSING NARROW AREAS WITHOUT WATERSHEDS
 
-            basins_e_3d = workspace + "/basins_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, basins_e, basins_e_3d)
+            # basins outside primary watersheds are not used in the TIN by the NUMPY engine
+            if engine != 'NUMPY':
+                arcpy.AddMessage("Processing remaining basins...")
+                bsn = Basin(dir)
+                basins = workspace + "/basins"
+                arcpy.RasterToPolygon_conversion(bsn, basins, False, "")
+                basins_e = workspace + "/basins_e"
+                arcpy.Erase_analysis(basins, watersheds1, basins_e)
+
+                streams1_3d = workspace + "/streams1_3d"
+                watersheds1_3d = workspace + "/watersheds1_3d"
+                watersheds2_3d = workspace + "/watersheds2_3d"
+                basins_e_3d = workspace + "/basins_3d"
+
+                shapes.append((streams1, streams1_3d, True, 'hardline'))
+                shapes.append((watersheds1, watersheds1_3d, True, 'softline'))
+                shapes.append((watersheds2, watersheds2_3d, True, 'softline'))
+                shapes.append((basins_e, basins_e_3d, True, 'softline'))
 
             # GENERALIZED TIN SURFACE
 
@@ -376,16 +573,17 @@ def call(oid,
 
             arcpy.AddMessage("TIN construction...")
 
+            if engine != 'NUMPY':
+                s1 = "'" + streams1_3d + "' Shape.Z " + "hardline"
+                w1 = "'" + watersheds1_3d + "' Shape.Z " + "softline"
+                w2 = "'" + watersheds2_3d + "' Shape.Z " + "softline"
+                b = "'" + basins_e_3d + "' Shape.Z " + "softline"
 
-            s1 = "'" + streams1_3d + "' Shape.Z " + "hardline"
-            w1 = "'" + watersheds1_3d + "' Shape.Z " + "softline"
-            w2 = "'" + watersheds2_3d + "' Shape.Z " + "softline"
-            b = "'" + basins_e_3d + "' Shape.Z " + "softline"
+                features.append(s1)
+                features.append(w1)
+                features.append(w2)
+                # features.append(b)
 
-            features.append(s1)
-            features.append(w1)
-            features.append(w2)
-            # features.append(b)
             if process_marine:
                 m2 = "'" + clip_3d + "' Shape.Z " + "hardline"
                 features.append(m2)
@@ -422,11 +620,15 @@ def call(oid,
         else:
 
             arcpy.AddMessage("NO STREAMS DETECTED. PROCESSING BASINS...")
-            bsn = Basin(dir)
-            basins = workspace + "/basins"
-            arcpy.RasterToPolygon_conversion(bsn, basins, False, "")
             basins_3d = workspace + "/basins_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, basins, basins_3d)
+            if engine == 'NUMPY':
+                bsn = cached(cache, ['basins'], lambda: [Hydrology.basins(rec, levels, nodata)], rec, nodata)[0]
+                tinlines['softline'] += boundary_lines(bsn, dem, heights)
+            else:
+                bsn = Basin(dir)
+                basins = workspace + "/basins"
+                arcpy.RasterToPolygon_conversion(bsn, basins, False, "")
+                shapes.append((basins, basins_3d, True, 'softline'))
             b = "'" + basins_3d + "' Shape.Z " + "softline"
             features.append(b)
 
@@ -447,28 +649,40 @@ def call(oid,
 
         if flines:
             flines_3d = workspace + "/flines_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, flines, flines_3d)
+            shapes.append((flines, flines_3d, True, 'softline'))
             f = "'" + flines_3d + "' Shape.Z " + "softline"
             features.append(f)
 
         if fpolys:
             fpolys_3d = workspace + "/fpolys_3d"
-            arcpy.InterpolateShape_3d(dem0.path + '/' + dem0.name, fpolys, fpolys_3d)
+            shapes.append((fpolys, fpolys_3d, True, 'softreplace'))
             f = "'" + fpolys_3d + "' Shape.Z " + "softreplace"
             features.append(f)
 
-        featurestring = ';'.join(features)
-        arcpy.ddd.CreateTin(tin, "", featurestring, "")
-
-        # GENERALIZED RASTER SURFACE
-        arcpy.AddMessage("TIN to raster conversion...")
+        if len(shapes) > 0:
+            arcpy.AddMessage("Interpolating features into 3D...")
+            for (_, _, _, kind), parts in zip(shapes, interpolate_shapes(shapes, dem0, heights, cell[0],
+                                                                          engine != 'NUMPY')):
+                tinlines[kind] += parts
 
         rastertin = rastertinworkspace + "/rastertin.tif"
-        try:
-            arcpy.TinRaster_3d(tin, rastertin, "FLOAT", "NATURAL_NEIGHBORS", "CELLSIZE " + str(cellsize), 1)
-        except:
-            arcpy.AddMessage("Failed to rasterize TIN using NATURAL_NEIGHBORS method. Switching to linear")
-            arcpy.TinRaster_3d(tin, rastertin, "FLOAT", "LINEAR", "CELLSIZE " + str(cellsize), 1)
+        if engine == 'NUMPY':
+            grid = (dem.extent.XMin, dem.extent.YMax, cellsize, heights.shape)
+            save_array(cached(cache, ['tin'], lambda: numpy_tin(tinlines, dem, heights.shape, tolerance),
+                              [tinlines[kind] for kind in Triangulation.SURFACE_TYPES], tolerance, grid)[0],
+                       dem, rastertin)
+        else:
+            featurestring = ';'.join(features)
+            arcpy.ddd.CreateTin(tin, "", featurestring, "")
+
+            # GENERALIZED RASTER SURFACE
+            arcpy.AddMessage("TIN to raster conversion...")
+
+            try:
+                arcpy.TinRaster_3d(tin, rastertin, "FLOAT", "NATURAL_NEIGHBORS", "CELLSIZE " + str(cellsize), 1)
+            except:
+                arcpy.AddMessage("Failed to rasterize TIN using NATURAL_NEIGHBORS method. Switching to linear")
+                arcpy.TinRaster_3d(tin, rastertin, "FLOAT", "LINEAR", "CELLSIZE " + str(cellsize), 1)
 
         # POSTPROCESSING
         arcpy.AddMessage("POSTPROCESSING")
@@ -547,6 +761,183 @@ def call(oid,
 
         return False
 
+def tile_windows(nrows, ncols, tile_size):
+    # rows and columns of non-overlapping tiles
+    return [(r0, min(r0 + tile_size, nrows), c0, min(c0 + tile_size, ncols))
+            for r0 in range(0, nrows, tile_size) for c0 in range(0, ncols, tile_size)]
+
+def raster_bands(raster, rows):
+    # bands of rows of the raster from the top, read one by one
+    source = arcpy.Raster(raster)
+    for r0 in range(0, source.height, rows):
+        r1 = min(r0 + rows, source.height)
+        yield Utils.read_raster(raster, window_corner(raster, r1, 0), source.width, r1 - r0)
+
+def window_corner(raster, r1, c0):
+    desc = arcpy.Describe(raster)
+    return arcpy.Point(desc.extent.XMin + c0 * desc.meanCellWidth, desc.extent.YMax - r1 * desc.meanCellHeight)
+
+def read_padded(raster, window):
+    # window of the raster with a one cell halo, NaN outside the raster
+    r0, r1, c0, c1 = window
+    source = arcpy.Raster(raster)
+    h0 = max(r0 - 1, 0)
+    h1 = min(r1 + 1, source.height)
+    g0 = max(c0 - 1, 0)
+    g1 = min(c1 + 1, source.width)
+
+    zh = numpy.full((r1 - r0 + 2, c1 - c0 + 2), numpy.nan)
+    zh[h0 - r0 + 1:h1 - r0 + 1, g0 - c0 + 1:g1 - c0 + 1] = \
+        Utils.read_raster(raster, window_corner(raster, h1, g0), g1 - g0, h1 - h0)
+    return zh
+
+# Just a crutch for pool.map (Python 2.7)
+def call_fill(args):
+    return tile_fill(*args)
+
+def tile_fill(k, demdataset, window, folder):
+    # depressions of a tile filled from its perimeter, its spill graph is returned
+    r0, r1, c0, c1 = window
+    raster = arcpy.Raster(demdataset)
+
+    z, labels, links = Hydrology.tile_fill(read_padded(demdataset, window), r0, c0, (raster.height, raster.width))
+    numpy.save(folder + '/fill' + str(k) + '.npy', z)
+    numpy.save(folder + '/label' + str(k) + '.npy', labels)
+    return links
+
+# Just a crutch for pool.map (Python 2.7)
+def call_drain(args):
+    return tile_drain(*args)
+
+def tile_drain(k, demdataset, window, spills, folder):
+    # tile raised to the water levels of its depressions, directions on its flats are saved
+    r0, r1, c0, c1 = window
+    raster = arcpy.Raster(demdataset)
+
+    z, codes = Hydrology.tile_drain(numpy.load(folder + '/fill' + str(k) + '.npy'),
+                                    numpy.load(folder + '/label' + str(k) + '.npy'),
+                                    Hydrology.outlets(read_padded(demdataset, window)),
+                                    spills, r0, c0, (raster.height, raster.width))
+    numpy.save(folder + '/flat' + str(k) + '.npy', codes)
+
+    out = folder + '/fill' + str(k) + '.tif'
+    Utils.write_raster(z.astype(numpy.float32), window_corner(demdataset, r1, c0),
+                       raster.meanCellWidth, raster.spatialReference, out)
+    return out
+
+# Just a crutch for pool.map (Python 2.7)
+def call_links(args):
+    return tile_links(*args)
+
+def tile_links(k, filled, window, folder):
+    # directions and local accumulation of a tile, its perimeter graph is returned
+    r0, r1, c0, c1 = window
+    raster = arcpy.Raster(filled)
+    shape = (raster.height, raster.width)
+
+    # directions are computed with a one cell halo, flats drain as they were flooded
+    zh = read_padded(filled, window)
+    dirs = Hydrology.steepest_descent(zh)[1:-1, 1:-1]
+    nodata = numpy.isnan(zh)[1:-1, 1:-1]
+    flats = (dirs == 0) & ~nodata
+    dirs[flats] = numpy.load(folder + '/flat' + str(k) + '.npy')[flats]
+
+    acc, links = Hydrology.tile_links(dirs, nodata, r0, c0, shape)
+    numpy.save(folder + '/acc' + str(k) + '.npy', acc)
+
+    Utils.write_raster(numpy.where(nodata, -1, dirs).astype(numpy.int16), window_corner(filled, r1, c0),
+                       raster.meanCellWidth, raster.spatialReference, folder + '/dir' + str(k) + '.tif', -1)
+    return links
+
+# Just a crutch for pool.map (Python 2.7)
+def call_inflow(args):
+    return tile_inflow(*args)
+
+def tile_inflow(k, filled, window, inflow, folder):
+    # global accumulation of a tile
+    r0, r1, c0, c1 = window
+    raster = arcpy.Raster(filled)
+
+    dirs = Utils.read_raster(folder + '/dir' + str(k) + '.tif')
+    nodata = numpy.isnan(dirs)
+    dirs = numpy.where(nodata, 0, dirs).astype(numpy.uint8)
+
+    acc = Hydrology.add_inflow(dirs, nodata, numpy.load(folder + '/acc' + str(k) + '.npy'), inflow)
+
+    out = folder + '/acc' + str(k) + '.tif'
+    Utils.write_raster(numpy.where(nodata, -1, acc).astype(numpy.int32), window_corner(filled, r1, c0),
+                       raster.meanCellWidth, raster.spatialReference, out, -1)
+    return out
+
+def tiled_hydrology(demdataset, flowdir, flowacc, folder, tile_size, is_parallel=False, num_processes=0):
+    # filling, directions and accumulation by tiles with memory bounded by the tile size.
+    # Water levels of depressions are solved on the graph of spills between tiles (Barnes et al., 2016),
+    # accumulation is stitched through the graph of tile perimeters (Barnes, 2017)
+    raster = arcpy.Raster(demdataset)
+    windows = tile_windows(raster.height, raster.width, tile_size)
+    arcpy.AddMessage('Filling depressions in ' + str(len(windows)) + ' tiles')
+
+    args = [(k, demdataset, windows[k], folder) for k in range(len(windows))]
+    links = list(Utils.imap_parallel(call_fill, args, is_parallel, num_processes, chunksize=1))
+
+    arcpy.AddMessage('Solving spill graph...')
+    spills = Hydrology.spill_levels(links, (raster.height, raster.width))
+    del links
+
+    args = [(k, demdataset, windows[k], spills[k], folder) for k in range(len(windows))]
+    fills = list(Utils.imap_parallel(call_drain, args, is_parallel, num_processes, chunksize=1))
+
+    filled = folder + '/fill.tif'
+    arcpy.MosaicToNewRaster_management(fills, os.path.dirname(filled), os.path.basename(filled),
+                                       pixel_type='32_BIT_FLOAT', number_of_bands=1)
+
+    arcpy.AddMessage('Accumulating flow in ' + str(len(windows)) + ' tiles')
+
+    args = [(k, filled, windows[k], folder) for k in range(len(windows))]
+    links = list(Utils.imap_parallel(call_links, args, is_parallel, num_processes, chunksize=1))
+
+    arcpy.AddMessage('Solving perimeter graph...')
+    sizes = [len(l[0]) for l in links]
+    inflow = Hydrology.perimeter_inflow(*[numpy.concatenate([l[i] for l in links]) for i in range(5)])
+    inflows = numpy.split(inflow, numpy.cumsum(sizes)[:-1])
+
+    args = [(k, filled, windows[k], inflows[k], folder) for k in range(len(windows))]
+    accs = list(Utils.imap_parallel(call_inflow, args, is_parallel, num_processes, chunksize=1))
+
+    dirs = [folder + '/dir' + str(k) + '.tif' for k in range(len(windows))]
+    arcpy.MosaicToNewRaster_management(dirs, os.path.dirname(flowdir), os.path.basename(flowdir),
+                                       pixel_type='16_BIT_SIGNED', number_of_bands=1)
+    arcpy.MosaicToNewRaster_management(accs, os.path.dirname(flowacc), os.path.basename(flowacc),
+                                       pixel_type='32_BIT_SIGNED', number_of_bands=1)
+
+    return flowdir, flowacc
+
+def global_hydrology(demdataset, scratchworkspace, tile_size, engine='ARCGIS',
+                     is_parallel=False, num_processes=0):
+    # flow direction and accumulation of the whole DEM, shared by all tiles
+    folder = scratchworkspace + '/hydro'
+    flowdir = folder + '/dir.tif'
+    flowacc = folder + '/acc.tif'
+
+    if arcpy.Exists(flowdir) and arcpy.Exists(flowacc):
+        return flowdir, flowacc
+
+    if not arcpy.Exists(folder):
+        arcpy.CreateFolder_management(scratchworkspace, 'hydro')
+
+    demsource = arcpy.Raster(demdataset)
+    arcpy.env.extent = demsource.extent  # Very important!
+    arcpy.env.snapRaster = demsource  # Very important!
+
+    if engine == 'NUMPY':
+        tiled_hydrology(demdataset, flowdir, flowacc, folder, tile_size, is_parallel, num_processes)
+    else:
+        dir = FlowDirection(Fill(demsource, ""), "", "")
+        dir.save(flowdir)
+        FlowAccumulation(dir, "", "INTEGER").save(flowacc)
+
+    return flowdir, flowacc
+
 def execute(demdataset,
             output,
             flowdir,
@@ -569,7 +960,11 @@ def execute(demdataset,
             is_parallel,
             num_processes,
             is_continued=False,
-            continued_folder=None):
+            continued_folder=None,
+            engine='ARCGIS',
+            is_global=False,
+            is_aggregated=False,
+            cache_size=0):
 
     try:
         # arcpy.CheckOutExtension("3D")
@@ -582,6 +977,16 @@ def execute(demdataset,
         workspace = os.path.dirname(output)
         scratchworkspace = workspace
 
+        # stage results are cached next to scratch folders and reused by the following runs
+        cache = None
+        if cache_size > 0 and engine != 'NUMPY':
+            arcpy.AddMessage('Cache is used only by the NUMPY engine')
+        elif cache_size > 0:
+            cachefolder = os.path.dirname(workspace) if workspace.endswith('.gdb') else workspace
+            if not arcpy.Exists(cachefolder + '/cache'):
+                arcpy.CreateFolder_management(cachefolder, 'cache')
+            cache = (cachefolder + '/cache', cache_size * 2 ** 20)
+
         if is_continued:
             scratchworkspace = continued_folder
             arcpy.AddMessage('\n> CONTINUING PREVIOUS PROCESSING')
@@ -616,6 +1021,34 @@ def execute(demdataset,
 
         demsource = arcpy.Raster(demdataset)
 
+        if is_aggregated and flowdir == None:
+            # hydrology and TIN are processed at half of the output resolution or finer
+            ratio = 0.5 * outputcellsize / max(demsource.meanCellHeight, demsource.meanCellWidth)
+            levels = int(math.floor(math.log(ratio, 2))) if ratio >= 2 else 0
+            if levels > 0:
+                factor = 2 ** levels
+                minacc1 = max(int(round(float(minacc1) / factor ** 2)), 1)
+                minacc2 = max(int(round(float(minacc2) / factor ** 2)), 1)
+                minlen1 = max(int(round(float(minlen1) / factor)), 1)
+                minlen2 = max(int(round(float(minlen2) / factor)), 1)
+
+                aggregated = scratchworkspace + '/aggregated.tif'
+                if not arcpy.Exists(aggregated):
+                    arcpy.AddMessage('AGGREGATING DEM ' + str(factor) + ' times')
+                    # DEM is read by bands of rows, so the memory is bounded as for the tiles
+                    rows = factor * int(math.ceil(float(tile_size) / factor))
+                    dem = Hydrology.aggregate(raster_bands(demdataset, rows), levels, minacc1)
+                    Utils.write_raster(dem, arcpy.Point(demsource.extent.XMin, demsource.extent.YMax -
+                                                        dem.shape[0] * factor * demsource.meanCellHeight),
+                                       factor * demsource.meanCellWidth, demsource.spatialReference, aggregated)
+                    del dem
+
+                arcpy.AddMessage('Flow accumulation and length thresholds are rescaled to ' +
+                                 str(minacc1) + ', ' + str(minlen1) + ' (primary) and ' +
+                                 str(minacc2) + ', ' + str(minlen2) + ' (secondary)')
+                demdataset = aggregated
+                demsource = arcpy.Raster(demdataset)
+
         nrows = int(math.ceil(float(demsource.height) / float(tile_size)))
         ncols = int(math.ceil(float(demsource.width) / float(tile_size)))
         total = nrows * ncols
@@ -626,6 +1059,16 @@ def execute(demdataset,
         cellsize = 0.5 * (demsource.meanCellHeight + demsource.meanCellWidth)
 
         bufferpixelwidth = math.ceil(max(demsource.width, demsource.height) / (max(nrows, ncols) * 10))
+
+        is_global = is_global and is_tiled and flowdir == None
+        if is_global:
+            # accumulation is not cut at tile edges, overlap has to cover only filtering windows
+            filterpixelwidth = math.ceil(widendist / cellsize) if is_widen else 0
+            bufferpixelwidth = max(math.ceil(bufferpixelwidth / 4.0), filterpixelwidth, filtersize, 1)
+
+        # details smaller than half of the output cell are not kept in TIN constraint lines
+        tolerance = 0.5 * outputcellsize
+
         bufferwidth = bufferpixelwidth * cellsize
         overlap = bufferwidth * 2
 
@@ -698,22 +1141,18 @@ def execute(demdataset,
                 arcpy.CopyRaster_management(demdataset, scratchworkspace + "/source/dem0.tif")
                 oids = [1]
 
+        if is_global:
+            arcpy.AddMessage('COMPUTING FLOW DIRECTION AND ACCUMULATION FOR THE WHOLE DEM')
+            flowdir, flowacc = global_hydrology(demdataset, scratchworkspace, int(tile_size), engine,
+                                                is_parallel, num_processes)
+
         # PERFORM PROCESSING
 
         jobs = []
 
         if is_parallel and is_tiled:
 
-            nproc = multiprocessing.cpu_count()
-
-            if 0 < num_processes < 1:
-                nproc = int(math.ceil(nproc * num_processes))
-            elif num_processes < 0:
-                nproc = int(math.floor(nproc - num_processes))
-                if nproc < 1:
-                    nproc = 1
-            elif num_processes >= 1:
-                nproc = int(math.ceil(num_processes))
+            nproc = Utils.get_nproc(num_processes)
 
             arcpy.AddMessage('> Trying to make multiprocessing using ' + str(nproc) + ' processor cores')
             arcpy.AddMessage('')
@@ -736,7 +1175,10 @@ def execute(demdataset,
                        repeat(widendist),
                        repeat(filtersize),
                        repeat(is_smooth),
-                       repeat(scratchworkspace))
+                       repeat(scratchworkspace),
+                       repeat(engine),
+                       repeat(tolerance),
+                       repeat(cache))
 
             results = pool.map(call_list, args)
 
@@ -772,7 +1214,10 @@ def execute(demdataset,
                                  widendist,
                                  filtersize,
                                  is_smooth,
-                                 scratchworkspace))
+                                 scratchworkspace,
+                                 engine,
+                                 tolerance,
+                                 cache))
             falseoids = []
             for state, oid in zip(jobs, oids):
                 if state == False:
@@ -856,12 +1301,16 @@ if __name__ == '__main__':
     is_tiled = True if arcpy.GetParameterAsText(17) == 'true' else False
     tile_size = arcpy.GetParameterAsText(18)
     is_parallel = True if arcpy.GetParameterAsText(19) == 'true' else False
-    num_processes = int(arcpy.GetParameterAsText(20))
+    num_processes = float(arcpy.GetParameterAsText(20))
     is_continued = True if arcpy.GetParameterAsText(21) == 'true' else False
     continued_folder = arcpy.GetParameterAsText(22)
+    engine = arcpy.GetParameterAsText(23) or 'ARCGIS'
+    is_global = True if arcpy.GetParameterAsText(24) == 'true' else False
+    is_aggregated = True if arcpy.GetParameterAsText(25) == 'true' else False
+    cache_size = int(arcpy.GetParameterAsText(26)) if arcpy.GetParameterAsText(26) else 0
 
     execute(demdataset, output, flowdir, flowacc, flines, fpolys, cliparea,
             outputcellsize, minacc1, minlen1, minacc2, minlen2,
             is_widen, widentype, widendist, filtersize,
             is_smooth, is_tiled, tile_size, is_parallel, num_processes,
-            is_continued, continued_folder)
\ No newline at end of file
+            is_continued, continued_folder, engine, is_global, is_aggregated, cache_size)
\ No newline at end of file
@@ -0,0 +1,633 @@
+# -*- coding: cp1251 -*-
+# Hydrological processing of DEM arrays without Spatial Analyst.
+# NoData cells are NaN, results are compatible with ArcGIS Fill
+# 2020, Timofey Samsonov, Lomonosov Moscow State University
+import heapq
+import numpy
+from scipy import ndimage
+
+__author__ = 'Timofey Samsonov'
+
+can_use_numba = True
+
+try:
+    from numba import njit
+except:
+    can_use_numba = False
+
+def compiled(func):
+    # kernels are plain Python, compiled if numba is available
+    return njit(cache=True)(func) if can_use_numba else func
+
+# D8 neighbours: row and column shifts
+DI = numpy.array([-1, -1, 0, 1, 1, 1, 0, -1])
+DJ = numpy.array([0, 1, 1, 1, 0, -1, -1, -1])
+
+def edge_cells(nodata):
+    # cells which drain outside: raster edges and neighbours of NoData
+    edges = ndimage.binary_dilation(nodata, structure=numpy.ones((3, 3), dtype=bool))
+    edges[0, :] = True
+    edges[-1, :] = True
+    edges[:, 0] = True
+    edges[:, -1] = True
+    return numpy.flatnonzero(edges & ~nodata)
+
+@compiled
+def priority_flood(z, closed, seeds, ni, nj, epsilon, labels, sources):
+    # Priority-Flood of Barnes et al. (2014) with a pit queue,
+    # z is flattened and filled in place, closed is True for NoData.
+    # If labels are given, unlabelled cells (-1) take the label of the cell they are flooded from
+    # and labelled cells are flooded only from cells with the same label.
+    # If sources are given, they get the cell each cell is flooded from
+    n = ni * nj
+    up = numpy.full(1, numpy.inf, dtype=z.dtype)
+    pit = numpy.empty(n, dtype=numpy.int64)
+    head = 0
+    tail = 0
+
+    heap = [(z[seeds[0]], seeds[0])]
+    closed[seeds[0]] = True
+    for k in range(1, len(seeds)):
+        heap.append((z[seeds[k]], seeds[k]))
+        closed[seeds[k]] = True
+    heapq.heapify(heap)
+
+    while len(heap) > 0 or head < tail:
+        if head < tail and not (len(heap) > 0 and heap[0][0] == z[pit[head]]):
+            c = pit[head]
+            head += 1
+        else:
+            c = heapq.heappop(heap)[1]
+            if head == tail:
+                head = 0
+                tail = 0
+
+        zc = z[c]
+        if epsilon:
+            zc = numpy.nextafter(zc, up[0])
+
+        i = c // nj
+        j = c % nj
+        for k in range(8):
+            ik = i + DI[k]
+            jk = j + DJ[k]
+            if ik < 0 or ik >= ni or jk < 0 or jk >= nj:
+                continue
+            nb = ik * nj + jk
+            if closed[nb]:
+                continue
+            if len(labels) > 0:
+                if labels[nb] < 0:
+                    labels[nb] = labels[c]
+                elif labels[nb] != labels[c]:
+                    continue
+            if len(sources) > 0:
+                sources[nb] = c
+            closed[nb] = True
+            if z[nb] <= zc:
+                z[nb] = zc
+                pit[tail] = nb
+                tail += 1
+            else:
+                heapq.heappush(heap, (z[nb], nb))
+
+def fill_depressions(dem, epsilon=False):
+    # depressionless DEM, with epsilon flats get a tiny gradient towards outlets
+    z = numpy.array(dem, copy=True)
+    nodata = numpy.isnan(z)
+    seeds = edge_cells(nodata)
+    if len(seeds) > 0:
+        none = numpy.empty(0, dtype=numpy.int64)
+        priority_flood(z.ravel(), nodata.ravel(), seeds, z.shape[0], z.shape[1], epsilon, none, none)
+    return z
+
+# D8 codes of ArcGIS for the neighbours above and the distances to them
+CODES = numpy.array([64, 128, 1, 2, 4, 8, 16, 32], dtype=numpy.uint8)
+DIST = numpy.array([1, numpy.sqrt(2), 1, numpy.sqrt(2), 1, numpy.sqrt(2), 1, numpy.sqrt(2)])
+
+# neighbour number for every D8 code
+NEIGHBOUR = numpy.zeros(256, dtype=numpy.int64)
+NEIGHBOUR[CODES] = numpy.arange(8)
+
+def shifted(a, di, dj, fill):
+    # value of the neighbour (i + di, j + dj) for every cell (i, j)
+    ni, nj = a.shape
+    out = numpy.full(a.shape, fill, dtype=a.dtype)
+    out[max(-di, 0):ni - max(di, 0), max(-dj, 0):nj - max(dj, 0)] = \
+        a[max(di, 0):ni + min(di, 0), max(dj, 0):nj + min(dj, 0)]
+    return out
+
+def resolve_flats(z, dirs, nodata):
+    # cells without downslope neighbours drain to the equal neighbours which already drain,
+    # flats are crossed in breadth-first order from their outlets
+    ni, nj = z.shape
+    unresolved = (dirs == 0) & ~nodata
+    if not unresolved.any():
+        return dirs
+
+    zf = z.ravel()
+    d = dirs.ravel()
+    un = unresolved.ravel()
+
+    near = ndimage.binary_dilation(unresolved, structure=numpy.ones((3, 3), dtype=bool))
+    frontier = numpy.flatnonzero(near & ~unresolved & ~nodata)
+
+    while len(frontier) > 0:
+        fi = frontier // nj
+        fj = frontier % nj
+        new = []
+        for k in range(8):
+            i = fi + DI[k]
+            j = fj + DJ[k]
+            inside = (i >= 0) & (i < ni) & (j >= 0) & (j < nj)
+            nb = i[inside] * nj + j[inside]
+            src = frontier[inside]
+
+            flows = un[nb] & (zf[nb] >= zf[src])
+            nb = nb[flows]
+            d[nb] = CODES[(k + 4) % 8]
+            un[nb] = False
+            new.append(nb)
+        frontier = numpy.unique(numpy.concatenate(new))
+
+    return dirs
+
+def steepest_descent(z):
+    # D8 steepest descent with ArcGIS codes, 0 for NoData, flats and sinks.
+    # Cells at edges and near NoData flow outside if they have no lower neighbours
+    nodata = numpy.isnan(z)
+    dirs = numpy.zeros(z.shape, dtype=numpy.uint8)
+    best = numpy.zeros(z.shape)
+
+    outside = []
+    for k in range(8):
+        zn = shifted(z, DI[k], DJ[k], numpy.nan)
+        drop = (z - zn) / DIST[k]
+        steeper = drop > best
+        best[steeper] = drop[steeper]
+        dirs[steeper] = CODES[k]
+        outside.append(numpy.isnan(zn))
+
+    for k in range(8):
+        edge = (dirs == 0) & outside[k] & ~nodata
+        dirs[edge] = CODES[k]
+
+    return dirs
+
+def flow_direction(z):
+    # D8 steepest descent with flats resolved, 0 for NoData and unresolved sinks
+    return resolve_flats(z, steepest_descent(z), numpy.isnan(z))
+
+def receivers(dirs, nodata=None):
+    # flattened index of the downstream cell, -1 where flow leaves the raster or stops
+    ni, nj = dirs.shape
+    rec = numpy.full(ni * nj, -1, dtype=numpy.int64)
+    for k in range(8):
+        i, j = numpy.nonzero(dirs == CODES[k])
+        ik = i + DI[k]
+        jk = j + DJ[k]
+        inside = (ik >= 0) & (ik < ni) & (jk >= 0) & (jk < nj)
+        rec[i[inside] * nj + j[inside]] = ik[inside] * nj + jk[inside]
+
+    if nodata is not None:
+        flows = rec >= 0
+        rec[flows] = numpy.where(nodata.ravel()[rec[flows]], -1, rec[flows])
+
+    return rec
+
+def group_sum(keys, values):
+    # unique keys with the sums and counts of their values
+    order = numpy.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    starts = numpy.concatenate(([0], numpy.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    counts = numpy.diff(numpy.concatenate((starts, [len(keys)])))
+    return keys[starts], numpy.add.reduceat(values[order], starts), counts
+
+def flow_accumulation(dirs, nodata=None, weights=None):
+    # number (or weight) of upstream cells as ArcGIS FlowAccumulation gives,
+    # cells are visited level by level in topological order of Kahn algorithm
+    rec = receivers(dirs, nodata)
+    n = len(rec)
+    w = numpy.ones(n) if weights is None else numpy.nan_to_num(weights.ravel().astype(numpy.float64))
+
+    donors = numpy.bincount(rec[rec >= 0], minlength=n).astype(numpy.int32)
+    acc = numpy.zeros(n)
+
+    frontier = numpy.flatnonzero(donors == 0)
+    while len(frontier) > 0:
+        frontier = frontier[rec[frontier] >= 0]
+        if len(frontier) == 0:
+            break
+        r, inflow, counts = group_sum(rec[frontier], acc[frontier] + w[frontier])
+        acc[r] += inflow
+        donors[r] -= counts.astype(numpy.int32)
+        frontier = r[donors[r] == 0]
+
+    return acc.reshape(dirs.shape)
+
+def pointer_ends(rec):
+    # last cell of the flow path from every cell, found by pointer doubling
+    ends = numpy.where(rec < 0, numpy.arange(len(rec)), rec)
+    while True:
+        nxt = ends[ends]
+        if numpy.array_equal(nxt, ends):
+            return ends
+        ends = nxt
+
+def perimeter(shape):
+    # flattened indices of the cells on the tile perimeter
+    mask = numpy.zeros(shape, dtype=bool)
+    mask[0, :] = True
+    mask[-1, :] = True
+    mask[:, 0] = True
+    mask[:, -1] = True
+    return numpy.flatnonzero(mask)
+
+def tile_links(dirs, nodata, r0, c0, shape):
+    # local accumulation of a tile with upper left cell (r0, c0) in a raster of the given shape,
+    # and its perimeter graph (Barnes, 2017): global indices of perimeter cells, their local
+    # accumulation and validity, the next perimeter cell of their flow and whether it lies in another tile
+    ni, nj = dirs.shape
+    acc = flow_accumulation(dirs, nodata)
+    ends = pointer_ends(receivers(dirs, nodata))
+
+    p = perimeter(dirs.shape)
+    nodes = (r0 + p // nj) * shape[1] + c0 + p % nj
+
+    # flow leaving the tile from the end cell of the path
+    e = ends[p]
+    codes = dirs.ravel()[e]
+    k = NEIGHBOUR[codes]
+    ei = r0 + e // nj + DI[k]
+    ej = c0 + e % nj + DJ[k]
+    cross = (codes > 0) & ~nodata.ravel()[e] & \
+            ((ei < r0) | (ei >= r0 + ni) | (ej < c0) | (ej >= c0 + nj)) & \
+            (ei >= 0) & (ei < shape[0]) & (ej >= 0) & (ej < shape[1])
+
+    succ = numpy.where(e != p, (r0 + e // nj) * shape[1] + c0 + e % nj, -1)
+    cross &= e == p
+    succ[cross] = ei[cross] * shape[1] + ej[cross]
+
+    return acc, (nodes, acc.ravel()[p], ~nodata.ravel()[p], succ, cross)
+
+def perimeter_inflow(nodes, acc, valid, succ, cross):
+    # inflow from upstream tiles into every perimeter cell, solved on the perimeter graph of all tiles
+    order = numpy.argsort(nodes)
+    nodes = nodes[order]
+    n = len(nodes)
+
+    pos = numpy.minimum(numpy.searchsorted(nodes, succ[order]), n - 1)
+    found = (succ[order] >= 0) & (nodes[pos] == succ[order]) & valid[order] & valid[order][pos]
+    target = numpy.where(found, pos, -1)
+
+    acc = acc[order]
+    cross = cross[order]
+    donors = numpy.bincount(target[target >= 0], minlength=n)
+    extra = numpy.zeros(n)
+    inflow = numpy.zeros(n)
+
+    frontier = numpy.flatnonzero(donors == 0)
+    while len(frontier) > 0:
+        frontier = frontier[target[frontier] >= 0]
+        if len(frontier) == 0:
+            break
+
+        # whole upstream area passes to the next tile, only the inflow passes within the tile
+        contrib = numpy.where(cross[frontier], acc[frontier] + extra[frontier] + 1, extra[frontier])
+        t, s, counts = group_sum(target[frontier], contrib)
+        extra[t] += s
+
+        c = frontier[cross[frontier]]
+        if len(c) > 0:
+            tc, sc, _ = group_sum(target[c], contrib[cross[frontier]])
+            inflow[tc] += sc
+
+        donors[t] -= counts
+        frontier = t[donors[t] == 0]
+
+    result = numpy.empty(n)
+    result[order] = inflow
+    return result
+
+def add_inflow(dirs, nodata, acc, inflow):
+    # global accumulation of a tile from its local accumulation and the inflow into its perimeter cells
+    w = numpy.zeros(dirs.shape)
+    w.ravel()[perimeter(dirs.shape)] = inflow
+    return acc + flow_accumulation(dirs, nodata, w) + w
+
+def outlets(zh):
+    # cells of a tile with a one cell halo (NaN outside the raster) which drain outside:
+    # raster edges and neighbours of NoData
+    return ndimage.binary_dilation(numpy.isnan(zh), structure=numpy.ones((3, 3), dtype=bool))[1:-1, 1:-1] & \
+           ~numpy.isnan(zh[1:-1, 1:-1])
+
+def global_cells(cells, r0, c0, nj, shape):
+    # flattened indices of tile cells in the raster
+    return (r0 + cells // nj) * shape[1] + c0 + cells % nj
+
+def spill_edges(a, b, spill, ca, cb):
+    # lowest spill between every pair of labels and the cells on both sides of it
+    if len(a) == 0:
+        return a, b, spill, ca, cb
+    lo = numpy.minimum(a, b)
+    hi = numpy.maximum(a, b)
+    key = lo * (hi.max() + 1) + hi
+    order = numpy.lexsort((spill, key))
+    first = order[numpy.concatenate(([True], key[order][1:] != key[order][:-1]))]
+    return a[first], b[first], spill[first], ca[first], cb[first]
+
+def tile_fill(zh, r0, c0, shape):
+    # depressions of a tile filled from its perimeter (Barnes et al., 2016). zh has a one cell halo,
+    # NaN outside the raster. Cells draining outside the raster get label 0, other perimeter cells
+    # start labels 1, 2, ... which are passed over the cells they flood.
+    # Returns filled tile, labels (-1 for NoData) and the spill graph: number of labels,
+    # spill edges between labels and the perimeter cells with their elevations and labels
+    z = zh[1:-1, 1:-1].copy()
+    ni, nj = z.shape
+    nodata = numpy.isnan(z)
+    ocean = outlets(zh)
+
+    edge = numpy.zeros(z.shape, dtype=bool)
+    edge.ravel()[perimeter(z.shape)] = True
+    seeds = numpy.flatnonzero((edge | ocean) & ~nodata)
+
+    labels = numpy.full(z.shape, -1, dtype=numpy.int64)
+    starts = seeds[~ocean.ravel()[seeds]]
+    labels.ravel()[ocean.ravel()] = 0
+    labels.ravel()[starts] = numpy.arange(1, len(starts) + 1)
+
+    if len(seeds) > 0:
+        priority_flood(z.ravel(), nodata.ravel().copy(), seeds, ni, nj, False, labels.ravel(),
+                       numpy.empty(0, dtype=numpy.int64))
+
+    # neighbours with different labels, every pair is visited once
+    idx = numpy.arange(ni * nj).reshape(ni, nj)
+    edges = []
+    for k in range(4):
+        lb = shifted(labels, DI[k], DJ[k], -1)
+        sel = (labels >= 0) & (lb >= 0) & (labels != lb)
+        edges.append((labels[sel], lb[sel], numpy.maximum(z[sel], shifted(z, DI[k], DJ[k], numpy.nan)[sel]),
+                      idx[sel], shifted(idx, DI[k], DJ[k], -1)[sel]))
+    a, b, spill, ca, cb = spill_edges(*[numpy.concatenate([e[i] for e in edges]) for i in range(5)])
+
+    p = perimeter(z.shape)
+    p = p[~nodata.ravel()[p]]
+    border = (global_cells(p, r0, c0, nj, shape), z.ravel()[p], labels.ravel()[p])
+
+    return z, labels, (len(starts), (a, b, spill, global_cells(ca, r0, c0, nj, shape),
+                                     global_cells(cb, r0, c0, nj, shape)), border)
+
+@compiled
+def minimax_flood(n, starts, targets, weights, edges):
+    # lowest level at which every label drains to label 0 and the edge it drains through
+    levels = numpy.full(n, numpy.inf)
+    via = numpy.full(n, -1, dtype=numpy.int64)
+    done = numpy.zeros(n, dtype=numpy.bool_)
+    levels[0] = -numpy.inf
+    heap = [(levels[0], numpy.int64(0))]
+    while len(heap) > 0:
+        w, u = heapq.heappop(heap)
+        if done[u]:
+            continue
+        done[u] = True
+        for p in range(starts[u], starts[u + 1]):
+            v = targets[p]
+            level = max(w, weights[p])
+            if level < levels[v]:
+                levels[v] = level
+                via[v] = edges[p]
+                heapq.heappush(heap, (level, v))
+    return levels, via
+
+def spill_levels(links, shape):
+    # water levels of the labels of all tiles solved on their spill graph.
+    # For every tile returns the levels of its labels, the cells through which they spill
+    # and the cells they spill into (-1 for label 0)
+    counts = [l[0] for l in links]
+    offsets = numpy.cumsum([0] + counts)[:-1]
+
+    def relabel(labels, offset):
+        return numpy.where(labels > 0, labels + offset, labels)
+
+    edges = [[relabel(l[1][0], o), relabel(l[1][1], o)] + list(l[1][2:]) for l, o in zip(links, offsets)]
+    nodes, z, labels = [numpy.concatenate(x) for x in
+                        zip(*[(l[2][0], l[2][1], relabel(l[2][2], o)) for l, o in zip(links, offsets)])]
+
+    # perimeter cells of neighbouring tiles
+    order = numpy.argsort(nodes)
+    nodes = nodes[order]
+    z = z[order]
+    labels = labels[order]
+    n = len(nodes)
+    for k in range(4):
+        i = nodes // shape[1] + DI[k]
+        j = nodes % shape[1] + DJ[k]
+        q = i * shape[1] + j
+        pos = numpy.minimum(numpy.searchsorted(nodes, q), max(n - 1, 0))
+        found = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1]) & (nodes[pos] == q) & (labels != labels[pos])
+        edges.append([labels[found], labels[pos[found]], numpy.maximum(z[found], z[pos[found]]),
+                      nodes[found], nodes[pos[found]]])
+
+    a, b, spill, ca, cb = spill_edges(*[numpy.concatenate([e[i] for e in edges]) for i in range(5)])
+
+    nlabels = 1 + sum(counts)
+    ends = numpy.concatenate((a, b))
+    order = numpy.argsort(ends, kind='mergesort')
+    starts = numpy.searchsorted(ends[order], numpy.arange(nlabels + 1))
+    targets = numpy.concatenate((b, a))[order]
+    weights = numpy.concatenate((spill, spill))[order]
+    ids = numpy.concatenate((numpy.arange(len(a)), numpy.arange(len(a))))[order]
+    levels, via = minimax_flood(nlabels, starts, targets, weights, ids)
+
+    # cell of the label and cell of the next label on the spill edge
+    cells = numpy.full(nlabels, -1, dtype=numpy.int64)
+    targets = numpy.full(nlabels, -1, dtype=numpy.int64)
+    lab = numpy.flatnonzero(via >= 0)
+    e = via[lab]
+    own = a[e] == lab
+    cells[lab] = numpy.where(own, ca[e], cb[e])
+    targets[lab] = numpy.where(own, cb[e], ca[e])
+
+    spills = []
+    for o, m in zip(offsets, counts):
+        sel = numpy.concatenate(([0], numpy.arange(o + 1, o + m + 1)))
+        spills.append((levels[sel], cells[sel], targets[sel]))
+    return spills
+
+# D8 code for the shift (di + 1) * 3 + dj + 1
+SHIFT_CODES = numpy.zeros(9, dtype=numpy.uint8)
+SHIFT_CODES[(DI + 1) * 3 + DJ + 1] = CODES
+
+def tile_drain(z, labels, ocean, spills, r0, c0, shape):
+    # tile raised to the water levels of its labels and the D8 codes along which its flats drain:
+    # every label is flooded from the cell through which it spills, cells of label 0 from the raster outlets
+    levels, cells, targets = spills
+    ni, nj = z.shape
+    z = numpy.maximum(z, levels[numpy.maximum(labels, 0)])
+
+    spill = cells >= 0
+    i = cells[spill] // shape[1]
+    j = cells[spill] % shape[1]
+    local = (i - r0) * nj + j - c0
+    seeds = numpy.concatenate((numpy.flatnonzero(ocean), local)).astype(numpy.int64)
+
+    sources = numpy.full(ni * nj, -1, dtype=numpy.int64)
+    if len(seeds) > 0:
+        priority_flood(z.ravel(), numpy.isnan(z).ravel(), seeds, ni, nj, False, labels.ravel().copy(), sources)
+
+    codes = numpy.zeros(ni * nj, dtype=numpy.uint8)
+    flooded = numpy.flatnonzero(sources >= 0)
+    codes[flooded] = SHIFT_CODES[(sources[flooded] // nj - flooded // nj + 1) * 3 +
+                                 sources[flooded] % nj - flooded % nj + 1]
+    codes[local] = SHIFT_CODES[(targets[spill] // shape[1] - i + 1) * 3 + targets[spill] % shape[1] - j + 1]
+
+    return z, codes.reshape(z.shape)
+
+def expand(mask, cells):
+    # mask expanded by the number of cells in all eight directions, as ArcGIS Expand does
+    if cells < 1:
+        return mask.copy()
+    return ndimage.binary_dilation(mask, structure=numpy.ones((3, 3), dtype=bool), iterations=int(cells))
+
+def stream_outlets(streams, dirs):
+    # stream cells which drain outside the stream mask: downstream ends of stream segments
+    rec = receivers(dirs)
+    s = streams.ravel()
+    inside = s & (rec >= 0)
+    inside[inside] = s[rec[inside]]
+    return streams & ~inside.reshape(streams.shape)
+
+def stream_lines(streams, dirs):
+    # stream cells chained along D8 pointers into lines split at confluences, ordered downstream.
+    # Each line ends in the first cell of the line it flows into, which is given by downstream (-1 for outlets)
+    ni, nj = streams.shape
+    rec = receivers(dirs)
+    s = streams.ravel()
+    inside = s & (rec >= 0)
+    inside[inside] = s[rec[inside]]
+    rec = numpy.where(inside, rec, -1)
+
+    donors = numpy.bincount(rec[rec >= 0], minlength=len(s))
+    heads = numpy.flatnonzero(s & (donors != 1))
+    index = numpy.full(len(s), -1, dtype=numpy.int64)
+    index[heads] = numpy.arange(len(heads))
+
+    rec = rec.tolist()
+    start = (index >= 0).tolist()
+    lines = []
+    ends = []
+    for h in heads.tolist():
+        cells = [h]
+        c = rec[h]
+        while c >= 0 and not start[c]:
+            cells.append(c)
+            c = rec[c]
+        if c >= 0:
+            cells.append(c)
+        ends.append(c)
+        lines.append(numpy.column_stack(numpy.divmod(cells, nj)))
+
+    ends = numpy.array(ends, dtype=numpy.int64)
+    downstream = numpy.where(ends >= 0, index[numpy.maximum(ends, 0)], -1)
+
+    return lines, downstream
+
+def pour_points(mask):
+    # unique positive labels of the marked cells, 0 elsewhere
+    labels = numpy.cumsum(mask.ravel()).reshape(mask.shape)
+    return numpy.where(mask, labels, 0).astype(numpy.int32)
+
+def upstream_levels(rec):
+    # cells grouped by the number of steps to their outlets: outlets first, then their donors and so on
+    n = len(rec)
+    flows = numpy.flatnonzero(rec >= 0)
+    donors = flows[numpy.argsort(rec[flows], kind='mergesort')]
+    starts = numpy.searchsorted(rec[donors], numpy.arange(n + 1))
+
+    levels = []
+    level = numpy.flatnonzero(rec < 0)
+    while len(level) > 0:
+        levels.append(level)
+        counts = starts[level + 1] - starts[level]
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        level = donors[numpy.repeat(starts[level], counts) + offsets]
+
+    return levels
+
+def watersheds(rec, levels, seeds):
+    # labels of seed cells passed upstream through the donor graph in one sweep over levels,
+    # 0 for cells which do not drain to any seed
+    s = seeds.ravel()
+    labels = numpy.zeros(len(rec), dtype=s.dtype)
+    for level in levels:
+        up = rec[level]
+        inherited = numpy.where(up >= 0, labels[up], 0)
+        labels[level] = numpy.where(s[level] > 0, s[level], inherited)
+    return labels.reshape(seeds.shape)
+
+def basins(rec, levels, nodata):
+    # watersheds of all outlets: cells draining outside the raster, to NoData or into sinks
+    outlets = (rec < 0).reshape(nodata.shape) & ~nodata
+    return watersheds(rec, levels, pour_points(outlets))
+
+def snap_pour_points(pours, acc, radius):
+    # every pour point moves to the cell of maximum accumulation within radius (in cells),
+    # the nearest one in case of ties
+    ni, nj = pours.shape
+    r = int(numpy.ceil(radius))
+    di, dj = numpy.mgrid[-r:r + 1, -r:r + 1]
+    dist = (di ** 2 + dj ** 2).ravel()
+    order = numpy.argsort(dist, kind='mergesort')
+    order = order[dist[order] <= radius ** 2]
+    di = di.ravel()[order]
+    dj = dj.ravel()[order]
+
+    i, j = numpy.nonzero(pours > 0)
+    ii = i[:, numpy.newaxis] + di
+    jj = j[:, numpy.newaxis] + dj
+    inside = (ii >= 0) & (ii < ni) & (jj >= 0) & (jj < nj)
+
+    a = numpy.where(inside, acc[numpy.clip(ii, 0, ni - 1), numpy.clip(jj, 0, nj - 1)], -numpy.inf)
+    a[numpy.isnan(a)] = -numpy.inf
+    best = numpy.argmax(a, axis=1)
+    k = numpy.arange(len(i))
+
+    snapped = numpy.zeros(pours.shape, dtype=pours.dtype)
+    snapped[ii[k, best], jj[k, best]] = pours[i, j]
+    return snapped
+
+def halved(sums, counts, mins):
+    # next level of the pyramid: 2 x 2 blocks of cells, odd rows and columns are padded with empty cells
+    ni = sums.shape[0] + sums.shape[0] % 2
+    nj = sums.shape[1] + sums.shape[1] % 2
+    out = []
+    for a, fill, func in ((sums, 0, numpy.sum), (counts, 0, numpy.sum), (mins, numpy.inf, numpy.min)):
+        padded = numpy.full((ni, nj), fill, dtype=a.dtype)
+        padded[:a.shape[0], :a.shape[1]] = a
+        out.append(func(padded.reshape(ni // 2, 2, nj // 2, 2), axis=(1, 3)))
+    return out
+
+def pyramid(dem, levels):
+    # sums, counts and minima of valid cells in blocks of 2 ** levels x 2 ** levels cells
+    nodata = numpy.isnan(dem)
+    sums = numpy.where(nodata, 0, dem)
+    counts = (~nodata).astype(numpy.int64)
+    mins = numpy.where(nodata, numpy.inf, dem)
+    for k in range(levels):
+        sums, counts, mins = halved(sums, counts, mins)
+    return sums, counts, mins
+
+def aggregate(bands, levels, minacc):
+    # DEM coarsened 2 ** levels times by the min/mean pyramid: block means keep the relief,
+    # block minima are kept in channels draining at least minacc coarse cells, so averaging does not dam valleys.
+    # DEM is given by bands of rows from the top, all bands but the last have a multiple of 2 ** levels rows
+    sums, counts, mins = [numpy.vstack(a) for a in zip(*[pyramid(band, levels) for band in bands])]
+
+    empty = counts == 0
+    mean = numpy.where(empty, numpy.nan, sums / numpy.maximum(counts, 1))
+    low = numpy.where(empty, numpy.nan, mins)
+
+    dirs = flow_direction(fill_depressions(low))
+    channels = flow_accumulation(dirs, empty) >= minacc
+
+    return numpy.where(channels, low, mean)
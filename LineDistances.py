@@ -7,39 +7,42 @@ import numpy
 import Utils
 from scipy.spatial.distance import cdist
 
-def execute(in_hydrolines, hydro_field, in_counterparts, count_field, deviation, out_table):
+def distance_pair(args):
+    count_coords, hydro_coords = args
 
-    coords_hydro = Utils.get_coordinates(in_hydrolines)
-    coords_count = Utils.get_coordinates(in_counterparts)
-    id_hydro = Utils.get_values(in_hydrolines, hydro_field)
-    id_count = Utils.get_values(in_counterparts, count_field)
+    frechet = Utils.frechet_dist(count_coords, hydro_coords)
+    haus, haus_forw, haus_back, _ = Utils.hausdorff_dists(count_coords, hydro_coords)
 
-    arcpy.CreateTable_management(os.path.dirname(out_table), os.path.basename(out_table))
+    return frechet, haus, haus_forw, haus_back
 
-    arcpy.AddField_management(out_table, 'ID', 'FLOAT', field_length=16)
-    arcpy.AddField_management(out_table, 'frechet', 'FLOAT', field_length=16)
-    arcpy.AddField_management(out_table, 'hausdorff', 'FLOAT', field_length=16)
-    arcpy.AddField_management(out_table, 'hausdorff_forw', 'FLOAT', field_length=16)
-    arcpy.AddField_management(out_table, 'hausdorff_back', 'FLOAT', field_length=16)
-    arcpy.AddField_management(out_table, 'quality', 'TEXT', field_length=16)
+def execute(in_hydrolines, hydro_field, in_counterparts, count_field, deviation, out_table,
+            is_parallel=False, num_processes=0):
 
-    N = len(id_hydro)
-    idx = []
-    for i in range(N):
-        idx.append(numpy.where(id_count == id_hydro[i])[0])
+    hydro_xy, hydro_offsets, id_hydro, _ = Utils.get_vertices(in_hydrolines, hydro_field)
+    count_xy, count_offsets, id_count, _ = Utils.get_vertices(in_counterparts, count_field)
 
-    coords_count = [coords_count[i] for i in idx]
+    # features without geometry have no distances
+    joined = [(h, c) for h, c in Utils.join_by_keys(id_hydro, id_count)
+              if hydro_offsets[h + 1] > hydro_offsets[h] and count_offsets[c + 1] > count_offsets[c]]
 
-    insertcursor = arcpy.da.InsertCursor(out_table, ['ID', 'frechet', 'hausdorff', 'hausdorff_forw', 'hausdorff_back', 'quality'])
+    # hydrolines without counterparts are missing from the table
+    matched = set(id_hydro[h] for h, c in joined)
+    missing = [id for id in id_hydro if id not in matched]
+    if len(missing) > 0:
+        arcpy.AddWarning(str(len(missing)) + ' hydrolines have no counterparts and are not in the table: ' +
+                         ', '.join(str(id) for id in missing))
 
-    for i in range(N):
-        id = id_hydro[i]
-        arcpy.AddMessage('ID = ' + str(id))
+    args = ((Utils.get_line(count_xy, count_offsets, c), Utils.get_line(hydro_xy, hydro_offsets, h))
+            for h, c in joined)
+
+    N = len(joined)
+    table = numpy.zeros(N, dtype=[('ID', 'f4'), ('frechet', 'f4'), ('hausdorff', 'f4'),
+                                  ('hausdorff_forw', 'f4'), ('hausdorff_back', 'f4'), ('quality', 'U16')])
 
-        frechet = Utils.frechet_dist(coords_count[i], coords_hydro[i])
-        haus = Utils.hausdorff_dist(coords_count[i], coords_hydro[i])
-        haus_forw = Utils.hausdorff_dist_dir(coords_count[i], coords_hydro[i])
-        haus_back = Utils.hausdorff_dist_dir(coords_hydro[i], coords_count[i])
+    for i, (frechet, haus, haus_forw, haus_back) in enumerate(Utils.imap_parallel(distance_pair, args,
+                                                                                  is_parallel, num_processes)):
+        id = id_hydro[joined[i][0]]
+        arcpy.AddMessage('ID = ' + str(id))
 
         quality = 'Unknown'
 
@@ -50,7 +53,9 @@ def execute(in_hydrolines, hydro_field, in_counterparts, count_field, deviation,
         elif haus_forw <= deviation:
             quality = 'Weak'
 
-        insertcursor.insertRow([id, frechet, haus, haus_forw, haus_back, quality])
+        table[i] = (id, frechet, haus, haus_forw, haus_back, quality)
+
+    arcpy.da.NumPyArrayToTable(table, out_table)
 
     return
 
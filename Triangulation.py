@@ -0,0 +1,138 @@
+# -*- coding: cp1251 -*-
+# In-memory TIN from 3D lines and its rasterization without 3D Analyst.
+# Constraint lines are densified, so that Delaunay edges follow them (conforming triangulation).
+# Linear interpolation does not bend the surface at softlines, so hardlines and softlines differ
+# only by densification, softreplace polygons are interpolated from their boundaries
+# 2020, Timofey Samsonov, Lomonosov Moscow State University
+import numpy
+import Utils
+from scipy.spatial import Delaunay
+
+__author__ = 'Timofey Samsonov'
+
+# surface feature types of CreateTin used for constraint lines
+SURFACE_TYPES = ['hardline', 'softline', 'softreplace']
+
+def line_points(lines, step):
+    # unique vertices of densified lines with their heights
+    parts = [line[:, :3] for line in lines if len(line) > 0]
+    if len(parts) == 0:
+        return numpy.empty((0, 3))
+
+    xyz = numpy.vstack([Utils.densify(line, step) for line in parts])
+    xyz = xyz[numpy.isfinite(xyz[:, 2])]
+    _, first = numpy.unique(xyz[:, 0] + 1j * xyz[:, 1], return_index=True)
+    return xyz[numpy.sort(first)]
+
+def line_keys(lines, xmin, ymax, cellsize, shape):
+    # unique cells crossed by each line, cells are flattened indices
+    keys = []
+    for line in lines:
+        rows, cols = Utils.line_cells(line, xmin, ymax, cellsize, shape)
+        keys.append(numpy.unique(rows * shape[1] + cols))
+    return keys
+
+def simplify_lines(lines, tolerance, xmin, ymax, cellsize, shape, fixed=()):
+    # Douglas-Peucker simplification of lines which keeps them from crossing each other and fixed lines:
+    # a simplified line which enters a cell of another line, where the original line is absent,
+    # is restored, until no new contacts remain
+    lines = list(lines)
+    n = len(lines)
+    simplified = [Utils.simplify(line, tolerance) for line in lines]
+    restored = numpy.array([len(a) == len(b) for a, b in zip(simplified, lines)], dtype=bool)
+
+    # cells of the lines are found once, each pass moves the restored lines
+    # from the cells of their simplified versions back to the original cells
+    original = line_keys(lines + list(fixed), xmin, ymax, cellsize, shape)
+    candidates = numpy.flatnonzero(~restored)
+    reduced = dict(zip(candidates, line_keys([simplified[k] for k in candidates], xmin, ymax, cellsize, shape)))
+    entered = [numpy.setdiff1d(reduced[k], original[k], assume_unique=True) for k in candidates]
+
+    empty = numpy.zeros(0, dtype=int)
+    cells = numpy.unique(numpy.concatenate([empty] + original + entered))
+    current = [reduced[k] if k in reduced else original[k] for k in range(len(original))]
+    counts = numpy.bincount(numpy.searchsorted(cells, numpy.concatenate([empty] + current)), minlength=len(cells))
+
+    new_cells = numpy.searchsorted(cells, numpy.concatenate([empty] + entered))
+    new_owners = numpy.repeat(candidates, [len(keys) for keys in entered])
+    while True:
+        conflicts = numpy.unique(new_owners[(counts[new_cells] > 1) & ~restored[new_owners]])
+        if len(conflicts) == 0:
+            return [lines[k] if restored[k] else simplified[k] for k in range(n)]
+        restored[conflicts] = True
+        for k in conflicts:
+            counts[numpy.searchsorted(cells, reduced[k])] -= 1
+            counts[numpy.searchsorted(cells, original[k])] += 1
+
+def inside_rings(xy, rings):
+    # points inside any of the closed rings by the even-odd rule
+    inside = numpy.zeros(len(xy), dtype=bool)
+    for ring in rings:
+        x0, y0 = ring[:, 0].min(), ring[:, 1].min()
+        x1, y1 = ring[:, 0].max(), ring[:, 1].max()
+        near = numpy.flatnonzero((xy[:, 0] > x0) & (xy[:, 0] < x1) & (xy[:, 1] > y0) & (xy[:, 1] < y1))
+        if len(near) == 0:
+            continue
+        x = xy[near, 0]
+        y = xy[near, 1]
+        odd = numpy.zeros(len(near), dtype=bool)
+        for (xa, ya), (xb, yb) in zip(ring[:-1, :2], ring[1:, :2]):
+            crosses = (ya > y) != (yb > y)
+            odd ^= crosses & (x < xa + (xb - xa) * (y - ya) / numpy.where(yb != ya, yb - ya, 1))
+        inside[near[odd]] = True
+    return inside
+
+def constraint_points(lines, cellsize):
+    # unique vertices of lines given by surface types, densified by the cell size so that every cell
+    # they cross is constrained. Vertices of other lines inside softreplace polygons are dropped,
+    # so that the polygons are interpolated from their boundaries only
+    rings = [line for line in lines.get('softreplace', []) if len(line) > 3]
+    groups = []
+    for kind in SURFACE_TYPES:
+        xyz = line_points(lines.get(kind, []), cellsize)
+        if kind != 'softreplace' and len(rings) > 0:
+            xyz = xyz[~inside_rings(xyz, rings)]
+        groups.append(xyz)
+
+    xyz = numpy.vstack(groups)
+    _, first = numpy.unique(xyz[:, 0] + 1j * xyz[:, 1], return_index=True)
+    return xyz[numpy.sort(first)]
+
+def triangulate(lines, cellsize):
+    # Delaunay triangulation of line vertices, lines are densified to be respected by edges
+    xyz = constraint_points(lines, cellsize)
+    if len(xyz) < 3:
+        return None, xyz[:, 2]
+    return Delaunay(xyz[:, :2]), xyz[:, 2]
+
+def rasterize(tri, z, xmin, ymax, cellsize, shape, block=256):
+    # linear (barycentric) interpolation within triangles at cell centers, NaN outside of the TIN.
+    # Rows are processed by blocks to bound the memory
+    ni, nj = shape
+    out = numpy.full(shape, numpy.nan, dtype=numpy.float32)
+    if tri is None:
+        return out
+
+    x = xmin + (numpy.arange(nj) + 0.5) * cellsize
+    for r0 in range(0, ni, block):
+        r1 = min(r0 + block, ni)
+        y = ymax - (numpy.arange(r0, r1) + 0.5) * cellsize
+        pts = numpy.column_stack((numpy.tile(x, r1 - r0), numpy.repeat(y, nj)))
+
+        s = tri.find_simplex(pts)
+        inside = s >= 0
+        s = s[inside]
+        t = tri.transform[s]
+        b = numpy.einsum('ijk,ik->ij', t[:, :2], pts[inside] - t[:, 2])
+        w = numpy.column_stack((b, 1 - b.sum(axis=1)))
+
+        block_out = numpy.full(len(pts), numpy.nan, dtype=numpy.float32)
+        block_out[inside] = (z[tri.simplices[s]] * w).sum(axis=1)
+        out[r0:r1] = block_out.reshape(r1 - r0, nj)
+
+    return out
+
+def tin_raster(lines, xmin, ymax, cellsize, shape):
+    # raster of the TIN constrained by 3D lines of surface types on the grid of the given extent
+    tri, z = triangulate(lines, cellsize)
+    return rasterize(tri, z, xmin, ymax, cellsize, shape)
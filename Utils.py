@@ -1,11 +1,21 @@
 # Frechet distance implementation is borrowed from
 # https://gist.github.com/MaxBareiss/ba2f9441d9455b56fbc9
 import math
+import hashlib
 import numpy
 import arcpy
 import os
+import multiprocessing
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 
+can_use_early_break = True
+
+try:
+    from scipy.spatial.distance import directed_hausdorff
+except ImportError:
+    can_use_early_break = False
+
 def euc_dist(p1, p2):
     return math.sqrt((p2[0] - p1[0]) * (p2[0] - p1[0]) + (p2[1] - p1[1]) * (p2[1] - p1[1]))
 
@@ -13,17 +23,33 @@ def euc_matrix(P, Q):
     mdist = cdist(P, Q, 'euclidean')
     return mdist
 
+def nearest_dists(P, Q):
+    # distances from every vertex of P to the closest vertex of Q,
+    # KD-tree keeps memory linear in the number of vertices
+    return cKDTree(numpy.asarray(Q, dtype=float)).query(numpy.asarray(P, dtype=float))[0]
+
+def hausdorff_dists(P, Q):
+    # all Hausdorff variants from one pair of nearest neighbour traversals:
+    # (hausdorff, directed P->Q, directed Q->P, modified).
+    # Modified distance is the larger of mean Q->P distance and directed P->Q distance
+    # as it was computed from the full distance matrix
+    dpq = nearest_dists(P, Q)
+    dqp = nearest_dists(Q, P)
+    forw = dpq.max()
+    back = dqp.max()
+    return max(forw, back), forw, back, max(numpy.mean(dqp), forw)
+
 def hausdorff_dist(P, Q):
-    m = euc_matrix(P, Q)
-    return max(max(numpy.amin(m, 0)), max(numpy.amin(m, 1)))
+    return hausdorff_dists(P, Q)[0]
 
 def hausdorff_dist_dir(P, Q):
-    m = euc_matrix(P, Q)
-    return max(numpy.amin(m, 1))
+    # Taha-Hanbury early break with randomized order if available
+    if can_use_early_break:
+        return directed_hausdorff(numpy.asarray(P, dtype=float), numpy.asarray(Q, dtype=float), seed=0)[0]
+    return nearest_dists(P, Q).max()
 
 def hausdorff_dist_mod(P, Q):
-    m = euc_matrix(P, Q)
-    return max(numpy.mean(numpy.amin(m, 0)), numpy.mean(max(numpy.amin(m, 1))))
+    return hausdorff_dists(P, Q)[3]
 
 def frechet_dist(P,Q):
     n = len(P)
@@ -53,16 +79,465 @@ dist_fun = {
 def get_values(features, field):
     return numpy.asarray([row[0] for row in arcpy.da.SearchCursor(features, field)])
 
+def get_vertices(features, field=None):
+    # all vertices of a feature class in one bulk read:
+    # line k occupies xy[offsets[k]:offsets[k+1]], keys[k] and oids[k] are its field value and OID.
+    # Lines follow the features in table order, features without geometry are left out
+    fields = ['OID@', 'SHAPE@X', 'SHAPE@Y', 'SHAPE@LENGTH']
+    if field is not None:
+        fields.append(field)
+
+    pts = arcpy.da.FeatureClassToNumPyArray(features, fields, explode_to_points=True)
+    pts = pts[numpy.isfinite(pts['SHAPE@X']) & numpy.isfinite(pts['SHAPE@Y'])]
+
+    # vertices of a feature repeat its OID, a line starts where the OID changes
+    ids = pts['OID@'].astype(numpy.int64)
+    starts = numpy.flatnonzero(numpy.concatenate(([True], ids[1:] != ids[:-1]))) if len(ids) > 0 \
+        else numpy.zeros(0, dtype=numpy.int64)
+    offsets = numpy.concatenate((starts, [len(ids)])).astype(numpy.int64)
+    oids = ids[starts]
+
+    xy = numpy.empty((len(pts), 2), dtype=numpy.float64)
+    xy[:, 0] = pts['SHAPE@X']
+    xy[:, 1] = pts['SHAPE@Y']
+
+    keys = pts[field][starts] if field is not None else None
+
+    # parts of a multipart feature are exploded one after another, so the jumps between them
+    # make the vertex chain longer than the feature. Only the first part of such features is kept
+    if len(starts) == 0:
+        return xy, offsets, keys, oids
+    seglen = numpy.zeros(len(xy))
+    seglen[:-1] = numpy.hypot(xy[1:, 0] - xy[:-1, 0], xy[1:, 1] - xy[:-1, 1])
+    seglen[offsets[1:] - 1] = 0
+    chain = numpy.add.reduceat(seglen, starts)
+    length = pts['SHAPE@LENGTH'][starts]
+    multipart = numpy.flatnonzero(chain > length * (1 + 1e-9) + 1e-9)
+    if len(multipart) > 0:
+        xy, offsets = first_parts(features, xy, offsets, oids, multipart)
+
+    return xy, offsets, keys, oids
+
+def first_parts(features, xy, offsets, oids, multipart):
+    # only multipart features are read as geometries
+    index = dict((int(oids[k]), k) for k in multipart)
+    oidfield = arcpy.AddFieldDelimiters(features, arcpy.Describe(features).OIDFieldName)
+    parts = {}
+    with arcpy.da.SearchCursor(features, ['OID@', 'SHAPE@'],
+                               oidfield + ' IN (' + ', '.join(str(oid) for oid in sorted(index)) + ')') as rows:
+        for row in rows:
+            parts[index[row[0]]] = numpy.asarray([[pnt.X, pnt.Y] for pnt in row[1].getPart(0) if pnt is not None],
+                                                 dtype=numpy.float64).reshape(-1, 2)
+
+    lines = [parts[k] if k in parts else xy[offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)]
+    counts = [len(line) for line in lines]
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+    xy = numpy.vstack(lines) if len(lines) > 0 else numpy.zeros((0, 2))
+    return xy, offsets
+
+def get_line(xy, offsets, k):
+    return xy[offsets[k]:offsets[k + 1]]
+
+def index_by_keys(keys):
+    # hash table from key to the first line with this key
+    index = {}
+    for k in range(len(keys) - 1, -1, -1):
+        index[keys[k]] = k
+    return index
+
+def join_by_keys(left_keys, right_keys):
+    # pairs of line indices with equal keys, each input is hashed once
+    index = index_by_keys(right_keys)
+    return [(k, index[key]) for k, key in enumerate(left_keys) if key in index]
+
+def get_nproc(num_processes):
+    nproc = multiprocessing.cpu_count()
+
+    if 0 < num_processes < 1:
+        nproc = int(math.ceil(nproc * num_processes))
+    elif num_processes < 0:  # all cores except the given number
+        nproc = int(math.floor(nproc + num_processes))
+        if nproc < 1:
+            nproc = 1
+    elif num_processes >= 1:
+        nproc = int(math.ceil(num_processes))
+
+    return int(nproc)
+
+def imap_parallel(func, args, is_parallel=False, num_processes=0, chunksize=16):
+    # yields func(arg) in the order of args, using a process pool if requested
+    if not is_parallel:
+        for arg in args:
+            yield func(arg)
+        return
+
+    nproc = get_nproc(num_processes)
+    arcpy.AddMessage('> Trying to make multiprocessing using ' + str(nproc) + ' processor cores')
+
+    pool = multiprocessing.Pool(nproc)
+    try:
+        for result in pool.imap(func, args, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
 def get_coordinates(features):
+    xy, offsets, _, _ = get_vertices(features)
+    return [get_line(xy, offsets, k) for k in range(len(offsets) - 1)]
+
+def line_wkt(xy):
+    if xy.shape[1] > 2:
+        return 'LINESTRING Z (' + ', '.join('%r %r %r' % (float(x), float(y), float(z)) for x, y, z in xy) + ')'
+    return 'LINESTRING (' + ', '.join('%r %r' % (float(x), float(y)) for x, y in xy) + ')'
+
+def write_lines(features, lines, spatial_reference, field=None, values=None, field_type='LONG', has_z=False):
+    arcpy.CreateFeatureclass_management(os.path.dirname(features), os.path.basename(features),
+                                        geometry_type='POLYLINE', spatial_reference=spatial_reference,
+                                        has_z='ENABLED' if has_z else 'DISABLED')
+    fields = ['SHAPE@WKT']
+    if field is not None:
+        arcpy.AddField_management(features, field, field_type)
+        fields.append(field)
+
+    with arcpy.da.InsertCursor(features, fields) as cursor:
+        for k in range(len(lines)):
+            if len(lines[k]) < 2:
+                continue
+            row = [line_wkt(lines[k])]
+            if field is not None:
+                row.append(values[k])
+            cursor.insertRow(row)
+
+    return features
+
+def line_cells(xy, xmin, ymax, cellsize, shape):
+    # supercover rasterization: rows and columns of all cells crossed by polyline,
+    # ordered from its first vertex and listed once
+    if len(xy) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+
+    x = (xy[:, 0] - xmin) / cellsize
+    y = (ymax - xy[:, 1]) / cellsize
+
+    rows = []
+    cols = []
+    for k in range(max(len(xy) - 1, 1)):
+        x0, y0 = x[k], y[k]
+        x1, y1 = (x[k + 1], y[k + 1]) if len(xy) > 1 else (x0, y0)
+        dx = x1 - x0
+        dy = y1 - y0
+
+        # parameters of the grid lines crossings along the segment
+        t = [numpy.array([0.0, 1.0])]
+        if dx != 0:
+            t.append((numpy.arange(math.ceil(min(x0, x1)), math.floor(max(x0, x1)) + 1) - x0) / dx)
+        if dy != 0:
+            t.append((numpy.arange(math.ceil(min(y0, y1)), math.floor(max(y0, y1)) + 1) - y0) / dy)
+        t = numpy.unique(numpy.concatenate(t))
+
+        tm = 0.5 * (t[:-1] + t[1:]) if len(t) > 1 else t
+        rows.append(numpy.floor(y0 + tm * dy).astype(int))
+        cols.append(numpy.floor(x0 + tm * dx).astype(int))
+
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+
+    # segments passing exactly through cell corners touch both side cells
+    diag = numpy.flatnonzero((numpy.diff(rows) != 0) & (numpy.diff(cols) != 0)) + 1
+    if len(diag) > 0:
+        rows = numpy.insert(rows, numpy.repeat(diag, 2), numpy.column_stack((rows[diag - 1], rows[diag])).ravel())
+        cols = numpy.insert(cols, numpy.repeat(diag, 2), numpy.column_stack((cols[diag], cols[diag - 1])).ravel())
+
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    rows = rows[inside]
+    cols = cols[inside]
+
+    _, first = numpy.unique(rows * shape[1] + cols, return_index=True)
+    first.sort()
+
+    return rows[first], cols[first]
+
+def label_boundaries(labels):
+    # edges between cells with different labels, at least one of them positive, chained into lines
+    # of cell corners (row, col) which are split where more than two edges meet
+    ni, nj = labels.shape
+    m = nj + 1
+
+    i, j = numpy.nonzero((labels[1:] != labels[:-1]) & ((labels[1:] > 0) | (labels[:-1] > 0)))
+    a = [(i + 1) * m + j]
+    b = [(i + 1) * m + j + 1]
+    i, j = numpy.nonzero((labels[:, 1:] != labels[:, :-1]) & ((labels[:, 1:] > 0) | (labels[:, :-1] > 0)))
+    a.append(i * m + j + 1)
+    b.append((i + 1) * m + j + 1)
+    a = numpy.concatenate(a)
+    b = numpy.concatenate(b)
+    n = len(a)
+
+    # every edge is listed from both of its corners
+    src = numpy.concatenate((a, b))
+    order = numpy.argsort(src, kind='mergesort')
+    dst = numpy.concatenate((b, a))[order].tolist()
+    eid = numpy.concatenate((numpy.arange(n), numpy.arange(n)))[order].tolist()
+    starts = numpy.searchsorted(src[order], numpy.arange((ni + 1) * m + 1))
+    degree = numpy.diff(starts)
+
+    used = [False] * n
     lines = []
-    with arcpy.da.SearchCursor(features, "SHAPE@") as rows:
-        for row in rows:
-            coords = []
-            for pnt in row[0].getPart().next():
-                coords.append([pnt.X, pnt.Y])
-            lines.append(coords)
+    # lines between nodes go first, closed rings remain
+    firsts = numpy.concatenate((numpy.flatnonzero((degree > 0) & (degree != 2)), src[order]))
+    starts = starts.tolist()
+    for c in firsts.tolist():
+        for p in range(starts[c], starts[c + 1]):
+            if used[eid[p]]:
+                continue
+            line = [c]
+            q = p
+            while True:
+                used[eid[q]] = True
+                cur = dst[q]
+                line.append(cur)
+                if degree[cur] != 2:
+                    break
+                q = starts[cur] if not used[eid[starts[cur]]] else starts[cur] + 1
+                if used[eid[q]]:
+                    break
+            lines.append(numpy.column_stack(numpy.divmod(line, m)))
+
     return lines
 
+def sample_heights(dem, xy, xmin, ymax, cellsize):
+    # bilinear interpolation between cell centers, NoData cells are excluded from weights
+    ni, nj = dem.shape
+    u = (xy[:, 0] - xmin) / cellsize - 0.5
+    v = (ymax - xy[:, 1]) / cellsize - 0.5
+    c0 = numpy.floor(u).astype(int)
+    r0 = numpy.floor(v).astype(int)
+    fu = u - c0
+    fv = v - r0
+
+    num = numpy.zeros(len(xy))
+    den = numpy.zeros(len(xy))
+    for dr, dc, w in ((0, 0, (1 - fv) * (1 - fu)), (0, 1, (1 - fv) * fu), (1, 0, fv * (1 - fu)), (1, 1, fv * fu)):
+        r = r0 + dr
+        c = c0 + dc
+        z = dem[numpy.clip(r, 0, ni - 1), numpy.clip(c, 0, nj - 1)]
+        valid = (r >= 0) & (r < ni) & (c >= 0) & (c < nj) & numpy.isfinite(z)
+        num += numpy.where(valid, w * z, 0)
+        den += numpy.where(valid, w, 0)
+
+    return numpy.where(den > 0, num / numpy.maximum(den, 1e-12), numpy.nan)
+
+def densify(xy, step):
+    # vertices are inserted along segments so that they are not longer than step in plan,
+    # other columns (heights) are interpolated linearly
+    if len(xy) < 2:
+        return xy
+    d = numpy.hypot(xy[1:, 0] - xy[:-1, 0], xy[1:, 1] - xy[:-1, 1])
+    n = numpy.maximum(numpy.ceil(d / step).astype(int), 1)
+    idx = numpy.repeat(numpy.arange(len(d)), n)
+    t = (numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)) / numpy.repeat(n, n).astype(float)
+    pts = xy[idx] + t[:, numpy.newaxis] * (xy[idx + 1] - xy[idx])
+    return numpy.vstack((pts, xy[-1:]))
+
+def simplify(xy, tolerance):
+    # Douglas-Peucker simplification in plan, first and last vertices are kept,
+    # other columns (heights) are kept for the remaining vertices
+    n = len(xy)
+    if n < 3 or tolerance <= 0:
+        return xy
+
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+    stack = [(0, n - 1)]
+    while len(stack) > 0:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        p = xy[i + 1:j]
+        dx = xy[j, 0] - xy[i, 0]
+        dy = xy[j, 1] - xy[i, 1]
+        length = math.hypot(dx, dy)
+        if length > 0:
+            dist = numpy.abs(dx * (p[:, 1] - xy[i, 1]) - dy * (p[:, 0] - xy[i, 0])) / length
+        else: # closed ring
+            dist = numpy.hypot(p[:, 0] - xy[i, 0], p[:, 1] - xy[i, 1])
+        k = int(numpy.argmax(dist))
+        if dist[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack.append((i, i + 1 + k))
+            stack.append((i + 1 + k, j))
+
+    return xy[keep]
+
+def sample_parts(dem, parts, xmin, ymax, cellsize):
+    # heights of the vertices of all parts in one call, vertices without heights are dropped
+    if len(parts) == 0:
+        return []
+    sizes = [len(xy) for xy in parts]
+    xy = numpy.vstack(parts)
+    xyz = numpy.column_stack((xy, sample_heights(dem, xy, xmin, ymax, cellsize)))
+    return [p[numpy.isfinite(p[:, 2])] for p in numpy.split(xyz, numpy.cumsum(sizes)[:-1])]
+
+def get_parts(features):
+    # vertices of all parts and rings of features, feature k is made of counts[k] of them
+    parts = []
+    counts = []
+    with arcpy.da.SearchCursor(features, ['SHAPE@']) as rows:
+        for row in rows:
+            n = len(parts)
+            if row[0] is not None:
+                for part in row[0]:
+                    ring = []
+                    for pnt in part:
+                        if pnt is None:  # interior rings of polygons are separated by None
+                            parts.append(numpy.array(ring, dtype=float).reshape(-1, 2))
+                            ring = []
+                        else:
+                            ring.append((pnt.X, pnt.Y))
+                    parts.append(numpy.array(ring, dtype=float).reshape(-1, 2))
+            counts.append(len(parts) - n)
+    return parts, counts
+
+def write_parts(features, parts, counts, geometry_type, spatial_reference):
+    # 3D features assembled from counts[k] arrays of x, y, z for feature k
+    arcpy.CreateFeatureclass_management(os.path.dirname(features), os.path.basename(features),
+                                        geometry_type=geometry_type, spatial_reference=spatial_reference,
+                                        has_z='ENABLED')
+    shape = arcpy.Polygon if geometry_type == 'POLYGON' else arcpy.Polyline
+    minsize = 3 if geometry_type == 'POLYGON' else 2
+
+    with arcpy.da.InsertCursor(features, ['SHAPE@']) as cursor:
+        k = 0
+        for n in counts:
+            rings = [arcpy.Array([arcpy.Point(*p) for p in xyz]) for xyz in parts[k:k + n] if len(xyz) >= minsize]
+            k += n
+            if len(rings) > 0:
+                cursor.insertRow([shape(arcpy.Array(rings), spatial_reference, True)])
+
+    return features
+
+def read_raster(in_raster, lowerleft=None, ncols=None, nrows=None):
+    # float64 array with NaN in NoData cells, optionally a window from lower left corner
+    raster = arcpy.Raster(in_raster)
+    nodata = raster.noDataValue
+    if nodata is None:
+        nodata = -9999
+
+    if lowerleft is None:
+        array = arcpy.RasterToNumPyArray(raster, nodata_to_value=nodata)
+    else:
+        array = arcpy.RasterToNumPyArray(raster, lowerleft, ncols, nrows, nodata_to_value=nodata)
+
+    array = array.astype(numpy.float64)
+    array[array == nodata] = numpy.nan
+    return array
+
+def write_raster(array, lowerleft, cellsize, crs, out_raster, nodata=None):
+    # float32 raster with NaN as NoData, or raster of array type if NoData value is given
+    if nodata is None:
+        raster = arcpy.NumPyArrayToRaster(array.astype(numpy.float32), lowerleft, cellsize, value_to_nodata=numpy.nan)
+    else:
+        raster = arcpy.NumPyArrayToRaster(array, lowerleft, cellsize, value_to_nodata=nodata)
+    arcpy.DefineProjection_management(raster, crs)
+    raster.save(out_raster)
+    return out_raster
+
+def write_block(array, template, r0, c0, out_raster):
+    # window of the template raster grid starting at row r0 and column c0 with NaN as NoData,
+    # written with the pixel type, NoData value and coordinate system of the template
+    desc = arcpy.Describe(template)
+    raster = arcpy.Raster(template)
+    dtype = arcpy.RasterToNumPyArray(raster, ncols=1, nrows=1).dtype
+    nodata = raster.noDataValue
+
+    if numpy.issubdtype(dtype, numpy.integer):
+        if nodata is None:
+            nodata = numpy.iinfo(dtype).min
+        array = numpy.where(numpy.isnan(array), nodata, numpy.round(array)).astype(dtype)
+    else:
+        array = array.astype(dtype)
+        if nodata is None:
+            nodata = numpy.nan
+        else:
+            array[numpy.isnan(array)] = nodata
+
+    arcpy.env.outputCoordinateSystem = desc.spatialReference
+    lowerleft = arcpy.Point(desc.extent.XMin + c0 * desc.meanCellWidth,
+                            desc.extent.YMax - (r0 + array.shape[0]) * desc.meanCellHeight)
+    block = arcpy.NumPyArrayToRaster(array, lowerleft, desc.meanCellWidth, desc.meanCellHeight, nodata)
+    arcpy.DefineProjection_management(block, desc.spatialReference)
+    block.save(out_raster)
+    return out_raster
+
+def mosaic_blocks(template, blocks, out_raster):
+    # copy of the template raster with all blocks mosaicked over it in one call
+    arcpy.CopyRaster_management(template, out_raster)
+    if len(blocks) > 0:
+        arcpy.Mosaic_management(';'.join(blocks), out_raster, 'LAST')
+    return out_raster
+
+# version of processing stages and their stored arrays, results of other versions are not reused
+CACHE_VERSION = 1
+
+def content_key(*items):
+    # hash of arrays, lists of arrays and parameters defining the result of a processing stage
+    h = hashlib.sha1(('version' + str(CACHE_VERSION)).encode('utf-8'))
+    for item in items:
+        if isinstance(item, numpy.ndarray):
+            h.update((str(item.dtype) + str(item.shape)).encode('utf-8'))
+            h.update(numpy.ascontiguousarray(item).tobytes())
+        elif isinstance(item, (list, tuple)):
+            h.update(('[' + str(len(item))).encode('utf-8'))
+            h.update(content_key(*item).encode('utf-8'))
+        else:
+            h.update(repr(item).encode('utf-8'))
+    return h.hexdigest()
+
+def cache_load(folder, key):
+    # arrays stored under the key or None, the entry becomes the most recently used
+    path = os.path.join(folder, key + '.npz')
+    if not os.path.exists(path):
+        return None
+    try:
+        os.utime(path, None)
+        with numpy.load(path) as data:
+            return dict((name, data[name]) for name in data.files)
+    except (IOError, OSError, ValueError):
+        return None
+
+def cache_save(folder, key, arrays, maxsize):
+    # arrays are stored under the key, least recently used entries are removed
+    # until the cache takes no more than maxsize bytes
+    path = os.path.join(folder, key + '.npz')
+    temp = path + '.' + str(os.getpid())
+    with open(temp, 'wb') as f:
+        numpy.savez(f, **arrays)
+    try:
+        os.rename(temp, path)
+    except OSError:  # stored by another process
+        os.remove(temp)
+
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(folder, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+            except OSError:
+                pass
+
+    size = sum(entry[1] for entry in entries)
+    for mtime, nbytes, name in sorted(entries):
+        if size <= maxsize:
+            break
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+        size -= nbytes
+
 def CreateScratchWorkspace(workspace, defname='scratch'):
     defworkspace = arcpy.env.workspace
 
@@ -0,0 +1,17 @@
+# arcpy is available only with ArcGIS, array functions of the modules are tested without it
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = types.ModuleType('arcpy')
+    for name in ['sa', 'da']:
+        module = types.ModuleType('arcpy.' + name)
+        setattr(arcpy, name, module)
+        sys.modules['arcpy.' + name] = module
+    sys.modules['arcpy'] = arcpy
+    arcpy.AddMessage = arcpy.AddWarning = lambda message: None
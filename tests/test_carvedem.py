@@ -0,0 +1,67 @@
+import numpy
+import CarveDEM
+
+
+def line(*cells):
+    return numpy.array(cells)
+
+
+def carve_order(features, shape):
+    junctions, groups = CarveDEM.stream_network(features, shape)
+    return junctions, [k for group in groups for k in group]
+
+
+def test_tributaries_are_carved_after_main_stream():
+    # U1 flows into U, U and T meet at X = (5, 5) where D starts
+    u1 = line((0, 2), (1, 2), (2, 2), (2, 3))
+    u = line((2, 0), (2, 1), (3, 2), (4, 3), (4, 4), (5, 5))
+    t = line((8, 5), (7, 5), (6, 5), (5, 5))
+    d = line((5, 5), (5, 6), (5, 7), (5, 8))
+
+    junctions, order = carve_order([u1, u, t, d], (10, 10))
+
+    assert order[0] == 3
+    assert order.index(0) > order.index(1)
+    assert junctions[3] is None
+    assert tuple(junctions[1]) == (5, 5) and tuple(junctions[2]) == (5, 5)
+
+
+def test_stream_flows_into_stream_next_to_its_outlet():
+    main = line((0, 0), (1, 1), (2, 2), (3, 3))
+    trib = line((0, 4), (1, 3), (2, 3))
+
+    junctions, order = carve_order([trib, main], (5, 5))
+
+    assert order == [1, 0]
+    assert tuple(junctions[0]) == (2, 2)
+
+
+def test_independent_networks_are_separate_groups():
+    a = line((0, 0), (0, 1))
+    b = line((5, 5), (5, 6))
+
+    junctions, groups = CarveDEM.stream_network([a, b], (10, 10))
+
+    assert sorted(groups) == [[0], [1]]
+
+
+def test_carve_profile_is_monotone():
+    z = numpy.array([10., 8., 9., 6., 7., 5.])
+    cells = numpy.column_stack((numpy.zeros(6), numpy.arange(6)))
+
+    carved, ncarved = CarveDEM.carve_profile(z, cells, 1)
+
+    assert (numpy.diff(carved) <= 0).all()
+    assert carved[0] == 10 and carved[-1] == 5
+
+
+def test_carve_profile_keeps_nodata():
+    z = numpy.array([10., numpy.nan, 9., 12., numpy.nan, 5.])
+    cells = numpy.column_stack((numpy.zeros(6), numpy.arange(6)))
+
+    carved, ncarved = CarveDEM.carve_profile(z, cells, 1)
+
+    assert numpy.isnan(carved[[1, 4]]).all()
+    valid = carved[numpy.isfinite(carved)]
+    assert (numpy.diff(valid) <= 0).all()
+    assert valid[-1] == 5
@@ -0,0 +1,14 @@
+import numpy
+import ConflateDEM
+
+
+def test_drainage_groups_join_touching_lines():
+    a = numpy.array([[0.0, 0.0], [5.0, 0.0]])
+    b = numpy.array([[5.0, 0.2], [5.0, 5.0]])
+    c = numpy.array([[20.0, 20.0], [25.0, 20.0]])
+    groups = ConflateDEM.drainage_groups([a, b, c], 0.5)
+    assert sorted(group.tolist() for group in groups) == [[0, 1], [2]]
+
+
+def test_drainage_groups_of_no_lines():
+    assert ConflateDEM.drainage_groups([], 0.5) == []
@@ -0,0 +1,54 @@
+import numpy
+import ConflateDEMbyLinks as CL
+
+
+def dem():
+    i, j = numpy.mgrid[0:10, 0:10]
+    return (i * 10 + j).astype(float)
+
+
+def square_mask():
+    mask = numpy.zeros((10, 10), dtype=bool)
+    mask[2:8, 2:8] = True
+    return mask
+
+
+def test_rubbersheet_moves_cells_along_links():
+    links = numpy.array([[3.5, 5.5, 4.5, 5.5]])
+
+    out = CL.rubbersheet_array(dem(), square_mask(), links, 0, 10, 1)
+
+    # the target cell takes the height of the source cell
+    assert out[4, 4] == dem()[4, 3]
+    assert numpy.array_equal(out[~square_mask()], dem()[~square_mask()])
+
+
+def test_empty_mask_leaves_dem_unchanged():
+    links = numpy.array([[3.5, 5.5, 4.5, 5.5]])
+
+    out = CL.rubbersheet_array(dem(), numpy.zeros((10, 10), dtype=bool), links, 0, 10, 1)
+
+    assert numpy.array_equal(out, dem())
+
+
+def test_no_links_and_no_fixed_points_leave_dem_unchanged():
+    # a single cell has no interior, its only fixed point is dropped next to the link target
+    mask = numpy.zeros((10, 10), dtype=bool)
+    mask[4, 4] = True
+
+    out = CL.rubbersheet_array(dem(), mask, numpy.zeros((0, 4)), 0, 10, 1)
+    assert numpy.array_equal(out, dem())
+
+    out = CL.rubbersheet_array(dem(), mask, numpy.array([[3.5, 5.5, 4.5, 5.5]]), 0, 10, 1)
+    assert numpy.array_equal(out, dem())
+
+
+def test_collinear_control_points_leave_dem_unchanged():
+    # mask of one row: all fixed points and link targets lie on one line
+    mask = numpy.zeros((10, 10), dtype=bool)
+    mask[5, 1:9] = True
+    links = numpy.array([[4.5, 5.5, 4.5, 4.5]])
+
+    out = CL.rubbersheet_array(dem(), mask, links, 0, 10, 1)
+
+    assert numpy.array_equal(out, dem())
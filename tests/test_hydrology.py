@@ -0,0 +1,252 @@
+import numpy
+import Hydrology
+
+nan = numpy.nan
+
+
+def test_fill_raises_pit_to_spill_level():
+    dem = numpy.array([[5., 5., 5., 5., 5.],
+                       [5., 3., 2., 3., 5.],
+                       [5., 3., 1., 4., 5.],
+                       [5., 5., 5., 4.5, 5.]])
+
+    filled = Hydrology.fill_depressions(dem)
+
+    assert (filled[1:3, 1:4] == [[4.5, 4.5, 4.5], [4.5, 4.5, 4.5]]).all()
+    assert (filled[0] == 5).all() and filled[3, 3] == 4.5
+    assert dem[2, 2] == 1
+
+
+def test_fill_keeps_nodata_and_drains_to_it():
+    dem = numpy.array([[5., 5., 5., 5.],
+                       [5., 1., 2., 5.],
+                       [5., 2., nan, 5.],
+                       [5., 5., 5., 5.]])
+
+    filled = Hydrology.fill_depressions(dem)
+
+    assert numpy.isnan(filled[2, 2])
+    assert numpy.array_equal(filled[numpy.isfinite(dem)], dem[numpy.isfinite(dem)])
+
+
+def test_fill_with_epsilon_leaves_no_flats():
+    dem = numpy.full((5, 5), 5.)
+    dem[1:4, 1:4] = 1
+    dem[2, 4] = 2
+
+    filled = Hydrology.fill_depressions(dem, epsilon=True)
+
+    assert (filled[1:4, 1:4] > 2).all()
+    for i in range(1, 4):
+        for j in range(1, 4):
+            assert filled[i - 1:i + 2, j - 1:j + 2].min() < filled[i, j]
+
+
+def test_flow_direction_uses_arcgis_codes():
+    # cone draining to the centre cell which is a sink
+    i, j = numpy.mgrid[0:3, 0:3]
+    z = numpy.hypot(i - 1, j - 1) + 10
+
+    dirs = Hydrology.flow_direction(Hydrology.fill_depressions(z))
+    codes = Hydrology.flow_direction(z)
+
+    assert codes[0, 0] == 2 and codes[0, 1] == 4 and codes[0, 2] == 8
+    assert codes[1, 0] == 1 and codes[1, 2] == 16
+    assert codes[2, 0] == 128 and codes[2, 1] == 64 and codes[2, 2] == 32
+    assert (dirs > 0).all()
+
+
+def test_edge_cells_flow_outside():
+    z = numpy.array([[1., 2., 3.],
+                     [2., 3., 4.],
+                     [3., 4., 5.]])
+
+    dirs = Hydrology.flow_direction(z)
+
+    # the lowest corner has no lower neighbours and drains outside
+    assert dirs[0, 0] > 0
+    assert Hydrology.receivers(dirs)[0] == -1
+    assert (Hydrology.receivers(dirs)[1:] >= 0).all()
+
+
+def test_flats_drain_to_their_outlet():
+    z = numpy.full((5, 7), 9.)
+    z[2, 1:6] = 1
+    z[2, 6] = 0
+
+    dirs = Hydrology.flow_direction(z)
+
+    # every flat cell drains towards the outlet in the east
+    assert (dirs[2, 1:6] == 1).all()
+    acc = Hydrology.flow_accumulation(dirs)
+    assert (numpy.diff(acc[2, 1:]) > 0).all()
+
+
+def test_accumulation_counts_upstream_cells():
+    dirs = numpy.array([[1, 1, 4],
+                        [1, 1, 4],
+                        [64, 16, 4]], dtype=numpy.uint8)
+
+    acc = Hydrology.flow_accumulation(dirs)
+
+    assert numpy.array_equal(acc, [[0, 1, 2],
+                                   [2, 3, 7],
+                                   [1, 0, 8]])
+
+
+def test_accumulation_stops_at_nodata():
+    dirs = numpy.array([[1, 1, 0, 1]], dtype=numpy.uint8)
+    nodata = numpy.array([[False, False, True, False]])
+
+    acc = Hydrology.flow_accumulation(dirs, nodata)
+
+    assert numpy.array_equal(acc, [[0, 1, 0, 0]])
+
+
+def windows(shape, size):
+    return [(r0, min(r0 + size, shape[0]), c0, min(c0 + size, shape[1]))
+            for r0 in range(0, shape[0], size) for c0 in range(0, shape[1], size)]
+
+
+def padded(dem, window):
+    r0, r1, c0, c1 = window
+    return numpy.pad(dem, 1, mode='constant', constant_values=nan)[r0:r1 + 2, c0:c1 + 2]
+
+
+def tiled_fill(dem, size):
+    # the same sequence of steps as tiled_hydrology of GeneralizeDEM
+    tiles = windows(dem.shape, size)
+    fills = [Hydrology.tile_fill(padded(dem, w), w[0], w[2], dem.shape) for w in tiles]
+    spills = Hydrology.spill_levels([f[2] for f in fills], dem.shape)
+
+    filled = numpy.empty(dem.shape)
+    flats = numpy.zeros(dem.shape, dtype=numpy.uint8)
+    for (r0, r1, c0, c1), (z, labels, links), spill in zip(tiles, fills, spills):
+        filled[r0:r1, c0:c1], flats[r0:r1, c0:c1] = \
+            Hydrology.tile_drain(z, labels, Hydrology.outlets(padded(dem, (r0, r1, c0, c1))), spill, r0, c0, dem.shape)
+
+    dirs = Hydrology.steepest_descent(filled)
+    sel = (dirs == 0) & ~numpy.isnan(dem)
+    dirs[sel] = flats[sel]
+    return filled, dirs
+
+
+def tiled_accumulation(dirs, nodata, size):
+    tiles = windows(dirs.shape, size)
+    links = [Hydrology.tile_links(dirs[r0:r1, c0:c1], nodata[r0:r1, c0:c1], r0, c0, dirs.shape)
+             for r0, r1, c0, c1 in tiles]
+    inflow = Hydrology.perimeter_inflow(*[numpy.concatenate([l[1][i] for l in links]) for i in range(5)])
+    inflows = numpy.split(inflow, numpy.cumsum([len(l[1][0]) for l in links])[:-1])
+
+    acc = numpy.empty(dirs.shape)
+    for (r0, r1, c0, c1), (local, graph), i in zip(tiles, links, inflows):
+        acc[r0:r1, c0:c1] = Hydrology.add_inflow(dirs[r0:r1, c0:c1], nodata[r0:r1, c0:c1], local, i)
+    return acc
+
+
+def test_tiled_fill_matches_global_fill():
+    numpy.random.seed(1)
+    for size in (2, 3, 5, 7):
+        dem = numpy.round(numpy.random.rand(17, 13) * 10)
+        dem[numpy.random.rand(17, 13) < 0.05] = nan
+
+        filled, dirs = tiled_fill(dem, size)
+
+        assert numpy.array_equal(numpy.isnan(filled), numpy.isnan(dem))
+        valid = ~numpy.isnan(dem)
+        assert numpy.array_equal(filled[valid], Hydrology.fill_depressions(dem)[valid])
+
+
+def test_tiled_directions_drain_every_cell():
+    numpy.random.seed(2)
+    dem = numpy.round(numpy.random.rand(20, 20) * 5)
+    dem[8:11, 8:11] = nan
+
+    filled, dirs = tiled_fill(dem, 6)
+    nodata = numpy.isnan(dem)
+
+    # all valid cells reach an outlet, so they are counted by the accumulation of the outlets
+    assert (dirs[~nodata] > 0).all()
+    acc = Hydrology.flow_accumulation(dirs, nodata)
+    outlets = (Hydrology.receivers(dirs, nodata) < 0).reshape(dem.shape) & ~nodata
+    assert acc[outlets].sum() + outlets.sum() == (~nodata).sum()
+
+
+def test_tiled_accumulation_matches_global_accumulation():
+    numpy.random.seed(3)
+    dem = numpy.random.rand(23, 19) * 10
+    dem[numpy.random.rand(23, 19) < 0.05] = nan
+    filled, dirs = tiled_fill(dem, 5)
+    nodata = numpy.isnan(dem)
+
+    for size in (4, 5, 8, 23):
+        acc = tiled_accumulation(dirs, nodata, size)
+        assert numpy.array_equal(acc, Hydrology.flow_accumulation(dirs, nodata))
+
+
+def test_upstream_levels_start_at_outlets():
+    # chain 3 -> 2 -> 1 -> 0 and a donor 4 -> 1
+    rec = numpy.array([-1, 0, 1, 2, 1])
+
+    levels = Hydrology.upstream_levels(rec)
+
+    assert [sorted(level.tolist()) for level in levels] == [[0], [1], [2, 4], [3]]
+
+
+def test_watersheds_take_the_nearest_seed_downstream():
+    # one row draining east, seeds in cells 2 and 5
+    dirs = numpy.ones((1, 6), dtype=numpy.uint8)
+    rec = Hydrology.receivers(dirs)
+    seeds = numpy.array([[0, 0, 1, 0, 0, 2]], dtype=numpy.int32)
+
+    labels = Hydrology.watersheds(rec, Hydrology.upstream_levels(rec), seeds)
+
+    assert numpy.array_equal(labels, [[1, 1, 1, 2, 2, 2]])
+
+
+def test_cells_below_seeds_are_not_labelled():
+    dirs = numpy.ones((1, 4), dtype=numpy.uint8)
+    rec = Hydrology.receivers(dirs)
+    seeds = numpy.array([[0, 3, 0, 0]], dtype=numpy.int32)
+
+    labels = Hydrology.watersheds(rec, Hydrology.upstream_levels(rec), seeds)
+
+    assert numpy.array_equal(labels, [[3, 3, 0, 0]])
+
+
+def test_basins_split_at_the_divide():
+    # west half drains west, east half drains east
+    dirs = numpy.array([[16, 16, 1, 1],
+                        [16, 16, 1, 1]], dtype=numpy.uint8)
+    nodata = numpy.zeros(dirs.shape, dtype=bool)
+    rec = Hydrology.receivers(dirs, nodata)
+
+    labels = Hydrology.basins(rec, Hydrology.upstream_levels(rec), nodata)
+
+    assert len(numpy.unique(labels)) == 4
+    assert (labels[:, 0] == labels[:, 1]).all() and (labels[:, 2] == labels[:, 3]).all()
+    assert (labels[:, 0] != labels[:, 3]).all()
+
+
+def test_aggregate_by_bands_matches_whole_dem():
+    numpy.random.seed(4)
+    dem = numpy.random.rand(37, 29) * 10
+    dem[numpy.random.rand(37, 29) < 0.05] = nan
+
+    whole = Hydrology.aggregate([dem], 2, 3)
+    bands = Hydrology.aggregate([dem[r0:r0 + 8] for r0 in range(0, 37, 8)], 2, 3)
+
+    assert whole.shape == (10, 8)
+    assert numpy.array_equal(whole, bands, equal_nan=True)
+
+
+def test_aggregate_keeps_minima_in_channels():
+    # valley along the middle row drains west
+    i, j = numpy.mgrid[0:8, 0:16]
+    dem = numpy.abs(i - 3.5) * 10 + j * 0.1
+    dem[3:5] = j[3:5] * 0.1
+
+    coarse = Hydrology.aggregate([dem], 1, 2)
+
+    assert numpy.allclose(coarse[1:3, :2], dem[3, [0, 2]])
+    assert numpy.allclose(coarse[0], dem[0:2].reshape(1, 2, 8, 2).mean(axis=(1, 3)))
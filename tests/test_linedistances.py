@@ -0,0 +1,20 @@
+import numpy
+import LineDistances
+import Utils
+
+
+def test_missing_counterparts_are_reported(monkeypatch):
+    lines = {
+        'hydro': (numpy.array([[0, 0], [1, 0], [0, 5], [1, 5]], dtype=float), numpy.array([0, 2, 4]),
+                  numpy.array([1, 2]), numpy.array([1, 2])),
+        'count': (numpy.array([[0, 0.1], [1, 0.1]]), numpy.array([0, 2]), numpy.array([1]), numpy.array([7])),
+    }
+    tables = []
+    warnings = []
+    monkeypatch.setattr(Utils, 'get_vertices', lambda features, field: lines[features])
+    monkeypatch.setattr(LineDistances.arcpy.da, 'NumPyArrayToTable', lambda table, out: tables.append(table),
+                        raising=False)
+    monkeypatch.setattr(LineDistances.arcpy, 'AddWarning', warnings.append)
+    LineDistances.execute('hydro', 'ID', 'count', 'ID', 1.0, 'table')
+    assert tables[0]['ID'].tolist() == [1]
+    assert len(warnings) == 1 and warnings[0].endswith(': 2')
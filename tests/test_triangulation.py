@@ -0,0 +1,84 @@
+import numpy
+import Triangulation
+
+nan = numpy.nan
+
+
+def plane(xy):
+    return 2 * xy[:, 0] - xy[:, 1] + 10
+
+
+def lines_on_plane(*lines):
+    return [numpy.column_stack((xy, plane(xy))) for xy in map(numpy.array, lines)]
+
+
+def test_tin_raster_reproduces_plane():
+    square = lines_on_plane([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]])
+
+    raster = Triangulation.tin_raster({'softline': square}, 0, 10, 1, (10, 10))
+
+    i, j = numpy.mgrid[0:10, 0:10]
+    expected = plane(numpy.column_stack(((j + 0.5).ravel(), (9.5 - i).ravel()))).reshape(10, 10)
+    assert numpy.allclose(raster, expected, atol=1e-4)
+
+
+def test_tin_raster_is_nodata_outside_lines():
+    line = lines_on_plane([[2, 2], [8, 2], [8, 8], [2, 2]])
+
+    raster = Triangulation.tin_raster({'hardline': line}, 0, 10, 1, (10, 10))
+
+    assert numpy.isnan(raster[0, 0]) and numpy.isnan(raster[9, 9])
+    assert numpy.isfinite(raster[6, 6])
+
+
+def test_inside_rings_by_even_odd_rule():
+    ring = numpy.array([[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]], dtype=float)
+    xy = numpy.array([[1, 1], [5, 1], [3.9, 3.9], [-1, 2]], dtype=float)
+
+    assert Triangulation.inside_rings(xy, [ring]).tolist() == [True, False, True, False]
+
+
+def test_softreplace_polygons_drop_other_vertices():
+    ring = numpy.array([[2, 2, 5], [6, 2, 5], [6, 6, 5], [2, 6, 5], [2, 2, 5]], dtype=float)
+    peak = numpy.array([[4, 4, 100], [4, 4.5, 100]], dtype=float)
+    frame = numpy.array([[0, 0, 0], [8, 0, 0], [8, 8, 0], [0, 8, 0], [0, 0, 0]], dtype=float)
+
+    raster = Triangulation.tin_raster({'hardline': [frame], 'softline': [peak], 'softreplace': [ring]},
+                                      0, 8, 1, (8, 8))
+
+    # the polygon is flat at the height of its boundary, the peak inside is not used
+    assert numpy.allclose(raster[2:6, 2:6], 5)
+
+
+def test_lines_are_densified_by_cell_size():
+    hard = [numpy.array([[0, 0, 0], [10, 0, 0]], dtype=float)]
+    soft = [numpy.array([[0, 5, 0], [10, 5, 0]], dtype=float)]
+
+    xyz = Triangulation.constraint_points({'hardline': hard, 'softline': soft}, 1)
+
+    assert (xyz[:, 1] == 0).sum() == 11
+    assert (xyz[:, 1] == 5).sum() == 11
+
+
+def test_simplified_lines_do_not_cross_fixed_lines():
+    # the bend of the soft line goes around the end of the hard line,
+    # simplification would cut through it
+    soft = numpy.array([[0.5, 5.5, 0], [2.5, 5.5, 0], [2.5, 1.5, 0], [7.5, 1.5, 0], [7.5, 5.5, 0], [9.5, 5.5, 0]])
+    hard = numpy.array([[5.0, 3.5, 0], [5.0, 9.5, 0]])
+    # this line crosses the hard line before and after simplification
+    free = numpy.array([[0.5, 8.5, 0], [4.5, 8.6, 0], [9.5, 8.5, 0]])
+
+    result = Triangulation.simplify_lines([soft, free], 5, 0, 10, 1, (10, 10), [hard])
+
+    assert numpy.array_equal(result[0], soft)
+    assert len(result[1]) == 2
+
+
+def test_simplified_lines_keep_their_contacts():
+    # two lines sharing their first vertex are simplified together
+    a = numpy.array([[0.5, 0.5, 0], [5.0, 0.6, 0], [9.5, 0.5, 0]])
+    b = numpy.array([[0.5, 0.5, 0], [0.6, 5.0, 0], [0.5, 9.5, 0]])
+
+    result = Triangulation.simplify_lines([a, b], 1, 0, 10, 1, (10, 10))
+
+    assert [len(line) for line in result] == [2, 2]
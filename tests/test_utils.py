@@ -0,0 +1,152 @@
+import os
+import numpy
+import Utils
+
+
+def cells(rows, cols):
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def test_line_cells_horizontal():
+    xy = numpy.array([[0.5, 2.5], [3.5, 2.5]])
+    rows, cols = Utils.line_cells(xy, 0, 5, 1, (5, 5))
+    assert cells(rows, cols) == [(2, 0), (2, 1), (2, 2), (2, 3)]
+
+
+def test_line_cells_follow_first_vertex():
+    xy = numpy.array([[3.5, 2.5], [0.5, 2.5]])
+    rows, cols = Utils.line_cells(xy, 0, 5, 1, (5, 5))
+    assert cells(rows, cols) == [(2, 3), (2, 2), (2, 1), (2, 0)]
+
+
+def test_line_cells_diagonal_touches_side_cells():
+    xy = numpy.array([[0.5, 4.5], [2.5, 2.5]])
+    rows, cols = Utils.line_cells(xy, 0, 5, 1, (5, 5))
+    result = cells(rows, cols)
+    assert result[0] == (0, 0) and result[-1] == (2, 2)
+    assert set(result) == {(0, 0), (0, 1), (1, 0), (1, 1), (1, 2), (2, 1), (2, 2)}
+    # every next cell is a neighbour of the previous one
+    steps = numpy.abs(numpy.diff(numpy.column_stack((rows, cols)), axis=0))
+    assert (steps.max(axis=1) == 1).all()
+
+
+def test_line_cells_listed_once_and_clipped():
+    xy = numpy.array([[-2.5, 0.5], [2.5, 0.5], [2.5, 1.5], [0.5, 1.5], [0.5, 0.5]])
+    rows, cols = Utils.line_cells(xy, 0, 2, 1, (2, 2))
+    assert cells(rows, cols) == [(1, 0), (1, 1), (0, 1), (0, 0)]
+
+
+def test_line_cells_empty():
+    rows, cols = Utils.line_cells(numpy.zeros((0, 2)), 0, 5, 1, (5, 5))
+    assert len(rows) == 0 and len(cols) == 0
+
+
+def test_simplify_keeps_vertices_beyond_tolerance():
+    xy = numpy.array([[0, 0, 1], [1, 0.1, 2], [2, 1, 3], [3, 0.1, 4], [4, 0, 5]], dtype=float)
+
+    result = Utils.simplify(xy, 0.5)
+
+    assert numpy.array_equal(result, xy[[0, 2, 4]])
+
+
+def test_simplify_closed_ring():
+    ring = numpy.array([[0, 0], [2, 0.1], [4, 0], [4, 4], [0, 4], [0, 0]], dtype=float)
+
+    result = Utils.simplify(ring, 0.5)
+
+    assert numpy.array_equal(result, ring[[0, 2, 3, 4, 5]])
+
+
+def test_simplify_without_tolerance_returns_line():
+    xy = numpy.array([[0, 0], [1, 0.1], [2, 0]], dtype=float)
+
+    assert Utils.simplify(xy, 0) is xy
+
+
+def test_content_key_depends_on_arrays_and_version(monkeypatch):
+    a = numpy.arange(6)
+    key = Utils.content_key(['dir'], a, 1.5)
+
+    assert key == Utils.content_key(['dir'], numpy.arange(6), 1.5)
+    assert key != Utils.content_key(['dir'], a.reshape(2, 3), 1.5)
+    assert key != Utils.content_key(['dir'], a.astype(float), 1.5)
+    assert key != Utils.content_key(['acc'], a, 1.5)
+
+    monkeypatch.setattr(Utils, 'CACHE_VERSION', Utils.CACHE_VERSION + 1)
+    assert key != Utils.content_key(['dir'], a, 1.5)
+
+
+def test_cache_round_trip(tmp_path):
+    folder = str(tmp_path)
+    arrays = {'dir': numpy.array([[1, 2], [4, 8]], dtype=numpy.uint8), 'acc': numpy.array([0.5, numpy.nan])}
+
+    assert Utils.cache_load(folder, 'key') is None
+    Utils.cache_save(folder, 'key', arrays, 2 ** 20)
+    restored = Utils.cache_load(folder, 'key')
+
+    assert sorted(restored) == ['acc', 'dir']
+    assert restored['dir'].dtype == numpy.uint8
+    assert numpy.array_equal(restored['dir'], arrays['dir'])
+    assert numpy.array_equal(restored['acc'], arrays['acc'], equal_nan=True)
+
+
+def test_cache_removes_least_recently_used(tmp_path):
+    folder = str(tmp_path)
+    array = {'a': numpy.zeros(1000)}
+    for k, key in enumerate(['first', 'second']):
+        Utils.cache_save(folder, key, array, 10 ** 6)
+        os.utime(os.path.join(folder, key + '.npz'), (k, k))
+
+    # reading makes the first entry the most recent one
+    Utils.cache_load(folder, 'first')
+    Utils.cache_save(folder, 'third', array, 2.5 * os.path.getsize(os.path.join(folder, 'first.npz')))
+
+    assert sorted(os.listdir(folder)) == ['first.npz', 'third.npz']
+
+
+def exploded(rows):
+    return numpy.array(rows, dtype=[('OID@', 'i4'), ('SHAPE@X', 'f8'), ('SHAPE@Y', 'f8'),
+                                    ('SHAPE@LENGTH', 'f8'), ('ID', 'i4')])
+
+
+def test_get_vertices_splits_lines_by_oid(monkeypatch):
+    pts = exploded([(1, 0, 0, 2, 10), (1, 2, 0, 2, 10), (3, 5, 5, 1, 30), (3, 5, 6, 1, 30), (3, 5, 6, 1, 30)])
+    monkeypatch.setattr(Utils.arcpy.da, 'FeatureClassToNumPyArray', lambda *args, **kwargs: pts, raising=False)
+    monkeypatch.setattr(Utils.arcpy.da, 'SearchCursor', None, raising=False)
+    xy, offsets, keys, oids = Utils.get_vertices('lines', 'ID')
+    assert offsets.tolist() == [0, 2, 5]
+    assert keys.tolist() == [10, 30]
+    assert oids.tolist() == [1, 3]
+    assert Utils.get_line(xy, offsets, 1).tolist() == [[5, 5], [5, 6], [5, 6]]
+
+
+def test_get_vertices_keeps_first_part(monkeypatch):
+    # the second part of feature 2 is 10 units away from the first one
+    pts = exploded([(1, 0, 0, 1, 10), (1, 1, 0, 1, 10),
+                    (2, 0, 0, 2, 20), (2, 1, 0, 2, 20), (2, 11, 0, 2, 20), (2, 12, 0, 2, 20)])
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.X, self.Y = x, y
+
+    class Shape(object):
+        def getPart(self, i):
+            return [Point(0, 0), Point(1, 0)]
+
+    class Cursor(object):
+        def __init__(self, features, fields, where):
+            assert where.endswith('IN (2)')
+        def __enter__(self):
+            return iter([(2, Shape())])
+        def __exit__(self, *args):
+            return False
+
+    monkeypatch.setattr(Utils.arcpy.da, 'FeatureClassToNumPyArray', lambda *args, **kwargs: pts, raising=False)
+    monkeypatch.setattr(Utils.arcpy.da, 'SearchCursor', Cursor, raising=False)
+    monkeypatch.setattr(Utils.arcpy, 'Describe', lambda features: type('D', (), {'OIDFieldName': 'FID'}),
+                        raising=False)
+    monkeypatch.setattr(Utils.arcpy, 'AddFieldDelimiters', lambda features, field: field, raising=False)
+    xy, offsets, keys, oids = Utils.get_vertices('lines', 'ID')
+    assert offsets.tolist() == [0, 2, 4]
+    assert Utils.get_line(xy, offsets, 1).tolist() == [[0, 0], [1, 0]]
+    assert oids.tolist() == [1, 2]